@@ -34,29 +34,40 @@
 Admin interfaces for contact models.
 """
 
+import mimetypes
+import os
 import StringIO
+import uuid
 from collections import OrderedDict
 from datetime import datetime
 
+from django.conf import settings
 from django.conf.urls import url
-from django.contrib import admin
-from django.http import Http404, HttpResponse
+from django.contrib import admin, messages
+from django.contrib.admin.models import CHANGE, LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django import forms
 from django.shortcuts import get_object_or_404, render, redirect
+from django.utils.encoding import force_text
 # pylint: disable=E0611
 
 from djangoplicity.admincomments.admin import AdminCommentInline, \
     AdminCommentMixin
-from djangoplicity.contacts.exporter import ExcelExporter
+from djangoplicity.contacts.exporter import EXPORTERS, StreamingCSVExporter, get_exporter_class
 from djangoplicity.contacts.forms import ContactAdminForm, ContactForm, \
     ContactListAdminForm
 from djangoplicity.contacts.models import ContactGroup, Contact, Country, \
     CountryGroup, GroupCategory, ContactField, Field, Label, PostalZone, \
     ContactGroupAction, ImportTemplate, ImportMapping, ImportSelector, \
     ImportGroupMapping, Import, CONTACTS_FIELDS, Deduplication, \
-    Region
-from djangoplicity.contacts.tasks import import_data, contactgroup_change_check, \
-    direct_import_data
+    Region, export_fs
+from djangoplicity.contacts.signals import contacts_added, contacts_removed
+from djangoplicity.contacts.labels import LABEL_PROGRESS_CACHE_KEY
+from djangoplicity.contacts.tasks import import_data, direct_import_data, export_contacts, make_labels
 
 
 class ImportSelectorInlineAdmin( admin.TabularInline ):
@@ -491,6 +502,8 @@ class ContactAdmin( AdminCommentMixin, admin.ModelAdmin ):
         urls = super( ContactAdmin, self ).get_urls()
         extra_urls = [
             url( r'^(?P<pk>[0-9]+)/label/$', self.admin_site.admin_view( self.label_view ), name='contacts_label' ),
+            url( r'^export/(?P<filename>[\w.-]+)/$', self.admin_site.admin_view( self.export_view ), name='contacts_contact_export' ),
+            url( r'^labels/(?P<token>[0-9a-f]+)/$', self.admin_site.admin_view( self.label_progress_view ), name='contacts_contact_label_progress' ),
         ]
         return extra_urls + urls
 
@@ -529,55 +542,125 @@ class ContactAdmin( AdminCommentMixin, admin.ModelAdmin ):
 
     def action_make_label( self, request, queryset, label=None ):
         """
-        Action method for generating a PDF
+        Action method for generating a PDF. Large selections (more than
+        CONTACT_LABEL_ASYNC_LIMIT labels) are rendered in the background and a
+        download link is sent by email.
         """
+        count = queryset.count()
+
+        if count * label.repeat > getattr( settings, 'CONTACT_LABEL_ASYNC_LIMIT', 1000 ):
+            token = uuid.uuid4().hex
+            make_labels.delay( label.pk, list( queryset.values_list( 'pk', flat=True ) ), request.user.email, token )
+            self.message_user( request, 'Generating labels for %d contacts in the background, a download link will be sent to %s (progress: %s).' % (
+                count, request.user.email, reverse( 'admin:contacts_contact_label_progress', args=[token] ) ) )
+            return None
+
         return label.get_label_render().render_http_response( queryset, 'contact_labels.pdf' )
 
-    def action_export_xls(self, modeladmin, request, queryset):
+    def label_progress_view( self, request, token=None ):
+        """
+        Progress of labels rendered in the background
+        """
+        progress = cache.get( LABEL_PROGRESS_CACHE_KEY % token )
+        if progress is None:
+            raise Http404
+        if progress['filename']:
+            progress['url'] = reverse( 'admin:contacts_contact_export', args=[progress['filename']] )
+        return JsonResponse( progress )
+
+    def action_export( self, request, queryset, file_format='xls' ):
+        """
+        Action method for exporting contacts. CSV exports are streamed,
+        other large exports (more than CONTACT_EXPORT_ASYNC_LIMIT contacts)
+        are run in the background and a download link is sent by email.
+        """
+        pks = list( queryset.values_list( 'pk', flat=True ) )
+
+        if file_format == 'csv':
+            exporter = StreamingCSVExporter( header=Contact.get_export_header() )
+            response = StreamingHttpResponse( exporter.stream( Contact.export_data( pks ) ), content_type=exporter.mimetype )
+            response['Content-Disposition'] = 'attachment; filename=Contacts.%s' % exporter.extension
+            return response
+
+        exporter_class = get_exporter_class( file_format, len( pks ) )
+        if exporter_class.extension != file_format:
+            self.message_user( request, '%s files are limited to %d contacts, the %d contacts are exported to %s.' % (
+                file_format.upper(), EXPORTERS[file_format].max_rows, len( pks ), exporter_class.extension.upper() ), level=messages.WARNING )
+
+        if len( pks ) > getattr( settings, 'CONTACT_EXPORT_ASYNC_LIMIT', 5000 ):
+            export_contacts.delay( pks, exporter_class.extension, request.user.email )
+            self.message_user( request, 'Exporting %d contacts in the background, a download link will be sent to %s.' % ( len( pks ), request.user.email ) )
+            return None
         output = StringIO.StringIO()
+        Contact.export( pks, exporter_class( filename_or_stream=output, title='Contacts', header=Contact.get_export_header() ) )
 
-        title = 'Contacts'
-        fields = ('id', 'title', 'first_name', 'last_name', 'position',
-            'organisation', 'department', 'street_1', 'street_2', 'zip',
-            'city', 'country', 'region', 'tax_code', 'phone', 'website',
-            'social', 'email', 'language')
-        many2many_fields = ('groups', )
-
-        exporter = ExcelExporter(
-            filename_or_stream=output,
-            title=title,
-            header=[(field, None) for field in fields + many2many_fields]
-        )
+        response = HttpResponse( output.getvalue(), content_type=exporter_class.mimetype )
+        response['Content-Disposition'] = 'attachment; filename=Contacts.%s' % exporter_class.extension
+        return response
 
-        for c in queryset:
-            data = dict([
-                (field, getattr(c, field)) for field in fields
-            ])
-            for field in many2many_fields:
-                data[field] = ', '.join([
-                    unicode(value) for value in getattr(c, field).all()
-                ])
-            exporter.writedata(data)
+    def action_export_xls(self, modeladmin, request, queryset):
+        return self.action_export( request, queryset, file_format='xls' )
 
-        exporter.save()
+    def export_view( self, request, filename=None ):
+        """
+        Download an export generated in the background
+        """
+        filename = os.path.basename( filename )
+        if not export_fs.exists( filename ):
+            raise Http404
 
-        response = HttpResponse(output.getvalue(), content_type='application/vnd.ms-excel')
-        response['Content-Disposition'] = 'attachment; filename={}.xls'.format(title)
+        exporter_class = EXPORTERS.get( os.path.splitext( filename )[1][1:] )
+        if exporter_class:
+            content_type = exporter_class.mimetype
+        else:
+            content_type = mimetypes.guess_type( filename )[0] or 'application/octet-stream'
+        response = FileResponse( export_fs.open( filename, 'rb' ), content_type=content_type )
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
         return response
 
     def action_set_group( self, request, queryset, group=None, remove=False ):
         """
-        Action method for set/removing groups to contacts.
+        Action method for set/removing groups to contacts. The contacts are
+        added to or removed from the group at once, and the group's actions
+        are dispatched once for all the changed contacts.
         """
-        for obj in queryset:
-            contactgroup_change_check.apply_async(
-                (list(obj.groups.values_list('id', flat=True)), obj.pk, obj.email),
-                countdown=20,
-            )
+        if group is None:
+            return
+
+        members = group.contact_set.filter( pk__in=queryset.values( 'pk' ) ).values_list( 'pk', flat=True )
+        if remove:
+            changed = list( queryset.filter( pk__in=list( members ) ) )
+        else:
+            changed = list( queryset.exclude( pk__in=list( members ) ) )
+
+        if not changed:
+            return
+
+        with transaction.atomic():
             if remove:
-                obj.groups.remove( group )
+                group.contact_set.remove( *changed )
+                contacts_removed.send( sender=Contact, group=group, contacts=changed,
+                    emails=[obj.email for obj in changed] )
+                self.log_changes( request, changed, 'Removed from groups: %s' % group.name )
             else:
-                obj.groups.add( group )
+                group.contact_set.add( *changed )
+                contacts_added.send( sender=Contact, group=group, contacts=changed )
+                self.log_changes( request, changed, 'Added to groups: %s' % group.name )
+
+    def log_changes( self, request, objects, message ):
+        """
+        Add the same change message to the admin history of several objects
+        with a single query.
+        """
+        content_type = ContentType.objects.get_for_model( self.model )
+        LogEntry.objects.bulk_create( [LogEntry(
+            user_id=request.user.pk,
+            content_type_id=content_type.pk,
+            object_id=force_text( obj.pk ),
+            object_repr=force_text( obj )[:200],
+            action_flag=CHANGE,
+            change_message=message,
+        ) for obj in objects], batch_size=500 )
 
     def _make_label_action( self, label ):
         """
@@ -601,12 +684,24 @@ class ContactAdmin( AdminCommentMixin, admin.ModelAdmin ):
 
         return ( name, ( action, name, "%s group %s" % ("Unset" if remove else "Set", group.name) ) )
 
+    def _make_export_action( self, file_format ):
+        """
+        Helper method to define an admin action for an export format
+        """
+        name = 'export_%s' % file_format
+
+        def action(modeladmin, request, queryset):
+            return modeladmin.action_export( request, queryset, file_format=file_format )
+
+        return ( name, ( action, name, "Export selected contacts to %s" % file_format.upper() ) )
+
     def get_actions( self, request ):
         """
         Dynamically add admin actions for creating labels based on enabled labels.
         """
         actions = super( ContactAdmin, self ).get_actions( request )
         actions['export_xls'] = (self.action_export_xls, 'export_xls', 'Export selected contacts to XLS')
+        actions.update( OrderedDict( [self._make_export_action( f ) for f in sorted( EXPORTERS ) if f != 'xls'] ) )
         actions.update( OrderedDict( [self._make_label_action( l ) for l in Label.objects.filter( enabled=True ).order_by( 'name' )] ) )
         actions.update( OrderedDict( [self._make_group_action( g, remove=False ) for g in ContactGroup.objects.all().order_by( 'name' )] ) )
         actions.update( OrderedDict( [self._make_group_action( g, remove=True ) for g in ContactGroup.objects.all().order_by( 'name' )] ) )
@@ -628,11 +723,23 @@ class ContactGroupActionAdmin( admin.ModelAdmin ):
 
 
 class DeduplicationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'last_deduplication', )
-    exclude = ('last_deduplication', )
-    readonly_fields = ('status', 'duplicate_contacts', 'deduplicated_contacts', )
+    list_display = ('id', 'last_deduplication', 'progress', )
+    exclude = ('last_deduplication', 'run_started', 'checkpoint', 'processed_contacts', 'total_contacts', 'run_token',
+        'heartbeat', 'run_resumed', 'resumed_contacts', )
+    readonly_fields = ('status', 'last_completed_run', 'progress', )
     filter_horizontal = ('groups', )
 
+    def progress(self, obj):
+        if obj.status != 'processing' or obj.checkpoint is None:
+            return '-'
+        progress = '%d / %d contacts' % (obj.processed_contacts, obj.total_contacts)
+        eta = obj.estimated_completion()
+        if eta:
+            progress += ', ETA %s' % eta.strftime('%Y-%m-%d %H:%M')
+        return progress
+
+    progress.short_description = 'Progress'
+
     def get_urls(self):
         urls = super(DeduplicationAdmin, self).get_urls()
         extra_urls = [
@@ -649,8 +756,9 @@ class DeduplicationAdmin(admin.ModelAdmin):
 
         dedup = get_object_or_404(Deduplication, pk=pk)
 
-        # Run the deduplication in the background
-        if dedup.status != 'processing':
+        # Run the deduplication in the background, or resume it if its task
+        # was lost
+        if dedup.status != 'processing' or dedup.is_stalled():
             dedup.status = 'processing'
             dedup.last_deduplication = datetime.now()
             dedup.save()
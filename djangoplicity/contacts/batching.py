@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-contacts
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Batching of the actions executed when contacts are added to or removed from
+groups.
+
+Outside a batch each contact_added/contact_removed action is dispatched for
+each contact. Inside a batch the dispatches are buffered and, once the batch
+ends, sent once per (group, action, event)::
+
+    >>> with batch_dispatch():
+    ...     for contact in contacts:
+    ...         contact.groups.add( group )
+    ...         contact_added.send( sender=Contact, group=group, contact=contact )
+
+Action plugins which define ``supports_batch = True`` receive the list of
+contacts in one call (``contacts``, and ``emails`` for removals), the other
+plugins are dispatched for each contact as before.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import threading
+
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+@contextmanager
+def batch_dispatch():
+    """
+    Buffer the action dispatches until the end of the block. Nested batches
+    are merged in the outermost one. Nothing is dispatched if the block
+    raises an exception.
+    """
+    if getattr( _local, 'batch', None ) is not None:
+        yield
+        return
+
+    _local.batch = OrderedDict()
+    try:
+        yield
+        batch = _local.batch
+    finally:
+        _local.batch = None
+
+    for ( dummy, dummy, on_event ), ( action, group, contacts, emails ) in batch.items():
+        dispatch_batch( action, on_event, group, contacts, emails )
+
+
+def supports_batch( action ):
+    """
+    Check if the plugin of the action accepts a list of contacts.
+    """
+    try:
+        return getattr( import_string( action.plugin ), 'supports_batch', False )
+    except ImportError:
+        return False
+
+
+def dispatch( action, on_event, group, contact, email=None ):
+    """
+    Dispatch an action for a contact, or buffer it if in a batch.
+    """
+    batch = getattr( _local, 'batch', None )
+    if batch is None:
+        dispatch_batch( action, on_event, group, [contact], [email] )
+        return
+
+    key = ( group.pk, action.pk, on_event )
+    if key not in batch:
+        batch[key] = ( action, group, [], [] )
+    batch[key][2].append( contact )
+    batch[key][3].append( email )
+
+
+def dispatch_batch( action, on_event, group, contacts, emails=None ):
+    """
+    Dispatch an action for a list of contacts, in one call if the action
+    supports it.
+    """
+    removed = on_event == 'contact_removed'
+    if emails is None:
+        emails = [c.email if c else None for c in contacts]
+
+    if len( contacts ) > 1 and supports_batch( action ):
+        logger.debug( "Dispatching %s for %d contacts in group %s", on_event, len( contacts ), group.pk )
+        if removed:
+            action.dispatch( group=group, contacts=contacts, emails=emails )
+        else:
+            action.dispatch( group=group, contacts=contacts )
+        return
+
+    for contact, email in zip( contacts, emails ):
+        if removed:
+            action.dispatch( group=group, contact=contact, email=email )
+        else:
+            action.dispatch( group=group, contact=contact )
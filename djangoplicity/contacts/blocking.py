@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-contacts
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+
+"""
+Candidate generation for the contact deduplication.
+
+Comparing a contact against the whole search space with
+``deduplication.similar`` is quadratic in the number of contacts. The
+blocking index groups the search space by cheap keys, so that only
+contacts sharing at least one key ("block") with a contact are scored.
+
+Usage::
+    index = BlockingIndex( search_space )
+    find_duplicates( data, search_space, index=index )
+
+Keys used for blocking:
+    * normalised email addresses,
+    * domain + prefix and domain + suffix of the email local part, and
+      local part + prefix of the domain, as similar emails (e.g.
+      jon@doe.org and john@doe.org) count as a match,
+    * phonetic key (Soundex) of the last name,
+    * prefix of the last name,
+    * phonetic key of the first name for contacts without a last name,
+    * country + city and organisation prefix for contacts without a name
+      (i.e. organisations, which are matched on their address).
+
+A pair of contacts not sharing any key is not scored at all. Emails with a
+typo at the start of the domain, or with several typos in a short local
+part, only share a block if the contacts share a name key. Set
+``CONTACT_DEDUPLICATION_BLOCKING = False`` in the settings to fall
+back to the exhaustive scan of the search space.
+
+Most duplicates share an exact key: the same email address, or the same
+last name, first name and country. The ``ExactKeyIndex`` finds those pairs
+in one dict pass over the search space, they are given their score
+directly and are not compared with ``similar`` at all::
+
+    find_duplicates( data, search_space, index=index, exact=ExactKeyIndex( search_space ) )
+"""
+
+from __future__ import unicode_literals
+
+from collections import defaultdict
+import unicodedata
+
+from django.conf import settings
+
+from djangoplicity.contacts.deduplication import _entry, _prepare_str
+
+LAST_NAME_PREFIX = 3
+EMAIL_AFFIX = 2
+DOMAIN_PREFIX = 4
+ORGANISATION_PREFIX = 4
+
+# Scores of the exact keys, the same as similar() gives for an identical
+# email, and for an identical name in the same country
+EXACT_EMAIL_SCORE = 0.8
+EXACT_NAME_SCORE = 0.9
+
+SOUNDEX_CODES = {}
+for _letters, _code in ( ( 'bfpv', '1' ), ( 'cgjkqsxz', '2' ), ( 'dt', '3' ),
+        ( 'l', '4' ), ( 'mn', '5' ), ( 'r', '6' ) ):
+    for _l in _letters:
+        SOUNDEX_CODES[_l] = _code
+
+
+def _ascii( s ):
+    """
+    Strip accents from a (normalised) string, e.g. müller -> muller
+    """
+    if not isinstance( s, unicode ):
+        s = unicode( s )
+    s = unicodedata.normalize( 'NFKD', s )
+    return ''.join( [c for c in s if not unicodedata.combining( c )] )
+
+
+def soundex( name ):
+    """
+    Return the Soundex key of a name, e.g. robert -> r163. Names not
+    starting with a latin letter are returned unchanged.
+    """
+    letters = [c for c in _ascii( name ).lower() if c.isalpha()]
+    if not letters or not 'a' <= letters[0] <= 'z':
+        return name
+
+    key = letters[0]
+    last = SOUNDEX_CODES.get( letters[0] )
+    for c in letters[1:]:
+        code = SOUNDEX_CODES.get( c )
+        if code and code != last:
+            key += code
+            if len( key ) == 4:
+                break
+        if c not in 'hw':
+            last = code
+
+    return ( key + '000' )[:4]
+
+
+def blocking_keys( data ):
+    """
+    Return the set of blocking keys for a contact dictionary or SearchEntry.
+    """
+    entry = _entry( data )
+    keys = set()
+
+    for email in entry.query_emails:
+        email = _prepare_str( email )
+        keys.add( 'e:%s' % email )
+
+        # A typo in the local part keeps either its start or its end
+        local, dummy, domain = email.rpartition( '@' )
+        if local:
+            keys.add( 'ep:%s:%s' % ( domain, local[:EMAIL_AFFIX] ) )
+            keys.add( 'es:%s:%s' % ( domain, local[-EMAIL_AFFIX:] ) )
+            keys.add( 'ed:%s:%s' % ( local, domain[:DOMAIN_PREFIX] ) )
+
+    if entry.last_name:
+        keys.add( 's:%s' % soundex( entry.last_name ) )
+        keys.add( 'p:%s' % entry.last_name[:LAST_NAME_PREFIX] )
+    elif entry.first_name:
+        keys.add( 'f:%s' % soundex( entry.first_name ) )
+
+    if not entry.first_name and not entry.last_name:
+        if entry.city:
+            keys.add( 'c:%s:%s' % ( entry.country or '', _prepare_str( entry.city ) ) )
+        if entry.organisation:
+            keys.add( 'o:%s' % entry.organisation[:ORGANISATION_PREFIX] )
+
+    return keys
+
+
+def exact_keys( data ):
+    """
+    Return the exact keys for a contact dictionary or SearchEntry, as a
+    dictionary of key: score.
+    """
+    entry = _entry( data )
+    keys = {}
+
+    for email in entry.query_emails:
+        keys['e:%s' % _prepare_str( email )] = EXACT_EMAIL_SCORE
+
+    if entry.last_name and entry.first_name and entry.country:
+        keys['n:%s:%s:%s' % ( entry.last_name, entry.first_name, entry.country )] = EXACT_NAME_SCORE
+
+    return keys
+
+
+class BlockingIndex( object ):
+    """
+    Index of a search space by blocking keys.
+    """
+    def __init__( self, search_space=None ):
+        self._blocks = defaultdict( list )
+        if search_space:
+            for pk, data in search_space.items():
+                self.add( pk, data )
+
+    def add( self, pk, data ):
+        """
+        Add a contact from the search space to the index.
+        """
+        for key in blocking_keys( data ):
+            self._blocks[key].append( pk )
+
+    def candidates( self, data ):
+        """
+        Return the set of primary keys sharing at least one block with data.
+        """
+        pks = set()
+        for key in blocking_keys( data ):
+            pks.update( self._blocks.get( key, () ) )
+        return pks
+
+
+class ExactKeyIndex( object ):
+    """
+    Index of a search space by exact keys (see exact_keys).
+    """
+    def __init__( self, search_space=None ):
+        self._keys = defaultdict( list )
+        if search_space:
+            for pk, data in search_space.items():
+                self.add( pk, data )
+
+    def add( self, pk, data ):
+        """
+        Add a contact from the search space to the index.
+        """
+        for key in exact_keys( data ):
+            self._keys[key].append( pk )
+
+    def matches( self, data ):
+        """
+        Return a dictionary of pk: score of the contacts sharing at least one
+        exact key with data, the score is the sum of the shared keys' scores.
+        """
+        scores = defaultdict( float )
+        for key, score in exact_keys( data ).items():
+            for pk in self._keys.get( key, () ):
+                scores[pk] += score
+        return dict( scores )
+
+
+def search_space_index( search_space ):
+    """
+    Build the blocking index for a search space, or return None if the
+    exhaustive scan has been configured.
+    """
+    if not getattr( settings, 'CONTACT_DEDUPLICATION_BLOCKING', True ):
+        return None
+    return BlockingIndex( search_space )
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-contacts
+# Copyright (c) 2007-2015, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+
+"""
+Two-tier caching of values computed from the database (e.g. the extra
+field definitions), shared between processes through Django's cache.
+
+Each process keeps a local copy of the value, which is used as long as the
+version stored under a small separate key in Django's cache is unchanged.
+Clearing the cache sets a new version, so every process reloads the value
+on its next access without a restart. Without a shared cache (e.g. with
+DummyCache) there is no version, and the value is loaded on every access::
+
+    >>> fields_cache = VersionedCache( 'djangoplicity.contacts.fields', lambda: list( Field.objects.values_list( 'slug', 'name' ) ) )
+    >>> fields_cache.get()
+    [('company-email', 'Company Email')]
+    >>> fields_cache.clear()
+"""
+
+import threading
+import uuid
+
+from django.core.cache import cache
+
+
+class VersionedCache( object ):
+    """
+    Value loaded with ``loader`` and cached under ``key`` in Django's cache
+    and in the process, validated against a version stored under
+    ``<key>.version``.
+    """
+    def __init__( self, key, loader, timeout=None ):
+        self.key = key
+        self.version_key = '%s.version' % key
+        self.loader = loader
+        self.timeout = timeout
+        self._local = None
+        self._lock = threading.Lock()
+
+    def _new_version( self ):
+        # Random versions ensure that a version lost by the cache is never
+        # reused.
+        return uuid.uuid4().hex
+
+    def version( self ):
+        """
+        Get the current version, creating one if needed.
+        """
+        version = cache.get( self.version_key )
+        if version is None:
+            cache.add( self.version_key, self._new_version(), None )
+            version = cache.get( self.version_key )
+        return version
+
+    def get( self ):
+        """
+        Get the value, from the local copy if it is still valid, otherwise
+        from Django's cache or the loader.
+        """
+        version = self.version()
+        if version is None:
+            # No shared cache, so a local copy could never be invalidated
+            self._local = None
+            return self.loader()
+
+        local = self._local
+        if local is not None and local[0] == version:
+            return local[1]
+
+        with self._lock:
+            shared = cache.get( self.key )
+            if shared is not None and shared[0] == version:
+                value = shared[1]
+            else:
+                value = self.loader()
+                cache.set( self.key, ( version, value ), self.timeout )
+            self._local = ( version, value )
+
+        return value
+
+    def clear( self ):
+        """
+        Invalidate the value in all processes.
+        """
+        cache.set( self.version_key, self._new_version(), None )
+        self._local = None
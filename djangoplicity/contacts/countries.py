@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-contacts
+# Copyright (c) 2007-2011, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+#
+
+"""
+Resolution of country values (ISO codes, names or misspelled names) found
+in imported data or passed to Contact.update_object to countries, and of
+region values to regions.
+
+Exact ISO codes and names are resolved with dictionaries. Other values are
+matched in a fuzzy way against the country names and ``ISO_EXPANSION``,
+using a bigram index to only compare the value with the names sharing at
+least one bigram with it. Resolved values, including values which don't
+match any country, are kept in a bounded LRU cache as the same values tend
+to be repeated across all rows of an import.
+
+The countries and regions are shared between processes with a
+``VersionedCache``: clearing a resolver (on Country or Region changes)
+reloads them, and drops the resolved values, in all processes. Checking the
+version costs a cache request per call, so loops over many values (e.g. the
+rows of an import) use a snapshot of the resolver instead, which keeps the
+data of the time it was taken::
+
+    >>> from djangoplicity.contacts.countries import country_resolver
+    >>> country_resolver.resolve( 'Deutchland' )
+    7
+    >>> countries = country_resolver.snapshot()
+    >>> [countries.resolve( v ) for v in ( 'DE', 'Germany' )]
+    [7, 7]
+
+Regions are resolved from an in-memory index per country, by code or by
+prefix of their name or local name::
+
+    >>> from djangoplicity.contacts.countries import region_resolver
+    >>> region_resolver.resolve( 'Schleswig', 7 )
+    544
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+import difflib
+import threading
+
+from django.conf import settings
+
+from djangoplicity.contacts.caching import VersionedCache
+
+_MISSING = object()
+
+
+def _bigrams( value ):
+    return set( [value[i:i + 2] for i in range( len( value ) - 1 )] )
+
+
+class CountryResolver( object ):
+    """
+    Resolve country values to country primary keys. The data is loaded
+    on first use and must be reloaded with clear() when countries change.
+    """
+    def __init__( self, maxsize=None, ratio_limit=0.90, key='djangoplicity.contacts.countries' ):
+        self.maxsize = maxsize if maxsize is not None else getattr( settings, 'CONTACT_COUNTRY_CACHE_SIZE', 1024 )
+        self.ratio_limit = ratio_limit
+        self._lock = threading.RLock()
+        self._data = VersionedCache( key, self._load_data )
+        self._loaded = None
+        self._cache = OrderedDict()
+
+    def clear( self ):
+        """
+        Empty the cache, the countries will be loaded again in all processes.
+        """
+        if self._data is not None:
+            self._data.clear()
+
+    def snapshot( self ):
+        """
+        Return a resolver using the current countries, which doesn't check
+        if they changed since.
+        """
+        with self._lock:
+            self._load()
+            resolver = CountryResolver( self.maxsize, self.ratio_limit )
+            resolver._data = None
+            resolver._set( self._loaded )
+            resolver._cache = OrderedDict( self._cache )
+            return resolver
+
+    def _load_data( self ):
+        from djangoplicity.contacts.models import Country, ISO_EXPANSION
+
+        countries = {}
+        iso = {}
+        names = {}
+        for c in Country.objects.all():
+            countries[c.pk] = c
+            iso[c.iso_code.lower()] = c.pk
+            names[c.name.lower()] = c.pk
+
+        # Fuzzy candidates: country names first, then the expansions
+        candidates = [( name, pk, 0 ) for name, pk in names.items()]
+        for code, expansions in ISO_EXPANSION.items():
+            if code.lower() in iso:
+                candidates += [( e, iso[code.lower()], 1 ) for e in expansions]
+
+        index = {}
+        for i, ( text, dummy, dummy ) in enumerate( candidates ):
+            for bigram in _bigrams( text ):
+                index.setdefault( bigram, [] ).append( i )
+
+        return ( countries, iso, names, candidates, index )
+
+    def _load( self ):
+        """
+        Get the current data, the resolved values are dropped if it changed.
+        """
+        if self._data is None:
+            return
+
+        data = self._data.get()
+        if data is not self._loaded:
+            self._set( data )
+
+    def _set( self, data ):
+        self._loaded = data
+        self._cache = OrderedDict()
+        self._countries, self._iso, self._names, self._candidates, self._index = data
+
+    def get( self, pk ):
+        """
+        Return the Country object for a primary key.
+        """
+        from djangoplicity.contacts.models import Country
+
+        with self._lock:
+            self._load()
+            try:
+                return self._countries[pk]
+            except KeyError:
+                raise Country.DoesNotExist( "Country %s does not exist." % pk )
+
+    def exact( self, value ):
+        """
+        Return the primary key of the country with the given ISO code (for
+        two letters values) or name, or None.
+        """
+        with self._lock:
+            self._load()
+            value = value.lower().strip()
+            if len( value ) == 2:
+                return self._iso.get( value )
+            return self._names.get( value )
+
+    def resolve( self, value ):
+        """
+        Return the primary key of the country matching the value, or None.
+        """
+        if not isinstance( value, unicode ):
+            value = unicode( value )
+        value = value.lower().strip()
+
+        with self._lock:
+            self._load()
+            pk = self._cache.pop( value, _MISSING )
+            if pk is _MISSING:
+                pk = self._resolve( value )
+                if len( self._cache ) >= self.maxsize:
+                    self._cache.popitem( last=False )
+            self._cache[value] = pk
+            return pk
+
+    def _resolve( self, value ):
+        if len( value ) == 2 and value in self._iso:
+            return self._iso[value]
+        elif value in self._names:
+            return self._names[value]
+
+        # Only strings sharing a bigram can have a ratio above the limit
+        ids = set()
+        for bigram in _bigrams( value ):
+            ids.update( self._index.get( bigram, [] ) )
+
+        best = None
+        for i in ids:
+            text, pk, priority = self._candidates[i]
+            ratio = difflib.SequenceMatcher( a=text, b=value ).ratio()
+            if ratio > self.ratio_limit and ( best is None or ( -priority, ratio ) > best[0] ):
+                best = ( ( -priority, ratio ), pk )
+
+        return best[1] if best else None
+
+
+country_resolver = CountryResolver()
+
+
+class RegionResolver( object ):
+    """
+    Resolve region values to region primary keys, without database queries
+    once the regions are loaded. The data is loaded on first use and must be
+    reloaded with clear() when regions change.
+    """
+    def __init__( self, key='djangoplicity.contacts.regions' ):
+        self._lock = threading.RLock()
+        self._data = VersionedCache( key, self._load_data )
+        self._regions = None
+        self._indexes = {}
+
+    def clear( self ):
+        """
+        Empty the cache, the regions will be loaded again in all processes.
+        """
+        if self._data is not None:
+            self._data.clear()
+
+    def snapshot( self ):
+        """
+        Return a resolver using the current regions, which doesn't check if
+        they changed since.
+        """
+        with self._lock:
+            self._load()
+            resolver = RegionResolver()
+            resolver._data = None
+            resolver._regions = self._regions
+            resolver._indexes = dict( self._indexes )
+            return resolver
+
+    def _load( self ):
+        """
+        Get the current regions, the indexes are dropped if they changed.
+        """
+        if self._data is None:
+            return
+
+        regions = self._data.get()
+        if regions is not self._regions:
+            self._regions = regions
+            self._indexes = {}
+
+    def _load_data( self ):
+        from djangoplicity.contacts.models import Region
+
+        # Same order as Region.Meta.ordering
+        return list( Region.objects.order_by( 'country__name', 'name', 'pk' ).values_list(
+            'pk', 'country_id', 'code', 'name', 'local_name' ) )
+
+    def _index( self, country_id ):
+        """
+        Return the index for a country (or all regions if country_id is
+        None): a dictionary of codes, and a list of names and local names
+        with their rank in the Region ordering, sorted for prefix search.
+        """
+        if country_id not in self._indexes:
+            codes = {}
+            names = []
+            for rank, ( pk, c_id, code, name, local_name ) in enumerate( self._regions ):
+                if country_id and c_id != country_id:
+                    continue
+                codes.setdefault( code.lower(), pk )
+                names.append( ( name.lower(), rank, pk ) )
+                names.append( ( local_name.lower(), rank, pk ) )
+            names.sort()
+            self._indexes[country_id] = ( codes, names, [n[0] for n in names] )
+
+        return self._indexes[country_id]
+
+    def resolve( self, value, country_id=None ):
+        """
+        Return the primary key of the region with the given code or else
+        the first region (in Region ordering) whose name or local name
+        starts with value, or None. The regions are limited to the given
+        country if any.
+        """
+        if not value:
+            return None
+        if not isinstance( value, unicode ):
+            value = unicode( value )
+        value = value.lower()
+
+        with self._lock:
+            self._load()
+            codes, names, keys = self._index( country_id or None )
+
+            if value in codes:
+                return codes[value]
+
+            best = None
+            i = bisect_left( keys, value )
+            while i < len( keys ) and keys[i].startswith( value ):
+                if best is None or names[i][1] < best[0]:
+                    best = ( names[i][1], names[i][2] )
+                i += 1
+
+            return best[1] if best else None
+
+
+region_resolver = RegionResolver()
@@ -36,6 +36,7 @@ Module to help find contact duplicates.
 
 Usage::
     find_duplicates( data, search_space )
+    find_duplicates( data, search_space, index=BlockingIndex( search_space ) )
 
 ``data'' is a dictionary with the following keys:
     * ``name'' - full name including civil titles like Dr., Mr., Ms. etc.
@@ -44,16 +45,25 @@ Usage::
     * ``zip''
     * ``country'' - country iso code (upper case)
 
-``search_space'' is a list of dictionaries like data. The dictionary can be created from
-contacts_search_space for all contacts in the contact database.
+``search_space'' is a dictionary of dictionaries like data (or SearchEntry) indexed by
+contact id. The compact search space of SearchEntry for all contacts in the contact
+database is created by contacts_search_space.
 
 
 
 
 """
-import difflib
+import heapq
 import re
 
+try:
+    # billiard (used by celery) allows to start a pool from a worker process
+    from billiard import Pool
+except ImportError:
+    from multiprocessing import Pool
+
+from djangoplicity.contacts.similarity import ratio
+
 #
 # Variables defining tokens/characters for splitting a name in title and name.
 #
@@ -65,6 +75,8 @@ WHITESPACE = [" ", "\n", "\r", "\t", ""]
 
 PUNCTUATION = [".", "-"]
 
+EMAIL_FIELDS = ['email', 'second_email', 'third_email']
+
 ORG_INDICATORS = [
 u'earth',
 u'institut',
@@ -250,16 +262,27 @@ splitter = re.compile(r"(\s+|\.|\-)")
 # Functions
 #
 
+SEARCH_SPACE_FIELDS = ['first_name', 'last_name', 'email', 'organisation', 'department',
+        'street_1', 'street_2', 'city', 'country']
+
+
 def contacts_search_space():
     """
     Create a search space from all contacts in the database.
+
+    The search space is a dictionary of SearchEntry indexed by contact id. Only
+    the fields needed for the comparison are loaded, and they are normalised
+    once here instead of for each comparison.
     """
     from djangoplicity.contacts.models import Contact
 
     search_space = {}
-    for c in Contact.objects.all().select_related( 'country' ):
-        #search_space.append( c.get_data() )
-        search_space[c.id] = c.get_data()
+    columns = ['pk'] + SEARCH_SPACE_FIELDS[:-1] + ['country_id']
+    for row in Contact.objects.order_by().values_list( *columns ).iterator():
+        # Same values as Contact.get_data()
+        data = dict( zip( SEARCH_SPACE_FIELDS[:-1], [x.strip() for x in row[1:-1]] ) )
+        data['country'] = row[-1] or ''
+        search_space[row[0]] = SearchEntry( data, pk=row[0] )
 
     return search_space
 
@@ -383,13 +406,65 @@ def _prepare_str(s):
     return re.sub(r'\s+', ' ', s)
 
 
+class SearchEntry( object ):
+    """
+    Compact representation of a contact dictionary, holding only the
+    normalised values used by similar().
+    """
+    __slots__ = ( 'pk', 'first_name', 'last_name', 'has_name', 'emails', 'query_emails',
+        'country', 'city', 'organisation', 'department', 'street_mask', 'addresses' )
+
+    def __init__( self, data, pk=None ):
+        self.pk = pk
+        self.first_name = _prepare_str( data['first_name'] ) if 'first_name' in data else ''
+        self.last_name = _prepare_str( data['last_name'] ) if 'last_name' in data else ''
+        self.has_name = bool( data.get( 'first_name' ) or data.get( 'last_name' ) )
+
+        # All emails are compared to the non-blank emails of the other contact
+        self.emails = tuple( [data[f].lower() for f in EMAIL_FIELDS if f in data] )
+        self.query_emails = tuple( [e for e in self.emails if e.strip() != ''] )
+
+        self.country = data.get( 'country' )
+        # City is only compared if both contacts have a country (see similar())
+        if data.get( 'city' ) and 'country' in data:
+            self.city = _preprocess_city( data['city'], data['country'] ).lower()
+        else:
+            self.city = None
+        self.organisation = _prepare_str( data['organisation'] ) if data.get( 'organisation' ) else None
+        self.department = _prepare_str( data['department'] ) if data.get( 'department' ) else None
+
+        # The address of a contact is compared using only the street fields
+        # present in the other contact, hence the address is prepared for
+        # each combination of street fields (bit 1: street_1, bit 2: street_2)
+        self.street_mask = ( 1 if 'street_1' in data else 0 ) | ( 2 if 'street_2' in data else 0 )
+        streets = [
+            unicode( data['street_1'] ) if self.street_mask & 1 else '',
+            unicode( data['street_2'] ) if self.street_mask & 2 else '',
+        ]
+        self.addresses = (
+            '',
+            _prepare_str( streets[0] ),
+            _prepare_str( streets[1] ),
+            _prepare_str( streets[0] + streets[1] ),
+        )
+
+    def __repr__( self ):
+        return '<SearchEntry %s: %s %s>' % ( self.pk, self.first_name, self.last_name )
+
+
+def _entry( data ):
+    """
+    Return data as a SearchEntry
+    """
+    return data if isinstance( data, SearchEntry ) else SearchEntry( data )
+
+
 def similar_text( a, b, ratio_limit=0.90 ):
     """
     Determine if two names are similar. Note, two
     empty names are not similar.
     """
-    seq = difflib.SequenceMatcher( a=a.lower(), b=b.lower() )
-    return seq.ratio() > ratio_limit
+    return ratio( a.lower(), b.lower(), ratio_limit ) > ratio_limit
 
 
 def similar_name(a, b, ratio_limit=0.8):
@@ -397,37 +472,37 @@ def similar_name(a, b, ratio_limit=0.8):
     Compare first name and last name, returns 0.8 if both match,
     0.5 if only last name, 0.1 if only first name
     """
-    a_first = _prepare_str(a['first_name']) if 'first_name' in a else ''
-    b_first = _prepare_str(b['first_name']) if 'first_name' in b else ''
-    a_last = _prepare_str(a['last_name']) if 'last_name' in a else ''
-    b_last = _prepare_str(b['last_name']) if 'last_name' in b else ''
+    a = _entry(a)
+    b = _entry(b)
+    a_first = a.first_name
+    b_first = b.first_name
+    a_last = a.last_name
+    b_last = b.last_name
 
     # Compare first and last name if we have all the information
     if a_first and b_first and a_last and a_last:
-        seq = difflib.SequenceMatcher(None,
-                a_first + a_last, b_first + b_last)
-        if seq.ratio() >= ratio_limit:
-            return 0.8 * seq.ratio()
+        r = ratio(a_first + a_last, b_first + b_last, ratio_limit)
+        if r >= ratio_limit:
+            return 0.8 * r
 
         # Look for first name initials (e.g.: "S.":
         if len(a_first) == 2 and a_first[1] == '.' and a_first[0] == b_first[0]:
             b_first = b_first[0] + '.'
-            seq = difflib.SequenceMatcher(None,
-                    a_first + a_last, b_first + b_last)
-            if seq.ratio() >= ratio_limit:
-                return 0.75 * seq.ratio()
+            r = ratio(a_first + a_last, b_first + b_last, ratio_limit)
+            if r >= ratio_limit:
+                return 0.75 * r
 
     # Compare last names
     if a_last and b_last:
-        seq = difflib.SequenceMatcher(None, a_last, b_last)
-        if seq.ratio() > ratio_limit:
-            return 0.4 * seq.ratio()
+        r = ratio(a_last, b_last, ratio_limit)
+        if r > ratio_limit:
+            return 0.4 * r
 
     # Compare first names
     if a_first and b_first:
-        seq = difflib.SequenceMatcher(None, a_first, b_first)
-        if seq.ratio() > ratio_limit:
-            return 0.1 * seq.ratio()
+        r = ratio(a_first, b_first, ratio_limit)
+        if r > ratio_limit:
+            return 0.1 * r
 
     return 0
 
@@ -436,60 +511,71 @@ def similar_address(a, b, no_name, ratio_limit=0.8):
     '''
     Compare two addresses
     '''
-    address_a = ''
-    address_b = ''
-    if 'street_1' in a:
-        address_a += unicode(a['street_1'])
-        if 'street_1' in b:
-            address_b += unicode(b['street_1'])
-    if 'street_2' in a:
-        address_a += unicode(a['street_2'])
-        if 'street_2' in b:
-            address_b += unicode(b['street_2'])
-
-    address_a = _prepare_str(address_a)
-    address_b = _prepare_str(address_b)
+    a = _entry(a)
+    b = _entry(b)
+    # Only the street fields of b which are also in a are compared
+    address_a = a.addresses[a.street_mask]
+    address_b = b.addresses[a.street_mask]
 
     if address_a and address_b:
-        seq = difflib.SequenceMatcher(None, address_a, address_b)
-        if seq.ratio() > ratio_limit:
+        r = ratio(address_a, address_b, ratio_limit)
+        if r > ratio_limit:
             if no_name:
-                return 0.4 * seq.ratio()
+                return 0.4 * r
             else:
-                return 0.2 * seq.ratio()
+                return 0.2 * r
 
     return 0
 
 
-def similar(a, b):
-    # Compares two contacts' dictonaries and return a value
+def similar(a, b, limit=None):
+    # Compares two contacts' dictonaries (or SearchEntry) and return a value
     # The higher the value the more similar the contacts
+    #
+    # If limit is given, the comparison stops as soon as the remaining
+    # components cannot lift the value above limit, and the value so far
+    # (which is at most limit) is returned. The components are still added
+    # in the same order, so a complete comparison gives the same value.
+    a = _entry(a)
+    b = _entry(b)
+
+    # If we have neither first_name nor last_name we change the
+    # algorithm to increase the weight of similar addresses as this
+    # helps detecting duplicate organisation
+    no_name = not (a.has_name or b.has_name)
+
+    # Cheap checks first: the country is compared for equality only, and
+    # for the fuzzy components the maximum value is known from the fields
+    # present in both contacts.
+    if a.country and b.country and a.country == b.country:
+        country = 0.2 if no_name else 0.1
+    else:
+        country = 0
+    max_name = 0.8 if (a.first_name and b.first_name) or (a.last_name and b.last_name) else 0
+    max_email = 0.8 * len(a.query_emails) * len([e for e in b.emails if e])
+    max_city = (0.2 if no_name else 0.1) if a.city and b.city else 0
+    max_organisation = (0.4 if no_name else 0.2) if a.organisation is not None and b.organisation is not None else 0
+    max_department = 0.2 if a.department is not None and b.department is not None else 0
+    max_address = (0.4 if no_name else 0.2) if a.addresses[a.street_mask] and b.addresses[a.street_mask] else 0
+    remaining = country + max_city + max_organisation + max_department + max_address
+
+    if limit is None:
+        limit = -1
+    if max_name + max_email + remaining <= limit:
+        return 0
 
     # Name
     r = similar_name(a, b)
+    if r + max_email + remaining <= limit:
+        return r
 
     # Email, compares basic email fields as well as potential
     # optional fields defined as Field
-    emails = ['email', 'second_email', 'third_email']
-    for email_a in emails:
-        if email_a not in a or a[email_a].strip() == '':
-            continue
-        for email_b in emails or b[email_b].strip() == '':
-            if email_b not in b:
-                continue
-            if similar_text(a[email_a], b[email_b],
-                            ratio_limit=0.95):
+    for email_a in a.query_emails:
+        for email_b in b.emails:
+            if similar_text(email_a, email_b, ratio_limit=0.95):
                 r += 0.8
 
-    # If we have neither first_name nor last_name we change the
-    # algorithm to increase the weight of similar addresses as this
-    # helps detecting duplicate organisation
-    no_name = True
-    for field in ('first_name', 'last_name'):
-        for contact in (a, b):
-            if field in contact and contact[field]:
-                no_name = False
-
     # Two people with same address (e.g.: same institute) will always
     # be matched as duplicates, so if neither the name or email have
     # at least some similarities we don't compare the addresses, unless
@@ -497,52 +583,36 @@ def similar(a, b):
     # is probably an institute or organisation):
     if not no_name and r < 0.15:
         return r
+    if r + remaining <= limit:
+        return r
 
     # Country
-    try:
-        if a['country'] and b['country'] and \
-                a['country'] == b['country']:
-            if no_name:
-                r += 0.2
-            else:
-                r += 0.1
-    except KeyError:
-        pass
+    r += country
+    remaining -= country
 
     # City
-    try:
-        if a['city'] and b['city'] and \
-                similar_text(_preprocess_city(a['city'], a['country']),
-                        _preprocess_city( b['city'], b['country'] ), ratio_limit=0.85):
-            if no_name:
-                r += 0.2
-            else:
-                r += 0.1
-    except KeyError:
-        pass
+    if max_city:
+        if similar_text(a.city, b.city, ratio_limit=0.85):
+            r += max_city
+        remaining -= max_city
+        if r + remaining <= limit:
+            return r
 
     # Organisation
-    try:
-        if a['organisation'] and b['organisation']:
-            organisation_a = _prepare_str(a['organisation'])
-            organisation_b = _prepare_str(b['organisation'])
-            if similar_text(organisation_a, organisation_b):
-                if no_name:
-                    r += 0.4
-                else:
-                    r += 0.2
-    except KeyError:
-        pass
+    if max_organisation:
+        if similar_text(a.organisation, b.organisation):
+            r += max_organisation
+        remaining -= max_organisation
+        if r + remaining <= limit:
+            return r
 
     # Department
-    try:
-        if a['department'] and b['department']:
-            department_a = _prepare_str(a['department'])
-            department_b = _prepare_str(b['department'])
-            if similar_text(department_a, department_b):
-                r += 0.2
-    except KeyError:
-        pass
+    if max_department:
+        if similar_text(a.department, b.department):
+            r += max_department
+        remaining -= max_department
+        if r + remaining <= limit:
+            return r
 
     # Address
     r += similar_address(a, b, no_name)
@@ -550,18 +620,137 @@ def similar(a, b):
     return r
 
 
-def find_duplicates( obj, search_space, ratio_limit=0.75 ):
+def find_duplicates( obj, search_space, ratio_limit=0.75, index=None, exclude=None, top_k=None, min_score=None,
+        exact=None ):
     """
     Return a list of possible duplicates of obj in the search space
+
+    The search space values can be contact dictionaries or SearchEntry
+    (see contacts_search_space), the returned list contains tuples of
+    (ratio, search space value).
+
+    If a blocking index (see djangoplicity.contacts.blocking) is given,
+    only the candidates sharing a block with obj are compared, otherwise
+    the whole search space is scanned. Search space values for which
+    exclude( value ) is true are skipped.
+
+    If an exact key index (see blocking.ExactKeyIndex) is given, the
+    candidates sharing an exact key with obj get the score of the shared
+    keys as ratio, only the other candidates are compared with similar().
+
+    Only the duplicates with a ratio of at least min_score are returned,
+    and if top_k is given only the top_k best ones (kept in a heap, the
+    limit passed to similar() is raised as soon as it is full).
     """
+    # Heap of ( ratio, n, search space value ), n is the position of the
+    # candidate: for equal ratios the later candidates come first.
     dups = []
+    if top_k is not None and top_k < 1:
+        return dups
+    obj = _entry( obj )
+
+    limit = ratio_limit if min_score is None else max( ratio_limit, min_score )
+
+    matches = exact.matches( obj ) if exact is not None else {}
+
+    if index is None:
+        pks = search_space.keys()
+    else:
+        pks = index.candidates( obj )
+
+    # The exact matches come first, with their score, then the remaining
+    # candidates to compare with similar()
+    candidates = [( pk, matches[pk] ) for pk in sorted( matches )]
+    candidates += [( pk, None ) for pk in pks if pk not in matches]
 
-    for s in search_space.values():
-        ratio = similar( obj, s )
+    for n, ( pk, ratio ) in enumerate( candidates ):
+        s = search_space.get( pk )
+        if s is None or ( exclude is not None and exclude( s ) ):
+            continue
+        full = top_k is not None and len( dups ) >= top_k
+        if ratio is None:
+            # The margin keeps the pairs whose rounded ratio may reach the limit
+            ratio = similar( obj, s, limit=( max( limit, dups[0][0] ) if full else limit ) - 0.01 )
         ratio = round(ratio, 2)
-        if ratio > ratio_limit:
-            dups.append( (ratio, s) )
+        if ratio <= ratio_limit or ( min_score is not None and ratio < min_score ):
+            continue
+        if not full:
+            heapq.heappush( dups, (ratio, n, s) )
+        elif ratio >= dups[0][0]:
+            heapq.heapreplace( dups, (ratio, n, s) )
+
+    dups.sort( reverse=True )
+    return [(ratio, s) for ratio, n, s in dups]
+
+
+# Search space shared with the worker processes of find_all_duplicates. It is
+# set before the pool is started, so the forked workers get a read-only copy
+# without having to pickle it.
+_shared = {}
+
+
+def _scan( pks ):
+    """
+    Find the duplicates of the contacts pks, see find_all_duplicates.
+    """
+    search_space, index, ranks, kwargs = _shared['scan']
+
+    results = []
+    for pk in pks:
+        obj = search_space.get( pk )
+        if obj is None:
+            continue
+
+        # Contacts checked before this one have already been compared with it
+        rank = ranks[pk]
+        exclude = lambda s: ranks.get( s.pk, rank + 1 ) <= rank
+
+        dups = find_duplicates( obj, search_space, index=index, exclude=exclude, **kwargs )
+        if dups:
+            results.append( ( pk, [( ratio, s.pk ) for ratio, s in dups] ) )
+    return results
+
+
+def find_all_duplicates( pks, search_space, ratio_limit=0.75, index=None, workers=1, top_k=None, min_score=None,
+        scan=None, exact=None ):
+    """
+    Find the duplicates in the search space of each contact in the list pks.
+
+    Each pair of contacts is only reported once, for the contact coming first
+    in pks. Returns a list of ( pk, [( ratio, duplicate pk ), ...] ) in the
+    order of pks, for the contacts having duplicates. See find_duplicates
+    for ratio_limit, top_k, min_score and exact.
+
+    If scan is given (a slice of pks), only the duplicates of the contacts
+    in scan are looked for, the pairs are reported as for the whole pks,
+    e.g. to look for the duplicates of a long list of contacts in chunks.
+
+    With workers > 1 the contacts are split into shards which are scanned
+    in a pool of processes; the result is the same as with a single worker.
+    """
+    ranks = dict( [( pk, i ) for i, pk in enumerate( pks )] )
+
+    kwargs = { 'ratio_limit': ratio_limit, 'top_k': top_k, 'min_score': min_score, 'exact': exact }
+    if scan is None:
+        scan = pks
+
+    _shared['scan'] = ( search_space, index, ranks, kwargs )
+    try:
+        if workers > 1 and len( scan ) > workers:
+            # Contacts at the start of pks are compared with more contacts,
+            # so use several small shards per worker to balance the load.
+            size = max( 1, len( scan ) // ( workers * 4 ) )
+            shards = [scan[i:i + size] for i in range( 0, len( scan ), size )]
+
+            pool = Pool( workers )
+            try:
+                results = pool.map( _scan, shards )
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_scan( scan )]
+    finally:
+        del _shared['scan']
 
-    dups.sort( key=lambda x: x[0] )
-    dups.reverse()
-    return dups
+    return [r for shard in results for r in shard]
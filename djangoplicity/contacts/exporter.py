@@ -30,7 +30,9 @@
 # POSSIBILITY OF SUCH DAMAGE
 #
 
+import csv
 import xlwt
+import xlsxwriter
 import datetime
 import decimal
 
@@ -39,6 +41,9 @@ class Exporter( object ):
     """
     Abstract base class for all exporters
     """
+    # Maximum number of rows (header excluded) of the format, if limited
+    max_rows = None
+
     def __init__( self, header=[] ):
         self._wrote_header = False
         self._header_mapping = {}
@@ -91,6 +96,8 @@ class ExcelExporter( Exporter ):
         exporter.save()
     """
     mimetype = "application/vnd.ms-excel"
+    extension = "xls"
+    max_rows = 65535
 
     styles = {
         'datetime': xlwt.easyxf( num_format_str="YYYY/MM/DD hh:mm:ss" ),
@@ -151,3 +158,155 @@ class ExcelExporter( Exporter ):
         if self._flush_rows > 0 and self._row % self._flush_rows == 0:
             self._ws.flush_row_data()
         self._row += 1
+
+
+class XLSXExporter( Exporter ):
+    """
+    Excel 2007+ exporter. Rows are written to disk as they are produced, so the number of rows is not limited by memory nor
+    by the XLS format (65536 rows).
+
+    Example::
+        exporter = XLSXExporter( filename_or_stream='/path/to/excelfile.xlsx', header=[ ('id',None), ('email', None) ] )
+        for obj in queryset:
+            exporter.writedata( { 'id': obj.id, 'email': obj.email } )
+        exporter.save()
+    """
+    mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    extension = "xlsx"
+
+    def __init__( self, filename_or_stream=None, title="Contacts", header=[] ):
+        super( XLSXExporter, self ).__init__( header=header )
+        self._out = filename_or_stream
+        self._wb = xlsxwriter.Workbook( filename_or_stream, { 'constant_memory': True, 'strings_to_urls': False } )
+        self._ws = self._wb.add_worksheet( title )
+        self.styles = {
+            'datetime': self._wb.add_format( { 'num_format': 'yyyy/mm/dd hh:mm:ss' } ),
+            'date': self._wb.add_format( { 'num_format': 'yyyy/mm/dd' } ),
+            'time': self._wb.add_format( { 'num_format': 'hh:mm:ss' } ),
+        }
+        self._row = 0
+        self.writeheader()
+
+    def save( self, filename_or_stream=None ):
+        self._wb.close()
+
+    def writeheader( self, **kwargs ):
+        defaults = { 'style': self._wb.add_format( { 'bold': True, 'font_color': 'white', 'bg_color': 'black' } ) }
+        defaults.update( kwargs )
+        super( XLSXExporter, self ).writeheader( **defaults )
+
+    def _prepare_value( self, value ):
+        if isinstance( value, datetime.datetime ):
+            return [value, self.styles['datetime']]
+        elif isinstance( value, datetime.date ):
+            return [value, self.styles['date']]
+        elif isinstance( value, datetime.time ):
+            return [value, self.styles['time']]
+        elif value is None or isinstance( value, ( basestring, int, long, float, bool, decimal.Decimal ) ):
+            return [value]
+        else:
+            return [unicode( value )]
+
+    def writerow( self, row, style=None, **kwargs ):
+        for i, cval in enumerate( row ):
+            if style is not None:
+                self._ws.write( self._row, i, self._prepare_value( cval )[0], style )
+            else:
+                self._ws.write( self._row, i, *self._prepare_value( cval ) )
+        self._row += 1
+
+
+class CSVExporter( Exporter ):
+    """
+    CSV exporter, values are encoded in UTF-8.
+
+    Example::
+        exporter = CSVExporter( filename_or_stream='/path/to/file.csv', header=[ ('id',None), ('email', None) ] )
+        for obj in queryset:
+            exporter.writedata( { 'id': obj.id, 'email': obj.email } )
+        exporter.save()
+    """
+    mimetype = "text/csv"
+    extension = "csv"
+
+    def __init__( self, filename_or_stream=None, title=None, header=[], encoding='utf-8' ):
+        super( CSVExporter, self ).__init__( header=header )
+        if isinstance( filename_or_stream, basestring ):
+            self._out = open( filename_or_stream, 'wb' )
+            self._close = True
+        else:
+            self._out = filename_or_stream
+            self._close = False
+        self._writer = csv.writer( self._out )
+        self._encoding = encoding
+        self.writeheader()
+
+    def save( self, filename_or_stream=None ):
+        if self._close:
+            self._out.close()
+
+    def _prepare_value( self, value ):
+        if value is None:
+            return ''
+        elif isinstance( value, unicode ):
+            return value.encode( self._encoding )
+        elif isinstance( value, str ):
+            return value
+        else:
+            return unicode( value ).encode( self._encoding )
+
+    def writerow( self, row, **kwargs ):
+        self._writer.writerow( [self._prepare_value( cval ) for cval in row] )
+
+
+class StreamingCSVExporter( CSVExporter ):
+    """
+    CSV exporter producing the output as a generator of strings instead of
+    writing it to a file, e.g. for a StreamingHttpResponse. Only a few rows
+    are held in memory at any time.
+
+    Example::
+        exporter = StreamingCSVExporter( header=[ ('id',None), ('email', None) ] )
+        data = ( { 'id': obj.id, 'email': obj.email } for obj in queryset.iterator() )
+        response = StreamingHttpResponse( exporter.stream( data ), content_type=exporter.mimetype )
+    """
+    def __init__( self, title=None, header=[], encoding='utf-8', buffer_rows=100 ):
+        self._lines = []
+        self._buffer_rows = buffer_rows
+        super( StreamingCSVExporter, self ).__init__( filename_or_stream=self, header=header, encoding=encoding )
+
+    def write( self, value ):
+        # Called by the csv writer
+        self._lines.append( value )
+
+    def _flush( self ):
+        output = ''.join( self._lines )
+        self._lines = []
+        return output
+
+    def stream( self, data ):
+        """
+        Generator of the CSV output (header included) for an iterable of
+        dictionaries as passed to writedata().
+        """
+        for d in data:
+            self.writedata( d )
+            if len( self._lines ) >= self._buffer_rows:
+                yield self._flush()
+        if self._lines:
+            yield self._flush()
+
+
+# Available exporters by file extension
+EXPORTERS = dict( [( e.extension, e ) for e in ( ExcelExporter, XLSXExporter, CSVExporter )] )
+
+
+def get_exporter_class( file_format, rows=0 ):
+    """
+    Get the exporter class for a file extension, or the XLSX exporter if the
+    format can't hold that many rows (i.e. XLS).
+    """
+    exporter_class = EXPORTERS[file_format]
+    if exporter_class.max_rows is not None and rows > exporter_class.max_rows:
+        return XLSXExporter
+    return exporter_class
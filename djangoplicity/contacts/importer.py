@@ -76,6 +76,7 @@ Usage example::
 
 import codecs
 import csv
+import itertools
 import xlrd
 
 
@@ -213,6 +214,10 @@ class CSVImporter( Importer ):
     """
     Importer for CSV files.
 
+    The file is streamed: rows are read on demand each time the importer is
+    iterated, so memory use doesn't depend on the size of the file. Rows
+    are returned as ImportRow objects sharing the header index.
+
     Defaults:
         encoding='utf-8'
         dialect=csv.excel
@@ -220,56 +225,109 @@ class CSVImporter( Importer ):
     """
     def __init__( self, filename=None, **kwargs ):
         """
-        Initialise importer by opening the Excel file and
-        reading out a specific sheet.
+        Initialise importer by opening the CSV file and
+        reading out the header.
         """
-        f = open( filename, 'r' )
-        self.csvreader = _UnicodeReader( f, **kwargs )
+        self.filename = filename
+        self.kwargs = kwargs
+        self._len = None
 
         # Parse header
         i = 0
         self.cols = {}
-        header = self.csvreader.next()
+        with open( filename, 'r' ) as f:
+            header = _UnicodeReader( f, **kwargs ).next()
         for c in header:
             if isinstance(c, basestring):
                 c = c.strip()
             self.cols[c] = i
             i += 1
 
-        # Build dictionary of tabular data
-        self._rows = []
-        for r in self.csvreader:
-            data = {}
-            for c, i in self.cols.items():
-                try:
-                    data[c] = r[i]
-                except IndexError:
-                    data[c] = None
-            self._rows.append( data )
-
     def __len__( self ):
         """
-        Return the number of rows in the excel file.
+        Return the number of rows in the CSV file. The file is read once
+        and the result cached.
         """
-        return len( self._rows )
+        if self._len is None:
+            self._len = sum( 1 for dummy in self._reader() )
+        return self._len
 
     def __getitem__( self, value ):
         """
         Return all values for a specific column
         """
-        column = []
-        for r in self._rows:
-            column.append( r[value] )
-        return column
+        if value not in self.cols:
+            raise KeyError( value )
+        return [r[value] for r in self]
 
     def row( self, rowidx ):
         """
-        Return a specific row in the table.
+        Return a specific row in the table. Negative indexes count from
+        the end of the table.
         """
-        return self._rows[rowidx]
+        if rowidx < 0:
+            rowidx += len( self )
+            if rowidx < 0:
+                raise IndexError( rowidx - len( self ) )
+        for r in itertools.islice( self, rowidx, None ):
+            return r
+        raise IndexError( rowidx )
 
     def __iter__( self ):
-        return self._rows.__iter__()
+        return ( ImportRow( self.cols, r ) for r in self._reader() )
+
+    def _reader( self ):
+        """
+        Iterate over the raw rows (lists of values) of the file, without the header.
+        """
+        with open( self.filename, 'r' ) as f:
+            csvreader = _UnicodeReader( f, **self.kwargs )
+            csvreader.next()
+            for r in csvreader:
+                yield r
+
+
+class ImportRow( object ):
+    """
+    Lightweight read-only mapping of column names to values for a row,
+    sharing the column index of the importer. Columns missing in the row
+    have the value None.
+    """
+    __slots__ = ( 'cols', 'data' )
+
+    def __init__( self, cols, data ):
+        self.cols = cols
+        self.data = data
+
+    def __getitem__( self, key ):
+        try:
+            return self.data[self.cols[key]]
+        except IndexError:
+            return None
+
+    def __contains__( self, key ):
+        return key in self.cols
+
+    def __iter__( self ):
+        return iter( self.cols )
+
+    def __len__( self ):
+        return len( self.cols )
+
+    def get( self, key, default=None ):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys( self ):
+        return self.cols.keys()
+
+    def items( self ):
+        return [( c, self[c] ) for c in self.cols]
+
+    def values( self ):
+        return [self[c] for c in self.cols]
 
 
 class _UTF8Recoder:
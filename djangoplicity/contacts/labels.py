@@ -60,17 +60,34 @@ Usage::
     # current object instance for the label you are rendering:
     >>> template = '...{{obj.email}}...'
 
+    # Render a large number of labels in chunks of 50 pages in 4 processes and
+    # merge them in one PDF file
+    >>> with open( '/path/to/somewhere/somefilename.pdf', 'wb' ) as f:
+    ...     l.render_merged( queryset, 'somefilename.pdf', f, pages=50, processes=4 )
+
 
 When override templates, instead of including a template in a file, you can also just
 directly define the django template in a string. This is used by the ``Label`` model to
 define custom labels.
 """
 
+from collections import deque, OrderedDict
 from django.template import Context, Template
 from django.utils.encoding import smart_str
 from django.http import HttpResponse
+import hashlib
 import math
 import os
+import tempfile
+import threading
+
+from PyPDF2 import PdfFileMerger
+
+try:
+    # billiard (used by celery) allows to start a pool from a worker process
+    from billiard import Pool
+except ImportError:
+    from multiprocessing import Pool
 
 try:
     import trml2pdf
@@ -112,13 +129,57 @@ LABEL_PAPER = {
 # Label paper choices for use as choices in a django field
 LABEL_PAPER_CHOICES = tuple( [( k, v['title'] ) for k, v in LABEL_PAPER.items()] )
 
+# Cache key for the progress of labels rendered in the background
+LABEL_PROGRESS_CACHE_KEY = 'djangoplicity.contacts.labels.%s'
+
+# Process-local LRU cache of compiled document templates, see LabelRender
+LABEL_TEMPLATE_CACHE_SIZE = 32
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+
+
+def clear_template_cache( cache_key=None ):
+    """
+    Remove the compiled templates for a cache key (e.g. a label primary
+    key) from the cache, or all templates if no key is given.
+    """
+    with _template_cache_lock:
+        if cache_key is None:
+            _template_cache.clear()
+        else:
+            for key in [k for k in _template_cache if k[0] == cache_key]:
+                del _template_cache[key]
+
+
+def _bounded_imap( pool, func, jobs, size ):
+    """
+    Like pool.imap, but the jobs are taken from the iterable in the calling
+    thread and only as the results are consumed, so that at most ``size``
+    jobs are pending. (pool.imap reads the whole iterable ahead in a thread.)
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append( pool.apply_async( func, ( job, ) ) )
+        if len( pending ) >= size:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _render_pages_worker( args ):
+    """
+    Render a chunk of pages in a worker process of LabelRender.render_merged
+    """
+    render_args, page_objects, filename, extra_context = args
+    return LabelRender( *render_args )._render_pages( page_objects, filename, extra_context ), len( page_objects )
+
 
 class LabelRender( object ):
     """
     Class that renders labels from a queryset.
     """
 
-    def __init__( self, paper, label_template=None, style=None, repeat=1 ):
+    def __init__( self, paper, label_template=None, style=None, repeat=1, cache_key=None ):
         """
         Initialise template render.
 
@@ -126,6 +187,8 @@ class LabelRender( object ):
             * ``label_template``: string with a django template to use instead of the default label template (optional)
             * ``style``: string with a django template to use instead of the default label template style (optional)
             * ``repeat``: the number of times to repeat each object in the query set.
+            * ``cache_key``: if given, the compiled document template is cached under this key (and the paper and
+              templates), see clear_template_cache (optional)
         """
         # Ensure trml2pdf is installed
         if trml2pdf is None:
@@ -147,16 +210,99 @@ class LabelRender( object ):
         # 1 block for the label_style
         # X blocks for the individual labels on a page.
         self.label_paper = LABEL_PAPER[paper]
-        self.document_template = """{%% extends "%s" %%}""" % self.label_paper['template']
+
+        if cache_key is None:
+            self.document_template = self._compile( label_template, style )
+        else:
+            digest = hashlib.sha1( smart_str( u'%s\0%s' % ( label_template or '', style or '' ) ) ).hexdigest()
+            key = ( cache_key, paper, digest )
+            with _template_cache_lock:
+                self.document_template = _template_cache.pop( key, None )
+            if self.document_template is None:
+                self.document_template = self._compile( label_template, style )
+            with _template_cache_lock:
+                _template_cache[key] = self.document_template
+                while len( _template_cache ) > LABEL_TEMPLATE_CACHE_SIZE:
+                    _template_cache.popitem( last=False )
+
+        self.repeat = repeat if int(repeat) > 0 else 1
+
+        # Arguments to create the same render in another process
+        self._args = ( paper, label_template, style, repeat, cache_key )
+
+    def _compile( self, label_template, style ):
+        """
+        Compile the document template
+        """
+        document_template = """{%% extends "%s" %%}""" % self.label_paper['template']
 
         if style:
-            self.document_template += u"""{%% block label_style %%}%s{%% endblock %%}""" % style
+            document_template += u"""{%% block label_style %%}%s{%% endblock %%}""" % style
         if label_template:
             for i in range( self.label_paper['labels_no'] ):
-                self.document_template += u"""{%% block label%s %%}%s{%% endblock %%}""" % ( i, label_template )
+                document_template += u"""{%% block label%s %%}%s{%% endblock %%}""" % ( i, label_template )
 
-        self.document_template = Template( self.document_template )
-        self.repeat = repeat if int(repeat) > 0 else 1
+        return Template( document_template )
+
+    def page_count( self, count ):
+        """
+        Number of pages needed for labels of ``count`` objects
+        """
+        return int( math.ceil( float( count * self.repeat ) / self.label_paper['labels_no'] ) )
+
+    def _iter_pages( self, queryset, iterator=False ):
+        """
+        Generator of pages: lists of labels_no objects (the last page is
+        padded with None), each object being repeated if needed.
+        """
+        labels_no = self.label_paper['labels_no']
+        if iterator and hasattr( queryset, 'iterator' ):
+            queryset = queryset.iterator()
+
+        page = []
+        for obj in queryset:
+            for dummy in range( self.repeat ):
+                page.append( obj )
+                if len( page ) == labels_no:
+                    yield page
+                    page = []
+
+        if page:
+            yield page + [None] * ( labels_no - len( page ) )
+
+    def _page_chunks( self, queryset, pages ):
+        """
+        Generator of lists of at most ``pages`` pages
+        """
+        chunk = []
+        for page in self._iter_pages( queryset, iterator=True ):
+            chunk.append( page )
+            if len( chunk ) == pages:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _render_pages( self, page_objects, filename, extra_context ):
+        """
+        Render a PDF for a list of pages
+        """
+        from django.conf import settings
+        context = dict( extra_context )
+        context.update( {
+            'filename': filename,
+            'label_template': self.label_paper['label_template'],
+            'label_template_style': self.label_paper['label_template_style'],
+            'objects': page_objects,
+            'MEDIA_ROOT': settings.MEDIA_ROOT,
+            'STATIC_ROOT': settings.STATIC_ROOT,
+        } )
+
+        # Generate RML template
+        rmldoc = self.document_template.render( Context( context ) )
+
+        # Generate PDF
+        return trml2pdf.parseString( smart_str( rmldoc ) )
 
     def render( self, queryset, filename, extra_context={} ):
         """
@@ -176,39 +322,57 @@ class LabelRender( object ):
             * title
             * label_template
         """
-        # Repeat objects in queryset if needed.
-        if self.repeat > 1:
-            new_queryset = []
-            for obj in queryset:
-                new_queryset += [obj] * self.repeat
-            queryset = new_queryset
-
-        # Split queryset into lists of pages
-        list_count = int( math.ceil( float( len( queryset ) ) / self.label_paper['labels_no'] ) )
+        return self._render_pages( list( self._iter_pages( queryset ) ), filename, extra_context )
 
-        page_objects = []
-        for i in range( list_count ):
-            page_objects.append( queryset[i * self.label_paper['labels_no']:( i + 1 ) * self.label_paper['labels_no']] )
-
-        if len( page_objects[-1] ) != self.label_paper['labels_no']:
-            page_objects[-1] = page_objects[-1] + [None] * ( self.label_paper['labels_no'] - len( page_objects[-1] ) )
-
-        # Generate context
-        from django.conf import settings
-        extra_context.update( {
-            'filename': filename,
-            'label_template': self.label_paper['label_template'],
-            'label_template_style': self.label_paper['label_template_style'],
-            'objects': page_objects,
-            'MEDIA_ROOT': settings.MEDIA_ROOT,
-            'STATIC_ROOT': settings.STATIC_ROOT,
-        } )
-
-        # Generate RML template
-        rmldoc = self.document_template.render( Context( extra_context ) )
-
-        # Generate PDF
-        return trml2pdf.parseString( smart_str( rmldoc ) )
+    def render_merged( self, queryset, filename, output, extra_context={}, pages=50, processes=None, progress=None ):
+        """
+        Render PDF in chunks of ``pages`` pages and write the merged document
+        to the file object output, so that large numbers of labels can be
+        rendered without holding the whole document in memory.
+
+            * ``processes``: number of processes used to render the chunks in
+              parallel (optional). The objects and extra_context must be
+              picklable. At most two chunks per process are read ahead.
+            * ``progress``: function called with the number of pages rendered
+              so far after each chunk (optional).
+        """
+        chunks = self._page_chunks( queryset, pages )
+        pool = None
+
+        if processes:
+            from django.db import connection
+            # The objects are sent to the workers, which will open their own
+            # database connection if needed.
+            connection.close()
+            pool = Pool( processes )
+            jobs = ( ( self._args, chunk, filename, extra_context ) for chunk in chunks )
+            results = _bounded_imap( pool, _render_pages_worker, jobs, processes * 2 )
+        else:
+            results = ( ( self._render_pages( chunk, filename, extra_context ), len( chunk ) ) for chunk in chunks )
+
+        merger = PdfFileMerger()
+        tmpfiles = []
+        try:
+            done = 0
+            for pdf, count in results:
+                # Keep the rendered chunks on disk until they are merged
+                f = tempfile.TemporaryFile()
+                f.write( pdf )
+                f.seek( 0 )
+                tmpfiles.append( f )
+                merger.append( f )
+
+                done += count
+                if progress:
+                    progress( done )
+
+            merger.write( output )
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for f in tmpfiles:
+                f.close()
 
     def render_http_response( self, queryset, filename, response=None, extra_context={} ):
         """
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-contacts
+# Copyright (c) 2007-2015, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoplicity.contacts.exporter import EXPORTERS
+from djangoplicity.contacts.models import Contact
+
+
+class Command(BaseCommand):
+    '''
+    Export contacts to a CSV, XLS or XLSX file
+    '''
+    help = 'Export contacts, optionally only the members of some groups, to a file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename', help='Output file, the format is given by the extension (e.g. contacts.csv)')
+        parser.add_argument('--group', action='append', dest='groups', default=[],
+            help='Only export members of this group (can be given several times)')
+
+    def handle(self, *args, **options):
+        filename = options['filename']
+        file_format = os.path.splitext(filename)[1][1:].lower()
+        if file_format not in EXPORTERS:
+            raise CommandError('Unsupported format "%s", use one of: %s' % (file_format, ', '.join(sorted(EXPORTERS))))
+
+        queryset = Contact.objects.all()
+        if options['groups']:
+            queryset = queryset.filter(groups__name__in=options['groups']).distinct()
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+
+        exporter_class = EXPORTERS[file_format]
+        with open(filename, 'wb') as f:
+            Contact.export(pks, exporter_class(filename_or_stream=f, title='Contacts', header=Contact.get_export_header()))
+
+        print 'Exported: %s contacts' % len(pks)
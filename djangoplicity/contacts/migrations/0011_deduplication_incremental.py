@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0010_auto_20210107_0038'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deduplication',
+            name='incremental',
+            field=models.BooleanField(default=False, help_text='Only look for duplicates of contacts created or modified since the last completed run.'),
+        ),
+        migrations.AddField(
+            model_name='deduplication',
+            name='last_completed_run',
+            field=models.DateTimeField(blank=True, help_text='Start time of the last completed run.', null=True),
+        ),
+    ]
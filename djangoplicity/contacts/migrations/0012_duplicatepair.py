@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0011_deduplication_incremental'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DuplicatePair',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('score', models.FloatField(default=1.0)),
+                ('decision', models.CharField(blank=True, choices=[('', 'Pending'), ('update', 'Updated'), ('ignore', 'Ignored')], default='', max_length=10)),
+                ('contact_a', models.ForeignKey(related_name='+', to='contacts.Contact')),
+                ('contact_b', models.ForeignKey(related_name='+', to='contacts.Contact')),
+                ('deduplication', models.ForeignKey(related_name='pairs', to='contacts.Deduplication')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='duplicatepair',
+            unique_together=set([('deduplication', 'contact_a', 'contact_b')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='duplicatepair',
+            index_together=set([('deduplication', 'decision'), ('deduplication', 'contact_a', 'score')]),
+        ),
+    ]
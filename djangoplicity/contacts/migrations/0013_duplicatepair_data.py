@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations
+
+
+def blobs_to_pairs(apps, schema_editor):
+    '''
+    Move the JSON duplicate_contacts and deduplicated_contacts of each
+    deduplication to the DuplicatePair table. Pairs of contacts which don't
+    exist anymore are dropped.
+    '''
+    Contact = apps.get_model('contacts', 'Contact')
+    Deduplication = apps.get_model('contacts', 'Deduplication')
+    DuplicatePair = apps.get_model('contacts', 'DuplicatePair')
+
+    contact_ids = set(Contact.objects.values_list('pk', flat=True))
+
+    for d in Deduplication.objects.all():
+        pairs = {}
+
+        if d.duplicate_contacts:
+            for contact_a, dups in json.loads(d.duplicate_contacts).items():
+                for contact_b, score in dups.items():
+                    pairs[(int(contact_a), int(contact_b))] = DuplicatePair(deduplication=d,
+                        contact_a_id=int(contact_a), contact_b_id=int(contact_b), score=score)
+
+        if d.deduplicated_contacts:
+            # The decision taken wasn't stored, so they are all migrated as
+            # ignored, which excludes them from the next runs the same way.
+            for key in json.loads(d.deduplicated_contacts):
+                contact_a, contact_b = [int(pk) for pk in key.split('_')]
+                if (contact_a, contact_b) not in pairs:
+                    pairs[(contact_a, contact_b)] = DuplicatePair(deduplication=d,
+                        contact_a_id=contact_a, contact_b_id=contact_b)
+                pairs[(contact_a, contact_b)].decision = 'ignore'
+
+        DuplicatePair.objects.bulk_create([
+            pair for (contact_a, contact_b), pair in pairs.items()
+            if contact_a in contact_ids and contact_b in contact_ids
+        ], batch_size=1000)
+
+
+def pairs_to_blobs(apps, schema_editor):
+    Deduplication = apps.get_model('contacts', 'Deduplication')
+    DuplicatePair = apps.get_model('contacts', 'DuplicatePair')
+
+    for d in Deduplication.objects.all():
+        duplicate_contacts = {}
+        deduplicated_contacts = []
+
+        for pair in DuplicatePair.objects.filter(deduplication=d):
+            if pair.contact_a_id != pair.contact_b_id:
+                duplicate_contacts.setdefault(str(pair.contact_a_id), {})[str(pair.contact_b_id)] = pair.score
+            if pair.decision:
+                deduplicated_contacts.append('%s_%s' % (pair.contact_a_id, pair.contact_b_id))
+
+        d.duplicate_contacts = json.dumps(duplicate_contacts) if duplicate_contacts else ''
+        d.deduplicated_contacts = json.dumps(deduplicated_contacts) if deduplicated_contacts else ''
+        d.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0012_duplicatepair'),
+    ]
+
+    operations = [
+        migrations.RunPython(blobs_to_pairs, pairs_to_blobs),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0013_duplicatepair_data'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='deduplication',
+            name='deduplicated_contacts',
+        ),
+        migrations.RemoveField(
+            model_name='deduplication',
+            name='duplicate_contacts',
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0014_remove_deduplication_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingGroupCheck',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('contact_id', models.IntegerField(unique=True)),
+                ('groups', models.TextField(blank=True)),
+                ('email', models.EmailField(max_length=254, blank=True)),
+                ('last_saved', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
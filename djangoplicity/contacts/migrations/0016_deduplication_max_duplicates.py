@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0015_pendinggroupcheck'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deduplication',
+            name='max_duplicates',
+            field=models.PositiveIntegerField(blank=True, default=20, help_text='Maximum number of duplicates kept for each contact (all if empty).', null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0016_deduplication_max_duplicates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deduplication',
+            name='run_started',
+            field=models.DateTimeField(blank=True, help_text='Start time of the current run.', null=True),
+        ),
+        migrations.AddField(
+            model_name='deduplication',
+            name='checkpoint',
+            field=models.IntegerField(blank=True, help_text='Last contact compared in the current run.', null=True),
+        ),
+        migrations.AddField(
+            model_name='deduplication',
+            name='processed_contacts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='deduplication',
+            name='total_contacts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
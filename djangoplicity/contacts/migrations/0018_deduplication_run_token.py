@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0017_deduplication_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deduplication',
+            name='run_token',
+            field=models.CharField(blank=True, help_text='Token of the task running the deduplication.', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='deduplication',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, help_text='Last time the running task saved its progress.', null=True),
+        ),
+        migrations.AddField(
+            model_name='deduplication',
+            name='run_resumed',
+            field=models.DateTimeField(blank=True, help_text='Time the running task started or resumed the current run.', null=True),
+        ),
+        migrations.AddField(
+            model_name='deduplication',
+            name='resumed_contacts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -30,29 +30,41 @@
 # POSSIBILITY OF SUCH DAMAGE
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from dirtyfields import DirtyFieldsMixin
 from hashids import Hashids
+import hashlib
 import logging
 import os
 import json
+import tempfile
+import time
+import uuid
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files.storage import FileSystemStorage
 from django.core.urlresolvers import reverse as url_reverse
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
 from django.db.models.signals import pre_delete, post_delete, post_save, \
-    pre_save
-from django.db.models import Q
+    pre_save, m2m_changed
+from django.db.models import F, Q
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from djangoplicity.actions.models import Action  # pylint: disable=E0611
-from djangoplicity.contacts.labels import LabelRender, LABEL_PAPER_CHOICES
+from djangoplicity.contacts.labels import LabelRender, LABEL_PAPER_CHOICES, clear_template_cache
 from djangoplicity.contacts.signals import contact_added, contact_removed, \
-    contact_updated
+    contact_updated, contacts_added, contacts_removed
 from djangoplicity.contacts.tasks import contactgroup_change_check
-from djangoplicity.contacts import deduplication
+from djangoplicity.contacts import batching, blocking, deduplication
+from djangoplicity.contacts.caching import VersionedCache
+from djangoplicity.contacts.countries import country_resolver, region_resolver
 from djangoplicity.translation.fields import LanguageField  # pylint: disable=E0611
 
 
@@ -71,11 +83,19 @@ class Label( models.Model ):
     enabled = models.BooleanField( default=True )
 
     def get_label_render( self ):
-        return LabelRender( self.paper, label_template=self.template, style=self.style, repeat=self.repeat )
+        return LabelRender( self.paper, label_template=self.template, style=self.style, repeat=self.repeat, cache_key=self.pk )
 
     def __unicode__( self ):
         return self.name
 
+    @classmethod
+    def clear_cache( cls, sender, instance=None, **kwargs ):
+        '''
+        Remove the compiled templates of a label once it is changed.
+        '''
+        if instance is not None:
+            clear_template_cache( instance.pk )
+
     class Meta:
         ordering = ['name']
 
@@ -98,16 +118,22 @@ class Field( models.Model ):
     blank = models.BooleanField( default=True )
     # Does field allow blank values
 
-    _allowed_fields = None
+    _cache = VersionedCache( 'djangoplicity.contacts.fields', lambda: list( Field.objects.values_list( 'slug', 'name' ) ) )
 
     @classmethod
     def _get_cache( cls ):
         """
         List of fields are cached for speed efficiency.
         """
-        if cls._allowed_fields is None:
-            cls._allowed_fields = list( cls.objects.values_list( 'slug', 'name' ) )
-        return cls._allowed_fields if cls._allowed_fields else []
+        return cls._cache.get()
+
+    @classmethod
+    def clear_cache( cls, *args, **kwargs ):
+        """
+        Ensure the list of fields is reloaded by all processes once a field
+        is saved or deleted.
+        """
+        cls._cache.clear()
 
     @classmethod
     def field_options( cls ):
@@ -123,13 +149,6 @@ class Field( models.Model ):
         """
         return [ x[0] for x in cls._get_cache() ]
 
-    def save( self, *args, **kwargs ):
-        """
-        Clear field cache if an object is saved.
-        """
-        super( Field, self ).save( *args, **kwargs )
-        self.__class__._slug_cache = None
-
     def __unicode__( self ):
         return self.name
 
@@ -209,6 +228,13 @@ class Country( models.Model ):
                 data[c.iso_code.upper()] = c
         return data
 
+    @classmethod
+    def clear_cache( cls, *args, **kwargs ):
+        """
+        Ensure the country resolver is reloaded in case any change is made.
+        """
+        country_resolver.clear()
+
     def save( self, *args, **kwargs ):
         """ Ensure ISO code is in upper case """
         self.iso_code = self.iso_code.upper()
@@ -234,6 +260,13 @@ class Region(models.Model):
     def __unicode__(self):
         return self.name
 
+    @classmethod
+    def clear_cache(cls, *args, **kwargs):
+        '''
+        Ensure the region resolver is reloaded in case any change is made.
+        '''
+        region_resolver.clear()
+
     class Meta:
         ordering = ['country', 'name']
 
@@ -285,9 +318,9 @@ class ContactGroup( DirtyFieldsMixin, models.Model ):
         """
 
         # See notes in pre_delete_callback
-        for c in Contact.objects.filter( pk__in=instance._cached_contact_set ).annotate( min__group_order=models.Min( 'groups__order' ) ):
-            if c.group_order != c.min__group_order:
-                Contact.objects.filter( pk=c.pk ).update( group_order=c.min__group_order )
+        pks = instance._cached_contact_set
+        for i in range( 0, len( pks ), 1000 ):
+            Contact.update_group_order( Contact.objects.filter( pk__in=pks[i:i + 1000] ) )
 
     @classmethod
     def pre_save_callback( cls, sender, instance=None, raw=False, **kwargs ):
@@ -318,9 +351,9 @@ class ContactGroup( DirtyFieldsMixin, models.Model ):
             elif instance.order is None or dirty_fields['order'] - instance.order < 0:
                 # Order value was changed to a greater value - hence we must update all contacts
                 # with a group_order greater than the *old* instance.order
-                for c in Contact.objects.filter( pk__in=instance.contact_set.filter( group_order__gte=dirty_fields['order'] ) ).annotate( min__group_order=models.Min( 'groups__order' ) ):
-                    if c.group_order != c.min__group_order:
-                        Contact.objects.filter( pk=c.pk ).update( group_order=c.min__group_order )
+                Contact.update_group_order( Contact.objects.filter(
+                    pk__in=Contact.groups.through.objects.filter( contactgroup=instance ).values( 'contact_id' ),
+                    group_order__gte=dirty_fields['order'] ) )
 
         # Reset dirty state - DirtyFieldMixin is supposed to do it automatically,
         # but apparently there's some conflicts with the signals it seems like.
@@ -330,6 +363,95 @@ class ContactGroup( DirtyFieldsMixin, models.Model ):
         ordering = ( 'name', )
 
 
+class ContactLookups( object ):
+    """
+    Lookup context for Contact.update_object/create_object. Countries,
+    regions, groups and extra fields are resolved at most once per distinct
+    value, so the same context can be passed to many calls to keep the
+    number of queries per contact constant::
+
+        lookups = ContactLookups()
+        for data in rows:
+            Contact.create_object( lookups=lookups, **data )
+    """
+    def __init__( self ):
+        self._fields = None
+        self._country_resolver = None
+        self._countries = {}
+        self._regions = {}
+        self._group_lists = {}
+
+    def country( self, value ):
+        """
+        Get a country from a primary key, ISO code or name.
+        """
+        if not value:
+            return None
+        if value not in self._countries:
+            self._countries[value] = self._get_country( value )
+        return self._countries[value]
+
+    def _get_country( self, value ):
+        # The resolver is validated once for all the lookups
+        if self._country_resolver is None:
+            self._country_resolver = country_resolver.snapshot()
+
+        pk = value if isinstance( value, int ) else self._country_resolver.exact( value )
+        if pk is not None:
+            try:
+                return self._country_resolver.get( pk )
+            except Country.DoesNotExist:
+                pass
+
+        # The country may have been created since the resolver was loaded
+        if isinstance( value, int ):
+            return Country.objects.get( pk=value )
+        elif len( value ) == 2:
+            return Country.objects.get( iso_code=value.upper() )
+        return Country.objects.get( name__iexact=value )
+
+    def region( self, value, country ):
+        """
+        Get a region from a primary key, or from a part of its name in the
+        given country.
+        """
+        key = ( value, country.pk if country else None )
+        if key not in self._regions:
+            try:
+                self._regions[key] = Region.objects.get( pk=value )
+            except ValueError:
+                query = Region.objects.filter( name__icontains=value, country=country ) if country else []
+                self._regions[key] = query[0] if query else None
+        return self._regions[key]
+
+    def groups( self, values ):
+        """
+        Get a list of groups from a list of ids or, if any of the values
+        isn't a number, from a list of names.
+        """
+        try:
+            key = ( 'pk', frozenset( [int( x ) for x in values] ) )
+        except ( ValueError, TypeError ):
+            key = ( 'name', frozenset( [unicode( x ) for x in values] ) )
+
+        if key not in self._group_lists:
+            if not key[1]:
+                self._group_lists[key] = []
+            elif key[0] == 'pk':
+                self._group_lists[key] = list( ContactGroup.objects.filter( pk__in=key[1] ) )
+            else:
+                self._group_lists[key] = list( ContactGroup.objects.filter( name__in=key[1] ) )
+        return self._group_lists[key]
+
+    def fields( self ):
+        """
+        Get a dictionary of extra field primary keys indexed by slug.
+        """
+        if self._fields is None:
+            self._fields = dict( Field.objects.values_list( 'slug', 'pk' ) )
+        return self._fields
+
+
 class Contact( DirtyFieldsMixin, models.Model ):
     """
     Contacts model
@@ -440,6 +562,52 @@ class Contact( DirtyFieldsMixin, models.Model ):
 
     ALLOWED_FIELDS = ['first_name', 'last_name', 'title', 'position', 'organisation', 'department', 'street_1', 'street_2', 'tax_code', 'city', 'zip', 'state', 'country', 'region', 'phone', 'website', 'social', 'email', 'language' ]
 
+    EXPORT_FIELDS = ['id', 'title', 'first_name', 'last_name', 'position', 'organisation', 'department', 'street_1', 'street_2', 'zip', 'city', 'country', 'region', 'tax_code', 'phone', 'website', 'social', 'email', 'language', 'groups' ]
+
+    @classmethod
+    def export_data( cls, pks, chunk_size=1000 ):
+        """
+        Generator of dictionaries of EXPORT_FIELDS for the contacts with the
+        given primary keys (in the same order). Each chunk of contacts is read
+        with one query for the fields and one for the group names, instead of
+        loading each contact and its groups.
+        """
+        related = { 'country': 'country__name', 'region': 'region__name' }
+        columns = [related.get( f, f ) for f in cls.EXPORT_FIELDS if f != 'groups']
+
+        for i in range( 0, len( pks ), chunk_size ):
+            chunk = pks[i:i + chunk_size]
+
+            rows = dict( [( r['id'], r ) for r in cls.objects.filter( pk__in=chunk ).order_by().values( *columns )] )
+
+            groups = {}
+            for contact_id, name in cls.groups.through.objects.filter( contact_id__in=chunk ).order_by( 'contactgroup__name' ).values_list( 'contact_id', 'contactgroup__name' ):
+                groups.setdefault( contact_id, [] ).append( name )
+
+            for pk in chunk:
+                data = rows.get( pk )
+                if data is None:
+                    # Contact was deleted in the meantime
+                    continue
+                for field, column in related.items():
+                    data[field] = data.pop( column )
+                data['groups'] = ', '.join( groups.get( pk, [] ) )
+                yield data
+
+    @classmethod
+    def export( cls, pks, exporter ):
+        """
+        Write the contacts with the given primary keys to an exporter (see
+        djangoplicity.contacts.exporter) created with get_export_header().
+        """
+        for data in cls.export_data( pks ):
+            exporter.writedata( data )
+        exporter.save()
+
+    @classmethod
+    def get_export_header( cls ):
+        return [( field, None ) for field in cls.EXPORT_FIELDS]
+
     @classmethod
     def get_allowed_extra_fields( cls ):
         """
@@ -448,12 +616,12 @@ class Contact( DirtyFieldsMixin, models.Model ):
         return Field.allowed_fields()
 
     @classmethod
-    def find_or_create_object( cls, **kwargs ):
+    def find_or_create_object( cls, lookups=None, **kwargs ):
         """
         Find an object or create it if no match was found.
         """
         obj = cls.find_object( **kwargs )
-        return obj if obj else cls.create_object( **kwargs )
+        return obj if obj else cls.create_object( lookups=lookups, **kwargs )
 
     @classmethod
     def _select_contact( cls, qs ):
@@ -497,22 +665,19 @@ class Contact( DirtyFieldsMixin, models.Model ):
         return None
 
     @classmethod
-    def create_object( cls, groups=None, **kwargs ):
+    def create_object( cls, groups=None, lookups=None, **kwargs ):
         """
-        Create a new contact from dictionary.
+        Create a new contact from dictionary. See ContactLookups for
+        the lookups argument.
         """
-        if groups is None:
-            groups = []
+        if lookups is None:
+            lookups = ContactLookups()
         obj = cls()
-        if obj.update_object( **kwargs ):
+        if obj.update_object( lookups=lookups, **kwargs ):
             obj.save()
-            obj.update_extra_fields( **kwargs )
+            obj.update_extra_fields( lookups=lookups, **kwargs )
             if groups:
-                try:
-                    groups = list(ContactGroup.objects.filter(id__in=groups))
-                except ValueError:
-                    # In case the groups is a list of strings and not ids
-                    groups = list(ContactGroup.objects.filter(name__in=groups))
+                groups = lookups.groups( groups )
                 if groups:
                     obj.groups.add( *groups )
                 for g in groups:
@@ -521,9 +686,91 @@ class Contact( DirtyFieldsMixin, models.Model ):
         else:
             return None
 
-    def update_object( self, groups=None, **kwargs ):
+    @classmethod
+    def bulk_create_objects( cls, rows, batch_size=500 ):
+        """
+        Create new contacts from a list of dictionaries, like create_object
+        but with a fixed number of queries: countries, regions, groups and
+        extra fields are resolved up front, and contacts, group memberships
+        and extra field values are inserted with bulk_create.
+
+        No contact_added signal nor group change check is sent for each
+        contact, instead a dictionary of the new contacts indexed by group is
+        returned so the caller can send one contacts_added signal per group.
+        """
+        lookups = ContactLookups()
+        allowed = set( cls.get_allowed_extra_fields() )
+        extra_fields = dict( ( k, v ) for k, v in lookups.fields().items() if k in allowed )
+
+        contacts = []
+        for data in rows:
+            kwargs = dict( data )
+            groups = lookups.groups( kwargs.pop( 'groups', None ) or [] )
+            obj = cls()
+            changed = False
+
+            if 'country' in kwargs:
+                obj.country = lookups.country( kwargs.pop( 'country' ) )
+                changed = True
+            if 'region' in kwargs:
+                region = kwargs.pop( 'region' )
+                if region:
+                    obj.region = lookups.region( region, obj.country )
+                    changed = changed or obj.region is not None
+
+            for field, val in kwargs.items():
+                if field in cls.ALLOWED_FIELDS:
+                    setattr( obj, field, val )
+                    changed = True
+
+            if not changed:
+                continue
+
+            if obj.email:
+                # All email addresses use lower-case (see pre_save_callback)
+                obj.email = obj.email.lower()
+
+            orders = [g.order for g in groups if g.order is not None]
+            obj.group_order = min( orders ) if orders else None
+
+            contacts.append( ( obj, groups, [( extra_fields[k], v ) for k, v in kwargs.items() if k in extra_fields] ) )
+
+        with transaction.atomic():
+            if connection.features.can_return_ids_from_bulk_insert:
+                cls.objects.bulk_create( [obj for obj, dummy, dummy in contacts], batch_size=batch_size )
+            else:
+                # The primary keys are needed for the relations, so the
+                # contacts have to be inserted one by one. A raw save skips
+                # the per contact signals, but also the auto_now(_add)
+                # handling so the timestamps are set here.
+                now = timezone.now()
+                for obj, dummy, dummy in contacts:
+                    obj.created = obj.last_modified = now
+                    obj.save_base( raw=True )
+
+            Through = cls.groups.through
+            Through.objects.bulk_create( [
+                Through( contact_id=obj.pk, contactgroup_id=g.pk ) for obj, groups, dummy in contacts for g in groups
+            ], batch_size=batch_size )
+
+            ContactField.objects.bulk_create( [
+                ContactField( field_id=field_id, contact_id=obj.pk, value=value )
+                for obj, dummy, values in contacts for field_id, value in values
+            ], batch_size=batch_size )
+
+        added = {}
+        for obj, groups, dummy in contacts:
+            for g in groups:
+                added.setdefault( g, [] ).append( obj )
+
+        return added
+
+    def update_object( self, groups=None, lookups=None, **kwargs ):
         """
-        Update a contact with new information from a dictionary. Following keys are supported:
+        Update a contact with new information from a dictionary. Countries,
+        regions, groups and extra fields are resolved with lookups (a
+        ContactLookups, shared between calls when updating many contacts).
+        Following keys are supported:
             * first_name
             * last_name
             * title
@@ -540,36 +787,23 @@ class Contact( DirtyFieldsMixin, models.Model ):
             * social
             * email
         """
+        if lookups is None:
+            lookups = ContactLookups()
         changed = False
 
-        ctry = None
         if 'country' in kwargs:
-            if kwargs['country'] and isinstance(kwargs['country'], int):
-                ctry = Country.objects.get(pk=kwargs['country'])
-            elif kwargs['country'] and len( kwargs['country'] ) == 2:
-                ctry = Country.objects.get( iso_code=kwargs['country'].upper() )
-            elif kwargs['country']:
-                ctry = Country.objects.get( name__iexact=kwargs['country'] )
-            self.country = ctry
+            self.country = lookups.country( kwargs['country'] )
             changed = True
             del kwargs['country']
         if 'region' in kwargs:
             if kwargs['region']:
-                try:
-                    self.region = Region.objects.get(pk=kwargs['region'])
+                region = lookups.region( kwargs['region'], self.country )
+                if region:
+                    self.region = region
                     changed = True
-                except ValueError:
-                    if self.country:
-                        query = Region.objects.filter(name__icontains=kwargs['region'], country=self.country)
-                        if query:
-                            self.region = query[0]
-                            changed = True
             del kwargs['region']
         if groups:
-            try:
-                groups = list(ContactGroup.objects.filter(id__in=groups))
-            except ValueError:
-                groups = list(ContactGroup.objects.filter(name__in=groups))
+            groups = lookups.groups( groups )
             if groups:
                 self.groups.add( *groups )
             for g in groups:
@@ -582,25 +816,54 @@ class Contact( DirtyFieldsMixin, models.Model ):
                 changed = True
 
         if self.pk:
-            self.update_extra_fields( **kwargs )
+            self.update_extra_fields( lookups=lookups, **kwargs )
 
         return changed
 
-    def update_extra_fields( self, **kwargs ):
+    def update_extra_fields( self, lookups=None, **kwargs ):
         """
         Settings extra fields requires the contact to be saved to the database
         before being able to set them, hence they are updated separately from the
         Contact's models fields.
+
+        Values are written in one go: existing values are fetched with one
+        query, missing ones are inserted with one query and the values
+        which differ are updated with one query.
         """
         extra_fields = self.get_allowed_extra_fields()
-        changed = False
+        requested = [field for field in kwargs if field in extra_fields]
+        if not requested:
+            return False
 
-        for field, val in kwargs.items():
-            if field in extra_fields:
-                self.set_extra_field( field, val )
-                changed = True
+        if lookups is None:
+            lookups = ContactLookups()
+        fields = lookups.fields()
 
-        return changed
+        values = {}
+        for field in requested:
+            if field in fields:
+                values[fields[field]] = kwargs[field]
+
+        if not values:
+            return False
+
+        existing = dict( ContactField.objects.filter( contact=self, field__in=values.keys() ).values_list( 'field_id', 'value' ) )
+
+        ContactField.objects.bulk_create( [
+            ContactField( field_id=field_id, contact=self, value=val )
+            for field_id, val in values.items() if field_id not in existing
+        ] )
+
+        changed = [( field_id, val ) for field_id, val in values.items() if field_id in existing and existing[field_id] != val]
+        if changed:
+            ContactField.objects.filter( contact=self, field_id__in=[field_id for field_id, val in changed] ).update(
+                value=models.Case( *[
+                    models.When( field_id=field_id, then=models.Value( val, output_field=models.CharField() ) )
+                    for field_id, val in changed
+                ] )
+            )
+
+        return True
 
     def __unicode__( self ):
         if self.first_name or self.last_name:
@@ -612,6 +875,44 @@ class Contact( DirtyFieldsMixin, models.Model ):
         else:
             return unicode( self.pk )
 
+    @classmethod
+    def update_group_order( cls, queryset=None ):
+        """
+        Set group_order to the minimum order of the contact's groups for all
+        contacts in queryset (default all contacts) in a single UPDATE.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+
+        min_order = cls.groups.through.objects.filter( contact=models.OuterRef( 'pk' ) ).order_by().values(
+            'contact' ).annotate( min_order=models.Min( 'contactgroup__order' ) ).values( 'min_order' )
+
+        return queryset.update( group_order=models.Subquery( min_order ) )
+
+    @classmethod
+    def groups_changed_callback( cls, sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs ):
+        """
+        Propagate ContactGroup.order to contacts when groups are added to or
+        removed from contacts.
+        """
+        if action == 'pre_clear' and reverse:
+            # The group's contacts are not known anymore after the clear
+            instance._cleared_contact_set = list( instance.contact_set.values_list( 'pk', flat=True ) )
+            return
+
+        if action not in ( 'post_add', 'post_remove', 'post_clear' ):
+            return
+
+        if not reverse:
+            pks = [instance.pk]
+        elif action == 'post_clear':
+            pks = instance.__dict__.pop( '_cleared_contact_set', [] )
+        else:
+            pks = list( pk_set or [] )
+
+        for i in range( 0, len( pks ), 1000 ):
+            cls.update_group_order( cls.objects.filter( pk__in=pks[i:i + 1000] ) )
+
     @classmethod
     def pre_delete_callback( cls, sender, instance=None, **kwargs ):
         """
@@ -634,16 +935,17 @@ class Contact( DirtyFieldsMixin, models.Model ):
             instance.email = instance.email.lower()
         instance._dirty_fields = instance.get_dirty_fields()
 
-        # Start a celery task to check if the groups have been changed.
+        # Schedule a celery task to check if the groups have been changed.
         # Ideally we would use m2m_changed signals, but at the moment Django
         # admin first clears then add the groups which makes it very hard
         # to identify changed groups. Instead we store the current groups' IDs
-        # and check if they have change when the task is run 20s later.
+        # (see PendingGroupCheck) and check if they have change when the task
+        # is run 20s later.
         # 20s is just an arbitrary value to give enough time for the contact to
         # be saved and the m2m relations saved to the DB
         # In case the contact is new we don't have the PK yet, so we store
-        # the groups in a instance attribute _initial_groups and call the
-        # task in the post_save
+        # the groups in a instance attribute _initial_groups and record
+        # them in the post_save
         if instance.pk:
             instance._initial_groups = list(instance.groups.values_list('id', flat=True))
         else:
@@ -663,12 +965,9 @@ class Contact( DirtyFieldsMixin, models.Model ):
         if dirty_fields != {}:
             contact_updated.send( sender=cls, instance=instance, dirty_fields=dirty_fields )
 
-        # Send task to check group changes, see pre_save_callback for details
+        # Schedule a check of the group changes, see pre_save_callback for details
         if instance and hasattr(instance, '_initial_groups'):
-            contactgroup_change_check.apply_async(
-                (instance._initial_groups, instance.pk, instance.email),
-                countdown=20,
-            )
+            PendingGroupCheck.schedule( instance.pk, instance._initial_groups, instance.email )
 
     def get_uid(self):
         '''
@@ -715,6 +1014,59 @@ class ContactField( models.Model ):
         unique_together = ( 'field', 'contact' )
 
 
+GROUP_CHECK_CACHE_KEY = 'djangoplicity.contacts.group_check_scheduled'
+
+
+class PendingGroupCheck( models.Model ):
+    """
+    Contact saved since the last group change check, with the groups it
+    belonged to before it was first saved and the email address of the
+    last save. Saving the same contact again only updates the entry, and one
+    contactgroup_change_check task checks all entries saved before it was
+    scheduled, instead of one task per save.
+    """
+    contact_id = models.IntegerField( unique=True )
+    groups = models.TextField( blank=True )
+    email = models.EmailField( blank=True )
+    last_saved = models.DateTimeField( db_index=True )
+
+    def get_groups( self ):
+        """
+        Get the list of group ids of the snapshot.
+        """
+        return [int( x ) for x in self.groups.split( ',' ) if x]
+
+    @classmethod
+    def schedule( cls, contact_id, groups, email ):
+        """
+        Record the groups of a contact before it was saved and make sure a
+        check is scheduled. The check is run CONTACT_GROUP_CHECK_DELAY
+        seconds (default 20) after the first save to give enough time for
+        the m2m relations to be saved.
+        """
+        now = datetime.now()
+        if not cls.objects.filter( contact_id=contact_id ).update( email=email, last_saved=now ):
+            try:
+                with transaction.atomic():
+                    cls.objects.create( contact_id=contact_id, groups=','.join( [str( x ) for x in groups] ), email=email, last_saved=now )
+            except IntegrityError:
+                # Entry was created in the meantime
+                cls.objects.filter( contact_id=contact_id ).update( email=email, last_saved=now )
+
+        cls.schedule_check()
+
+    @classmethod
+    def schedule_check( cls ):
+        """
+        Schedule a contactgroup_change_check task unless one is already
+        scheduled. The task clears the flag when it starts, the timeout only
+        matters if the task is lost.
+        """
+        delay = getattr( settings, 'CONTACT_GROUP_CHECK_DELAY', 20 )
+        if cache.add( GROUP_CHECK_CACHE_KEY, True, delay * 10 ):
+            contactgroup_change_check.apply_async( kwargs={ 'until': time.time() }, countdown=delay )
+
+
 # More advanced stuff - configurable actions to be execute once
 # contacts are added/removed from groups (e.g subscribe to mailman).
 
@@ -740,13 +1092,14 @@ class ContactGroupAction( models.Model ):
     on_event = models.CharField( max_length=50, choices=ACTION_EVENTS, db_index=True )
 
     _key = 'djangoplicity.contacts.action_cache'
+    _cache = VersionedCache( _key, lambda: ContactGroupAction.create_cache() )
 
     @classmethod
     def clear_cache( cls, *args, **kwargs ):
         """
-        Ensure cache is reset in case any change is made.
+        Ensure cache is reset in all processes in case any change is made.
         """
-        cache.delete( cls._key )
+        cls._cache.clear()
 
     @classmethod
     def create_cache( cls, *args, **kwargs ):
@@ -792,7 +1145,6 @@ class ContactGroupAction( models.Model ):
 
             # by event, group_pk = actions
 
-        cache.set( cls._key, action_cache )
         return action_cache
 
     @classmethod
@@ -802,14 +1154,11 @@ class ContactGroupAction( models.Model ):
 
         Caches results to prevent many queries to the database. Currently the entire
         table is cached, however in case of issues, this caching strategy can be improved.
-        """
-        action_cache = cache.get( cls._key )
-
-        # Prime cache if needed
-        if action_cache is None:
-            action_cache = cls.create_cache()
 
-        return action_cache
+        Each process keeps its own copy, so usually only the small version key
+        is fetched from the cache (see VersionedCache).
+        """
+        return cls._cache.get()
 
     @classmethod
     def get_actions_for_event( cls, on_event, group_pk=None ):
@@ -845,7 +1194,21 @@ class ContactGroupAction( models.Model ):
         """
         logger.debug( "contact %s added to group %s", contact.pk, group.pk )
         for a in cls.get_actions( group, on_event='contact_added' ):
-            a.dispatch( group=group, contact=contact )
+            batching.dispatch( a, 'contact_added', group, contact )
+
+    @classmethod
+    def contacts_added_callback( cls, sender=None, group=None, contacts=None, **kwargs ):
+        """
+        Callback handler for when several contacts are *added* to a group at
+        once. Will execute defined actions for this group for each contact.
+        """
+        actions = cls.get_actions( group, on_event='contact_added' )
+        logger.debug( "%d contacts added to group %s", len( contacts ), group.pk )
+        if not actions:
+            return
+        contacts = list( contacts )
+        for a in actions:
+            batching.dispatch_batch( a, 'contact_added', group, contacts )
 
     @classmethod
     def contact_removed_callback( cls, sender=None, group=None, contact=None, email=None, **kwargs ):
@@ -855,7 +1218,21 @@ class ContactGroupAction( models.Model ):
         """
         logger.debug( "contact %s removed from group %s", contact.pk, group.pk )
         for a in cls.get_actions( group, on_event='contact_removed' ):
-            a.dispatch( group=group, contact=contact, email=email )
+            batching.dispatch( a, 'contact_removed', group, contact, email=email )
+
+    @classmethod
+    def contacts_removed_callback( cls, sender=None, group=None, contacts=None, emails=None, **kwargs ):
+        """
+        Callback handler for when several contacts are *removed* from a group
+        at once. Will execute defined actions for this group for each contact.
+        """
+        actions = cls.get_actions( group, on_event='contact_removed' )
+        logger.debug( "%d contacts removed from group %s", len( contacts ), group.pk )
+        if not actions:
+            return
+        contacts = list( contacts )
+        for a in actions:
+            batching.dispatch_batch( a, 'contact_removed', group, contacts, emails )
 
     @classmethod
     def contact_updated_callback( cls, sender=None, instance=None, dirty_fields=None, **kwargs ):
@@ -988,10 +1365,13 @@ class ImportTemplate( models.Model ):
             self._mapping_cache = [x for x in ImportMapping.objects.filter( template=self )]
         return self._mapping_cache
 
-    def parse_row( self, incoming_data, as_list=False, flat=False, include_missing=False ):
+    def parse_row( self, incoming_data, as_list=False, flat=False, include_missing=False, resolvers=None ):
         """
         Transform the incoming data according to
         the defined data mapping.
+
+        When parsing many rows, pass the country and region resolvers from
+        get_resolvers() so they are validated once instead of for each row.
         """
         # TODO: this should be cleaned up to avoid the pylint warning
         # pylint: disable=too-many-nested-blocks
@@ -1000,7 +1380,7 @@ class ImportTemplate( models.Model ):
             for m in self.get_mapping():
                 field = str( m.get_field() )
                 try:
-                    val = m.get_value( incoming_data )
+                    val = m.get_value( incoming_data, resolvers=resolvers )
 
                     if as_list:
                         # Groups are a list of ids and are handled separetely
@@ -1051,13 +1431,83 @@ class ImportTemplate( models.Model ):
 
         return importercls( filename=filename )
 
+    def get_resolvers( self ):
+        """
+        Get snapshots of the country and region resolvers for parsing the
+        rows of an import file.
+        """
+        return ( country_resolver.snapshot(), region_resolver.snapshot() )
+
     def extract_data( self, filename ):
         """
         Extract data from an import file. Supported formats
         are currently, CSV and Excel (.xls).
+
+        For uploaded import files the parsed rows are cached next to the
+        file, so the file is only parsed once for the different stages of
+        an import. The cache is specific to the template revision.
+        """
+        if not getattr( settings, 'CONTACT_IMPORT_CACHE', True ) or \
+                os.path.dirname( os.path.abspath( filename ) ) != os.path.abspath( upload_dir ):
+            importer = self.get_importer( filename )
+            resolvers = self.get_resolvers()
+            return ( self.parse_row( row, resolvers=resolvers ) for row in importer )
+
+        cache_filename = '%s.%s.cache' % ( filename, self.revision() )
+        if not os.path.exists( cache_filename ):
+            self._write_data_cache( filename, cache_filename )
+        return self._read_data_cache( cache_filename )
+
+    def revision( self ):
+        """
+        Return a hash of the mappings, selectors and group mappings of the
+        template, which changes whenever the parsed data would.
+        """
+        mappings = [( m.pk, m.header, m.field, m.group_separator ) for m in self.get_mapping()]
+        selectors = [( s.header, s.value, s.case_sensitive ) for s in self.get_selectors()]
+        groupmappings = list( ImportGroupMapping.objects.filter( mapping__template=self ).order_by(
+            'pk' ).values_list( 'mapping_id', 'value', 'group_id' ) )
+        return hashlib.sha1( repr( ( mappings, selectors, groupmappings ) ) ).hexdigest()[:12]
+
+    def _write_data_cache( self, filename, cache_filename ):
+        """
+        Parse the import file and store the rows in chunks of pickled lists.
+
+        The rows are written to a unique temporary file which is renamed
+        once complete, so concurrent writers (e.g. the admin preview and the
+        import task) never publish a partial cache.
         """
-        importer = self.get_importer( filename )
-        return ( self.parse_row( row ) for row in importer )
+        clear_data_cache( filename, temporary=False )
+
+        dirname, basename = os.path.split( cache_filename )
+        fd, tmp_filename = tempfile.mkstemp( prefix='%s.' % basename, suffix='.tmp', dir=dirname )
+        try:
+            with os.fdopen( fd, 'wb' ) as f:
+                chunk = []
+                resolvers = self.get_resolvers()
+                for row in self.get_importer( filename ):
+                    chunk.append( self.parse_row( row, resolvers=resolvers ) )
+                    if len( chunk ) == IMPORT_CACHE_CHUNK_SIZE:
+                        pickle.dump( chunk, f, pickle.HIGHEST_PROTOCOL )
+                        chunk = []
+                if chunk:
+                    pickle.dump( chunk, f, pickle.HIGHEST_PROTOCOL )
+            # mkstemp creates the file readable by its owner only
+            os.chmod( tmp_filename, 0o644 )
+            os.rename( tmp_filename, cache_filename )
+        except Exception:
+            os.remove( tmp_filename )
+            raise
+
+    def _read_data_cache( self, cache_filename ):
+        with open( cache_filename, 'rb' ) as f:
+            while True:
+                try:
+                    chunk = pickle.load( f )
+                except EOFError:
+                    break
+                for row in chunk:
+                    yield row
 
     def preview_data( self, filename ):
         """
@@ -1066,9 +1516,10 @@ class ImportTemplate( models.Model ):
         """
         data_table = []
         i = 1  # Excel start with header at row 1
+        resolvers = self.get_resolvers()
         for row in self.get_importer( filename ):
             i += 1
-            data = self.parse_row( row, as_list=True, flat=True, include_missing=True )
+            data = self.parse_row( row, as_list=True, flat=True, include_missing=True, resolvers=resolvers )
             if data:
                 data.insert( 0, i )
                 data_table.append( data )
@@ -1189,21 +1640,37 @@ class ImportTemplate( models.Model ):
         extra_groups = list( self.extra_groups.all().values_list( 'name', flat=True ) )
         _frozen_set = set( self.frozen_groups.all().values_list( 'pk', flat=True ) )
 
-        i = 0
+        batch_size = getattr( settings, 'CONTACT_IMPORT_BATCH_SIZE', 500 )
+        added = {}
+        rows = []
+
+        def create_contacts( rows ):
+            for g, contacts in Contact.bulk_create_objects( rows, batch_size=batch_size ).items():
+                added.setdefault( g, [] ).extend( [obj.pk for obj in contacts] )
+            logger.info( "Created %d contacts", len( rows ) )
+
         for data in self.extract_data( filename ):
             if data:
-                i += 1
                 if 'groups' in data and data['groups']:
                     data['groups'] += extra_groups
                 else:
-                    data['groups'] = extra_groups
+                    data['groups'] = list( extra_groups )
 
                 # Add import group if needed
                 if import_grp:
                     data['groups'].append( import_grp.name )
 
-                obj = Contact.create_object( **data )
-                logger.info( "Creating contact %s", obj.pk )
+                rows.append( data )
+                if len( rows ) == batch_size:
+                    create_contacts( rows )
+                    rows = []
+
+        if rows:
+            create_contacts( rows )
+
+        # Notify once per group instead of once per contact
+        for g, pks in added.items():
+            contacts_added.send( sender=Contact, group=g, contacts=Contact.objects.filter( pk__in=pks ) )
 
     def import_data( self, import_contacts ):
         """
@@ -1250,19 +1717,22 @@ class ImportTemplate( models.Model ):
 
         duplicate_contacts = {}
         search_space = deduplication.contacts_search_space()
+        index = blocking.search_space_index(search_space)
+        exact = blocking.ExactKeyIndex(search_space)
+        top_k = getattr( settings, 'CONTACT_IMPORT_MAX_DUPLICATES', 10 )
 
         i = 1  # Excel start with header at row 1
         for data in self.extract_data( filename ):
             i += 1
             if data:
-                dups = deduplication.find_duplicates(data, search_space)
+                dups = deduplication.find_duplicates(data, search_space, index=index, top_k=top_k, exact=exact)
                 if not dups:
                     continue
 
                 # Create a dict of duplicate score with Contact id as key
                 keys = {}
                 for dup in dups:
-                    keys[dup[1]['contact_object'].pk] = dup[0]
+                    keys[dup[1].pk] = dup[0]
 
                 duplicate_contacts[i] = keys
 
@@ -1303,7 +1773,6 @@ class ImportMapping( models.Model ):
     field = models.SlugField( max_length=255 )
     group_separator = models.CharField( max_length=20, default='', blank=True )
 
-    _country_cache = None
     _groupmap_cache = None
 
     def save( self, *args, **kwargs ):
@@ -1330,45 +1799,15 @@ class ImportMapping( models.Model ):
         '''
         return Contact._meta.get_field(self.field)
 
-    def get_country_value( self, value ):
+    def get_country_value( self, value, resolver=None ):
         """
+        Get the primary key of the country matching value (ISO code, name or
+        similar name), or None.
         """
-        from djangoplicity.contacts.deduplication import similar_text
-
-        # Make country cache if it doesn't exists
-        if ImportMapping._country_cache is None:
-            ImportMapping._country_cache = { 'iso': {}, 'name': {} }
-            for c in Country.objects.all():
-                ImportMapping._country_cache['iso'][c.iso_code.lower()] = c.pk
-                ImportMapping._country_cache['name'][c.name.lower()] = c.pk
-
-        if not isinstance(value, unicode):
-            value = unicode(value)
-        value = value.lower().strip()
-        if len( value ) == 2 and value in ImportMapping._country_cache['iso']:
-            return ImportMapping._country_cache['iso'][value]
-        elif value in ImportMapping._country_cache['name']:
-            return ImportMapping._country_cache['name'][value]
-        else:
-            for k, v in ImportMapping._country_cache['name'].items():
-                if similar_text( k, value ):
-                    logger.info( "similar %s = %s", k, value )
-                    return v
-
-            for iso, exps in ISO_EXPANSION.items():
-                for e in exps:
-                    if similar_text( unicode( value ), e ):
-                        return ImportMapping._country_cache['iso'][iso.lower()]
-            return None
+        return ( resolver or country_resolver ).resolve( value )
 
-    def get_region_value(self, value, country_id):
-        if not value:
-            return None
-        queryset = Region.objects.filter(country=country_id) if country_id else Region.objects.all()
-        region = queryset.filter(code__iexact=value).first()
-        if not region:
-            region = queryset.filter(Q(name__istartswith=value) | Q(local_name__istartswith=value)).first()
-        return region.pk if region else None
+    def get_region_value(self, value, country_id, resolver=None):
+        return (resolver or region_resolver).resolve(value, country_id)
 
     def get_groups_value( self, value ):
         """
@@ -1384,12 +1823,14 @@ class ImportMapping( models.Model ):
 
         return filter( lambda x: x, map( lambda x: self._groupmap_cache.get( x, None ), values ) )
 
-    def get_value( self, data ):
+    def get_value( self, data, resolvers=None ):
         """
         Get the value for the model field. For most fields, this is just
         the direct value, however for groups and country there are special
-        processing going on.
+        processing going on. resolvers is an optional pair of country and
+        region resolvers (see ImportTemplate.get_resolvers).
         """
+        countries, regions = resolvers or ( None, None )
         try:
             val = data[self.header]
             if self.field:
@@ -1397,12 +1838,12 @@ class ImportMapping( models.Model ):
                 if trail[0] == 'groups':
                     return self.get_groups_value(val)
                 if trail[0] == 'country':
-                    return self.get_country_value(val)
+                    return self.get_country_value(val, countries)
                 if trail[0] == 'region':
                     # Try to get the country from the imported data to filter Regions inside that country
                     country = data.get('country', None) or data.get('Country', None)
-                    country_id = self.get_country_value(country)
-                    return self.get_region_value(val, country_id)
+                    country_id = self.get_country_value(country, countries)
+                    return self.get_region_value(val, country_id, regions)
                 if trail[0] == 'language':
                     if not isinstance(val, unicode):
                         val = unicode(val)
@@ -1469,6 +1910,26 @@ class ImportGroupMapping( models.Model ):
 upload_dir = os.path.join( settings.SHARED_DIR, 'contacts_import' )
 upload_fs = FileSystemStorage( location=upload_dir, base_url=None )
 
+IMPORT_CACHE_CHUNK_SIZE = 1000
+
+export_dir = os.path.join( settings.SHARED_DIR, 'contacts_export' )
+export_fs = FileSystemStorage( location=export_dir, base_url=None )
+
+
+def clear_data_cache( filename, temporary=True ):
+    """
+    Delete the parsed data caches of an import file, including the
+    temporary files of caches being written unless temporary is False.
+    """
+    dirname, basename = os.path.split( filename )
+    for name in os.listdir( dirname ):
+        if name.startswith( '%s.' % basename ) and '.cache' in name and \
+                ( temporary or not name.endswith( '.tmp' ) ):
+            try:
+                os.remove( os.path.join( dirname, name ) )
+            except OSError:
+                pass
+
 
 def handle_uploaded_file( instance, filename ):
     """
@@ -1571,6 +2032,7 @@ class Import( models.Model ):
         Delete any file stored on the object, when the object is being deleted.
         """
         try:
+            clear_data_cache( instance.data_file.path )
             instance.data_file.delete()
         except Exception:
             pass
@@ -1583,13 +2045,30 @@ class Deduplication(models.Model):
     status = models.CharField(max_length=20, choices=DEDUPLICATION_STATUS,
                 help_text='', default='new')
     last_deduplication = models.DateTimeField(null=True)
-    duplicate_contacts = models.TextField(blank=True)
-    deduplicated_contacts = models.TextField( blank=True )
     groups = models.ManyToManyField(ContactGroup, blank=True)
     max_display = models.IntegerField(default=25,
                     help_text='Maximum number of duplicates to display at once.')
     min_score_display = models.FloatField(default=0.7,
                             help_text='Only display duplicates with score above this score.')
+    max_duplicates = models.PositiveIntegerField(default=20, null=True, blank=True,
+                    help_text='Maximum number of duplicates kept for each contact (all if empty).')
+    incremental = models.BooleanField(default=False,
+                    help_text='Only look for duplicates of contacts created or modified since the last completed run.')
+    last_completed_run = models.DateTimeField(null=True, blank=True,
+                            help_text='Start time of the last completed run.')
+    run_started = models.DateTimeField(null=True, blank=True,
+                    help_text='Start time of the current run.')
+    checkpoint = models.IntegerField(null=True, blank=True,
+                    help_text='Last contact compared in the current run.')
+    processed_contacts = models.IntegerField(default=0)
+    total_contacts = models.IntegerField(default=0)
+    run_token = models.CharField(max_length=32, blank=True,
+                    help_text='Token of the task running the deduplication.')
+    heartbeat = models.DateTimeField(null=True, blank=True,
+                    help_text='Last time the running task saved its progress.')
+    run_resumed = models.DateTimeField(null=True, blank=True,
+                    help_text='Time the running task started or resumed the current run.')
+    resumed_contacts = models.IntegerField(default=0)
 
     def run(self):
         '''
@@ -1599,60 +2078,181 @@ class Deduplication(models.Model):
 
         Also, the user is responsible to set the import status and save it
         afterwards to ensure that it's marked as done.
+
+        In incremental mode only the contacts created or modified since the
+        last completed run are compared to the whole contacts DB, and the
+        results are merged in the stored duplicates.
+
+        The contacts are compared in chunks of CONTACT_DEDUPLICATION_CHECKPOINT
+        contacts, ordered by primary key. After each chunk the duplicates found
+        are saved along with the last compared contact, so an interrupted run
+        is resumed after this contact the next time it is run.
+
+        Only one task runs a deduplication at a time: returns False if
+        another task is running it (i.e. saved its progress less than
+        CONTACT_DEDUPLICATION_TIMEOUT seconds ago), or took it over.
         '''
+        token = self.claim()
+        if token is None:
+            logger.warning('Deduplication %s is already running', self.pk)
+            return False
 
-        duplicate_contacts = {}
-        search_space = deduplication.contacts_search_space()
+        try:
+            return self._run(token)
+        finally:
+            # Let the deduplication be run again at once if it failed
+            Deduplication.objects.filter(pk=self.pk, run_token=token).update(run_token='', heartbeat=None)
 
-        if self.groups.all():
-            contacts = Contact.objects.filter(groups__in=self.groups.all()).select_related('country').distinct()
-        else:
-            contacts = Contact.objects.all().select_related('country')
+    def claim(self):
+        '''
+        Mark the deduplication as being run by a new task, unless another
+        task is running it. Returns the token of the new task, or None.
+        '''
+        now = datetime.now()
+        timeout = timedelta(seconds=getattr(settings, 'CONTACT_DEDUPLICATION_TIMEOUT', 3600))
+        token = uuid.uuid4().hex
+
+        # Conditional update, so only one of concurrent tasks gets the row
+        claimed = Deduplication.objects.filter(pk=self.pk).filter(
+            Q(heartbeat__isnull=True) | Q(heartbeat__lt=now - timeout)).update(
+            run_token=token, heartbeat=now, run_resumed=now)
+        if not claimed:
+            return None
 
-        # Get set of known deduplicated contacts
-        deduplicated_contacts = set()
-        for d in Deduplication.objects.filter(status='review'):
-            if d.deduplicated_contacts:
-                deduplicated_contacts.update(json.loads(d.deduplicated_contacts))
+        self.refresh_from_db()
+        return token
 
-        for contact in contacts:
-            # Remove the current contact from the search space:
-            del search_space[contact.id]
+    def is_stalled(self):
+        '''
+        Returns True if the task running the deduplication stopped saving
+        its progress, e.g. because its worker was lost.
+        '''
+        timeout = timedelta(seconds=getattr(settings, 'CONTACT_DEDUPLICATION_TIMEOUT', 3600))
+        return self.heartbeat is not None and self.heartbeat < datetime.now() - timeout
 
-            dups = deduplication.find_duplicates(contact.get_data(), search_space)
+    def stalled_in(self):
+        '''
+        Returns the number of seconds until the task running the deduplication
+        is considered lost (see is_stalled), or None if no task is running it.
+        '''
+        if self.heartbeat is None:
+            return None
+        timeout = timedelta(seconds=getattr(settings, 'CONTACT_DEDUPLICATION_TIMEOUT', 3600))
+        return max(0, int((self.heartbeat + timeout - datetime.now()).total_seconds()) + 1)
+
+    def _run(self, token):
+        resume = self.checkpoint is not None
+        if resume:
+            started = self.run_started
+            logger.info('Resume deduplication %s after contact %s', self.pk, self.checkpoint)
+        else:
+            started = datetime.now()
 
-            if not dups:
-                continue
+        search_space = deduplication.contacts_search_space()
+        index = blocking.search_space_index(search_space)
+        exact = blocking.ExactKeyIndex(search_space)
 
-            # Create a dict of duplicate score with Contact id as key
-            keys = {}
-            for dup in dups:
-                duplicate_id = dup[1]['contact_object'].pk
-                if '%s_%s' % (contact.pk, duplicate_id) in deduplicated_contacts or \
-                    '%s_%s' % (duplicate_id, contact.pk) in deduplicated_contacts:
-                    # This pair was already deduplicated
-                    logger.info('Ignore deduplicated: %s, %s', contact.pk, duplicate_id)
-                    continue
-                keys[duplicate_id] = dup[0]
+        if self.groups.all():
+            contacts = Contact.objects.filter(groups__in=self.groups.all()).distinct()
+        else:
+            contacts = Contact.objects.all()
+
+        incremental = self.incremental and self.last_completed_run
+        if incremental:
+            contacts = contacts.filter(last_modified__gte=self.last_completed_run)
+
+        pks = list(contacts.order_by('pk').values_list('pk', flat=True))
+        workers = getattr(settings, 'CONTACT_DEDUPLICATION_WORKERS', 1)
+        chunk_size = getattr(settings, 'CONTACT_DEDUPLICATION_CHECKPOINT', 1000)
+
+        if not resume:
+            # Remove the pending pairs which will be looked for again, the pairs
+            # with a decision are kept. Pairs of deleted contacts are removed
+            # along with the contacts.
+            pending = self.pairs.filter(decision='')
+            if incremental:
+                pending = pending.filter(Q(contact_a__in=pks) | Q(contact_b__in=pks))
+            pending.delete()
+
+            self.run_started = started
+            self.checkpoint = 0
+
+        todo = [pk for pk in pks if pk > self.checkpoint]
+        self.total_contacts = len(pks)
+        self.processed_contacts = self.resumed_contacts = len(pks) - len(todo)
+        self.save(update_fields=['run_started', 'checkpoint', 'total_contacts', 'processed_contacts',
+            'resumed_contacts'])
 
-            if keys:
-                duplicate_contacts[contact.pk] = keys
+        # Get set of known deduplicated contacts
+        deduplicated_contacts = set(DuplicatePair.objects.filter(
+            deduplication__status='review').exclude(decision='').values_list(
+            'contact_a_id', 'contact_b_id'))
+        deduplicated_contacts.update(self.pairs.values_list('contact_a_id', 'contact_b_id'))
+
+        for i in range(0, len(todo), chunk_size):
+            chunk = todo[i:i + chunk_size]
+
+            # Deduplications can take many hours to complete, and we risk running
+            # into a 'MySQL server has gone away' error, so we close the DB
+            # connection, it will be automatically re-opened if necessary. This
+            # also prevents the worker processes from sharing the connection.
+            connection.close()
+
+            pairs = []
+            # Duplicates which would not be displayed are not stored
+            for contact_pk, dups in deduplication.find_all_duplicates(pks, search_space, index=index, workers=workers,
+                    top_k=self.max_duplicates, min_score=self.min_score_display, scan=chunk,
+                    exact=exact):
                 message = ''
-                for key in keys:
-                    message += '%d (%.2f), ' % (key, keys[key])
+                for ratio, duplicate_id in dups:
+                    if (contact_pk, duplicate_id) in deduplicated_contacts or \
+                        (duplicate_id, contact_pk) in deduplicated_contacts:
+                        # This pair was already deduplicated
+                        logger.info('Ignore deduplicated: %s, %s', contact_pk, duplicate_id)
+                        continue
+                    pairs.append(DuplicatePair(deduplication=self, contact_a_id=contact_pk,
+                                    contact_b_id=duplicate_id, score=ratio))
+                    message += '%d (%.2f), ' % (duplicate_id, ratio)
+
+                if message:
                     logger.info("Found duplicates for deduplication %s: %s", self.pk, message)
 
-        # Deduplications can take many hours to complete, and we risk running
-        # into a 'MySQL server has gone away' error, so we close the DB
-        # connection, it will be automatically re-opened if necessary
-        connection.close()
-
-        if duplicate_contacts:
-            self.duplicate_contacts = json.dumps(duplicate_contacts)
-            self.save()
+            # Save the duplicates along with the checkpoint, unless another
+            # task took the deduplication over (the update locks the row)
+            with transaction.atomic():
+                if not Deduplication.objects.filter(pk=self.pk, run_token=token).update(
+                        checkpoint=chunk[-1], processed_contacts=self.processed_contacts + len(chunk),
+                        heartbeat=datetime.now()):
+                    logger.warning('Deduplication %s was taken over by another task', self.pk)
+                    return False
+                DuplicatePair.objects.bulk_create(pairs, batch_size=1000)
+                self.checkpoint = chunk[-1]
+                self.processed_contacts += len(chunk)
+
+        if not Deduplication.objects.filter(pk=self.pk, run_token=token).update(
+                last_completed_run=started, checkpoint=None, run_token='', heartbeat=None):
+            return False
+        self.last_completed_run = started
+        self.checkpoint = None
+        self.run_token = ''
+        self.heartbeat = None
 
         return True
 
+    def estimated_completion(self):
+        '''
+        Estimate the end time of the current run from its progress since it
+        was started or resumed, returns None if the deduplication is not
+        running.
+        '''
+        processed = self.processed_contacts - self.resumed_contacts
+        if self.status != 'processing' or self.checkpoint is None or processed <= 0 or not self.run_resumed:
+            return None
+
+        now = datetime.now()
+        remaining = self.total_contacts - self.processed_contacts
+        return now + (now - self.run_resumed) * remaining / processed
+
     def review_data( self, page=1 ):
         """
         Returns the view of the potential found duplicates as well as the total
@@ -1660,80 +2260,58 @@ class Deduplication(models.Model):
         Only return max_display duplicates at a time
         """
         from djangoplicity.contacts.forms import ContactForm
-        duplicate_contacts = json.loads(self.duplicate_contacts) if self.duplicate_contacts else {}
 
-        # Load previously deduplicated contacts
-        deduplicated_contacts = set()
-        if self.deduplicated_contacts:
-            deduplicated_contacts.update(json.loads(self.deduplicated_contacts))
+        # Contacts with duplicates, without the ones already deduplicated
+        contact_ids = self.pairs.exclude(contact_a=F('contact_b')).exclude(
+            contact_a__in=self.pairs.filter(contact_a=F('contact_b')).exclude(
+                decision='').values('contact_a')
+        ).order_by('contact_a').values_list('contact_a', flat=True).distinct()
 
-        # Remove duplicated contacts
-        duplicate_contacts = dict([
-            (k, v) for k, v in duplicate_contacts.items()
-            if '%s_%s' % (k, k) not in deduplicated_contacts
-        ])
-
-        total_duplicates = len(duplicate_contacts)
+        total_duplicates = contact_ids.count()
 
         # Paginate
         start = (page - 1) * self.max_display
         end = page * self.max_display
-        duplicate_contacts = dict([
-            (k, v) for k, v in duplicate_contacts.items()
-        ][start:end])
+        contact_ids = list(contact_ids[start:end])
 
-        duplicates = []
+        pairs = self.pairs.filter(contact_a__in=contact_ids, score__gte=self.min_score_display).exclude(
+            contact_a=F('contact_b')).order_by('-score', '-contact_b').values_list(
+            'contact_a', 'contact_b', 'score')
+        duplicate_contacts = dict([(contact_id, []) for contact_id in contact_ids])
+        for contact_id, pk, score in pairs:
+            duplicate_contacts[contact_id].append((pk, score))
 
         # Prefetch Contacts
-        keys = []
-        for k, v in duplicate_contacts.items():
-            keys.append(k)
-            keys += v.keys()
+        keys = set(contact_ids)
+        for dups in duplicate_contacts.values():
+            keys.update([pk for pk, score in dups])
         contacts = Contact.objects.filter(pk__in=keys).prefetch_related(
             'groups', 'country').select_related('country', 'region')
-        contacts = dict([(str(c.pk), c) for c in contacts])
+        contacts = dict([(c.pk, c) for c in contacts])
 
-        for contact_id in duplicate_contacts:
-            try:
-                contact = contacts[contact_id]
-                fields = ('<a href="%s">%s</a>' % (url_reverse('admin:contacts_contact_change',
-                                args=[contact_id]), contact_id), )
-                form = ContactForm(instance=contact, prefix='%s_%s' % (contact_id, contact_id))
-            except KeyError:
-                fields = ('<span style="color: red;">Contact %s disappeared!</span>' % contact_id, )
-                contact = None
-                form = None
+        duplicates = []
 
+        for contact_id in contact_ids:
+            contact = contacts[contact_id]
             record = {
-                'fields': fields,
+                'fields': ('<a href="%s">%s</a>' % (url_reverse('admin:contacts_contact_change',
+                                args=[contact_id]), contact_id), ),
                 'contact_id': contact_id,
                 'contact': contact,
-                'form': form,
+                'form': ContactForm(instance=contact, prefix='%s_%s' % (contact_id, contact_id)),
             }
 
             dups = []
 
-            for pk, score in sorted(duplicate_contacts[contact_id].iteritems(),
-                    key=lambda(k, v): (v, k), reverse=True):
-
-                if score < self.min_score_display:
-                    continue
-
-                try:
-                    contact = contacts[pk]
-                    # Create a list of extra fields to display in the form
-                    fields = ('<a href="%s">%s</a> (%.2f)' % (url_reverse('admin:contacts_contact_change',
-                                args=[pk]), pk, score),)
-                    form = ContactForm(instance=contact, prefix='%s_%s' % (contact_id, pk))
-                except KeyError:
-                    fields = ('<span style="color: red">Contact %s disappeared! Please re-run deduplication</span>' % pk,)
-                    form = None
-
+            for pk, score in duplicate_contacts[contact_id]:
+                contact = contacts[pk]
                 dups.append({
-                    'fields': fields,
+                    # Create a list of extra fields to display in the form
+                    'fields': ('<a href="%s">%s</a> (%.2f)' % (url_reverse('admin:contacts_contact_change',
+                                args=[pk]), pk, score),),
                     'contact_id': pk,
                     'contact': contact,
-                    'form': form,
+                    'form': ContactForm(instance=contact, prefix='%s_%s' % (contact_id, pk)),
                 })
 
             record['duplicates'] = dups
@@ -1757,7 +2335,8 @@ class Deduplication(models.Model):
             except Contact.DoesNotExist:
                 resultlist['errors'].append(
                         'Couldn\'t delete Contact "%s", Contact doesn\'t exist!' % contact_id)
-            deduplicated_contacts.append(contact_id)
+            # There is no decision to store, the pairs of the deleted contact
+            # are removed along with it
 
         for contact, data in update.iteritems():
             form = data['form']
@@ -1766,22 +2345,63 @@ class Deduplication(models.Model):
             resultlist['messages'].append('Updated Contact <a href="%s">%s</a>' %
                     (url_reverse('admin:contacts_contact_change', args=[contact_id]), contact_id))
 
-            deduplicated_contacts.append(contact)
+            deduplicated_contacts.append((contact, 'update'))
 
         for contact in ignore:
             resultlist['messages'].append('Ignored Contact "%s"' % contact)
-            deduplicated_contacts.append(contact)
+            deduplicated_contacts.append((contact, 'ignore'))
 
-        if deduplicated_contacts:
-            old = json.loads(self.deduplicated_contacts) if self.deduplicated_contacts else []
-            self.deduplicated_contacts = json.dumps(deduplicated_contacts + old)
-            self.save()
+        for contact, decision in deduplicated_contacts:
+            contact_a, contact_b = contact.split('_')
+            DuplicatePair.objects.update_or_create(deduplication=self, contact_a_id=int(contact_a),
+                    contact_b_id=int(contact_b), defaults={'decision': decision})
 
         return resultlist
 
 
+DUPLICATE_DECISIONS = [
+    ( '', 'Pending' ),
+    ( 'update', 'Updated' ),
+    ( 'ignore', 'Ignored' ),
+]
+
+
+class DuplicatePair(models.Model):
+    '''
+    Potential duplicate found by a deduplication, and the decision taken
+    during the review. A decision on the reviewed contact itself is stored
+    with contact_a and contact_b set to the same contact.
+    '''
+    deduplication = models.ForeignKey(Deduplication, related_name='pairs')
+    contact_a = models.ForeignKey(Contact, related_name='+')
+    contact_b = models.ForeignKey(Contact, related_name='+')
+    score = models.FloatField(default=1.0)
+    decision = models.CharField(max_length=10, choices=DUPLICATE_DECISIONS, blank=True, default='')
+
+    class Meta:
+        unique_together = ('deduplication', 'contact_a', 'contact_b')
+        index_together = [
+            ('deduplication', 'decision'),
+            ('deduplication', 'contact_a', 'score'),
+        ]
+
+
 pre_delete.connect( Import.pre_delete_callback, sender=Import )
 
+# Connect signals to clear the extra fields cache
+post_delete.connect( Field.clear_cache, sender=Field )
+post_save.connect( Field.clear_cache, sender=Field )
+
+# Connect signals to clear the compiled label templates
+post_delete.connect( Label.clear_cache, sender=Label )
+post_save.connect( Label.clear_cache, sender=Label )
+
+# Connect signals to clear the country resolver cache
+post_delete.connect( Country.clear_cache, sender=Country )
+post_save.connect( Country.clear_cache, sender=Country )
+post_delete.connect( Region.clear_cache, sender=Region )
+post_save.connect( Region.clear_cache, sender=Region )
+
 # Connect signals to clear the action cache
 post_delete.connect( ContactGroupAction.clear_cache, sender=ContactGroupAction )
 post_save.connect( ContactGroupAction.clear_cache, sender=ContactGroupAction )
@@ -1800,8 +2420,11 @@ pre_delete.connect( ContactGroup.pre_delete_callback, sender=ContactGroup )
 post_delete.connect( ContactGroup.post_delete_callback, sender=ContactGroup )
 pre_save.connect( ContactGroup.pre_save_callback, sender=ContactGroup )
 post_save.connect( ContactGroup.post_save_callback, sender=ContactGroup )
+m2m_changed.connect( Contact.groups_changed_callback, sender=Contact.groups.through )
 
 # Connect signals handling the execution of actions
 contact_added.connect( ContactGroupAction.contact_added_callback, sender=Contact )
+contacts_added.connect( ContactGroupAction.contacts_added_callback, sender=Contact )
 contact_removed.connect( ContactGroupAction.contact_removed_callback, sender=Contact )
+contacts_removed.connect( ContactGroupAction.contacts_removed_callback, sender=Contact )
 contact_updated.connect( ContactGroupAction.contact_updated_callback, sender=Contact )
@@ -66,3 +66,5 @@ from django.dispatch import Signal
 contact_added = Signal( providing_args=[ "group", "contact", ] )
 contact_removed = Signal( providing_args=[ "group", "contact", "email" ] )
 contact_updated = Signal( providing_args=[ "instance", "dirty_fields", ] )  # Some field changed value
+contacts_added = Signal( providing_args=[ "group", "contacts", ] )  # Several contacts added at once (bulk import)
+contacts_removed = Signal( providing_args=[ "group", "contacts", "emails" ] )  # Several contacts removed at once
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# djangoplicity-contacts
+# Copyright (c) 2007-2015, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#
+#   * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#   * Neither the name of the European Southern Observatory nor the names
+#     of its contributors may be used to endorse or promote products derived
+#     from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+
+"""
+String similarity used by the contact deduplication.
+
+``ratio( a, b, limit )`` returns the same value as
+``difflib.SequenceMatcher( None, a, b ).ratio()``, which the thresholds of
+``deduplication.similar`` are tuned for, but avoids computing it when a
+cheap upper bound shows that it is below ``limit``. In that case 0.0 is
+returned, so that both ``ratio( a, b, limit ) > limit`` and
+``ratio( a, b, limit ) >= limit`` give the same result as with difflib.
+
+Upper bounds, from the cheapest:
+    * length bound (``2 * min( len ) / ( len( a ) + len( b ) )``),
+    * longest common subsequence ratio from a C implementation, if
+      ``rapidfuzz`` or ``python-Levenshtein`` is installed (the blocks
+      matched by difflib form a common subsequence, so this is never
+      lower than the difflib ratio),
+    * ``SequenceMatcher.quick_ratio`` (common characters).
+"""
+
+from __future__ import unicode_literals
+
+import difflib
+
+try:
+    from rapidfuzz.fuzz import ratio as _fuzz_ratio
+
+    def lcs_ratio( a, b ):
+        return _fuzz_ratio( a, b ) / 100.0
+except ImportError:
+    try:
+        from Levenshtein import ratio as lcs_ratio
+    except ImportError:
+        lcs_ratio = None
+
+# Tolerance for the floating point rounding of the C implementations.
+EPSILON = 1e-9
+
+
+def length_bound( a, b ):
+    """
+    Upper bound of the ratio of two strings from their lengths only.
+    """
+    la, lb = len( a ), len( b )
+    if not la + lb:
+        return 1.0
+    return 2.0 * min( la, lb ) / ( la + lb )
+
+
+def ratio( a, b, limit=0.0 ):
+    """
+    Return the difflib ratio of a and b, or 0.0 if it is below limit.
+    """
+    if a == b:
+        return 1.0
+
+    if length_bound( a, b ) < limit:
+        return 0.0
+
+    if lcs_ratio is not None and limit > 0:
+        try:
+            if lcs_ratio( a, b ) < limit - EPSILON:
+                return 0.0
+        except TypeError:
+            # E.g. python-Levenshtein does not accept mixed str/unicode
+            pass
+
+    seq = difflib.SequenceMatcher( None, a, b )
+    if seq.quick_ratio() < limit:
+        return 0.0
+    return seq.ratio()
@@ -31,8 +31,11 @@
 #
 
 import hashlib
+import operator
+import os
+import uuid
 from celery.task import PeriodicTask, task
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from django.apps import apps
 from django.conf import settings
@@ -40,6 +43,8 @@ from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
+from django.db.models import CharField, Q, Value
+from django.db.models.functions import Concat, Lower
 
 from djangoplicity.actions.plugins import ActionPlugin  # pylint: disable=E0611
 from djangoplicity.utils.history import add_admin_history  # pylint: disable=E0611
@@ -131,10 +136,17 @@ http://%s%s
                 message, msg_from, [email, msg_to])
 
 
-@task(ignore_result=True)
+@task(ignore_result=True, acks_late=True, max_retries=None)
 def run_deduplication(deduplication_pk, email):
     """
     Look for potential duplicates in groups selected in deduplication
+
+    The task is acknowledged once done, so it is run again if the worker
+    is lost, and the deduplication resumes from its last checkpoint.
+
+    The lost task still holds the deduplication until its heartbeat
+    expires (see Deduplication.claim), so the task is retried once it
+    has expired, as long as another task holds the deduplication.
     """
     logger = run_deduplication.get_logger()
 
@@ -142,6 +154,10 @@ def run_deduplication(deduplication_pk, email):
 
     dedup = Deduplication.objects.get( pk=deduplication_pk )
 
+    if run_deduplication.request.retries and dedup.status != 'processing':
+        # The task holding the deduplication completed it in the meantime
+        return
+
     if dedup.run():
         dedup.status = 'review'
         dedup.save()
@@ -161,49 +177,210 @@ http://%s%s
         msg_to = getattr(settings, 'CONTACT_IMPORT_NOTIFY', '')
         send_mail('Deduplication %s ready for review' % dedup.pk,
                 message, msg_from, [email, msg_to])
+    else:
+        dedup.refresh_from_db()
+        countdown = dedup.stalled_in()
+        if countdown is not None:
+            logger.warning( "Deduplication %s is held by another task, retry in %ss" % ( dedup.pk, countdown ) )
+            raise run_deduplication.retry( countdown=countdown )
 
 
-@task
-def contactgroup_change_check(old_groups_ids, contact_id, email):
+@task( ignore_result=True )
+def export_contacts( pks, file_format, email ):
+    """
+    Export contacts to a file in the export storage and send a download
+    link by email. pks is the ordered list of contact primary keys and
+    file_format an extension from djangoplicity.contacts.exporter.EXPORTERS,
+    XLS exports with too many rows are written to XLSX instead.
+    """
+    logger = export_contacts.get_logger()
+
+    from djangoplicity.contacts.exporter import get_exporter_class
+    from djangoplicity.contacts.models import Contact, export_dir
+
+    exporter_class = get_exporter_class( file_format, len( pks ) )
+    filename = 'contacts_%s_%s.%s' % ( datetime.now().strftime( '%Y%m%d%H%M%S' ), uuid.uuid4().hex[:8], exporter_class.extension )
+
+    if not os.path.exists( export_dir ):
+        os.makedirs( export_dir )
+
+    with open( os.path.join( export_dir, filename ), 'wb' ) as f:
+        Contact.export( pks, exporter_class( filename_or_stream=f, title='Contacts', header=Contact.get_export_header() ) )
+
+    logger.warning( "Exported %d contacts to %s" % ( len( pks ), filename ) )
+
+    # Send email to user:
+    site = Site.objects.get_current()
+    message = '''Dear User,
+
+The export of %d contacts is ready. You can download it at:
+http://%s%s
+
+''' % (len(pks), site.domain, reverse('admin:contacts_contact_export', args=[filename]))
+
+    msg_from = getattr(settings, 'DEFAULT_FROM_EMAIL', '')
+    send_mail('Contacts export %s ready' % filename, message, msg_from, [email])
+
+    return filename
+
+
+@task( ignore_result=True )
+def make_labels( label_pk, pks, email, token ):
+    """
+    Render the labels for the contacts with the given primary keys (in that
+    order) into a PDF in the export storage and send a download link by
+    email. The progress is stored in the cache under
+    LABEL_PROGRESS_CACHE_KEY % token.
+    """
+    logger = make_labels.get_logger()
+
+    from django.core.cache import cache
+    from djangoplicity.contacts import labels
+    from djangoplicity.contacts.models import Contact, Label, export_dir
+
+    label = Label.objects.get( pk=label_pk )
+    render = label.get_label_render()
+    key = labels.LABEL_PROGRESS_CACHE_KEY % token
+    total = render.page_count( len( pks ) )
+    filename = 'labels_%s_%s.pdf' % ( datetime.now().strftime( '%Y%m%d%H%M%S' ), token[:8] )
+
+    def progress( done, filename=None ):
+        cache.set( key, { 'done': done, 'total': total, 'filename': filename }, 60 * 60 * 24 )
+
+    def contacts():
+        # Fetch the contacts in chunks, keeping the order of pks
+        for i in range( 0, len( pks ), 1000 ):
+            chunk = Contact.objects.select_related( 'country' ).in_bulk( pks[i:i + 1000] )
+            for pk in pks[i:i + 1000]:
+                if pk in chunk:
+                    yield chunk[pk]
+
+    progress( 0 )
+
+    if not os.path.exists( export_dir ):
+        os.makedirs( export_dir )
+
+    with open( os.path.join( export_dir, filename ), 'wb' ) as f:
+        render.render_merged( contacts(), 'contact_labels.pdf', f,
+            pages=getattr( settings, 'CONTACT_LABEL_CHUNK_PAGES', 50 ),
+            processes=getattr( settings, 'CONTACT_LABEL_PROCESSES', None ),
+            progress=progress )
+
+    progress( total, filename=filename )
+    logger.warning( "Rendered %d labels to %s" % ( len( pks ), filename ) )
+
+    # Send email to user:
+    site = Site.objects.get_current()
+    message = '''Dear User,
+
+The labels "%s" for %d contacts are ready. You can download them at:
+http://%s%s
+
+''' % (label.name, len(pks), site.domain, reverse('admin:contacts_contact_export', args=[filename]))
+
+    msg_from = getattr(settings, 'DEFAULT_FROM_EMAIL', '')
+    send_mail('Labels %s ready' % filename, message, msg_from, [email])
+
+    return filename
+
+
+def _contactgroup_changes( pending, logger ):
+    """
+    Send the contact_added/contact_removed signals for a list of
+    (contact id, old group ids, email), with one query for the contacts,
+    one for their current groups and one for the groups.
+    """
+    from djangoplicity.contacts import batching
     from djangoplicity.contacts.models import Contact, ContactGroup
     from djangoplicity.contacts.signals import contact_added, contact_removed
+
+    ids = [contact_id for contact_id, dummy, dummy in pending]
+    contacts = Contact.objects.in_bulk( ids )
+
+    current = {}
+    for contact_id, group_id in Contact.groups.through.objects.filter( contact_id__in=ids ).values_list( 'contact_id', 'contactgroup_id' ):
+        current.setdefault( contact_id, set() ).add( group_id )
+
+    group_ids = set()
+    for contact_id, old_groups_ids, dummy in pending:
+        group_ids.update( old_groups_ids )
+        group_ids.update( current.get( contact_id, [] ) )
+    groups = ContactGroup.objects.in_bulk( group_ids )
+
+    with batching.batch_dispatch():
+        for contact_id, old_groups_ids, email in pending:
+            c = contacts.get( contact_id )
+            old_groups = set( [groups[pk] for pk in old_groups_ids if pk in groups] )
+
+            if c:
+                new_groups = set( [groups[pk] for pk in current.get( contact_id, [] ) if pk in groups] )
+                added = []
+                removed = []
+
+                for g in new_groups - old_groups:
+                    logger.info('Added "%s" to group "%s"', c, g)
+                    added.append(g.name)
+                    contact_added.send(sender=c.__class__, group=g, contact=c)
+
+                for g in old_groups - new_groups:
+                    logger.info('Removed "%s" from group "%s"', c, g)
+                    removed.append(g.name)
+                    contact_removed.send(sender=c.__class__, group=g, contact=c, email=email)
+
+                messages = []
+                if added:
+                    messages.append('Added to groups: %s' % (', '.join(added)))
+                if removed:
+                    messages.append('Removed from groups: %s' % (', '.join(removed)))
+
+                if messages:
+                    add_admin_history(c, ', '.join(messages))
+
+            else:
+                # Contact has disappeared, remove it from its group
+                for g in old_groups:
+                    logger.info('Remove disappeared contact "%s" from group "%s"', email, g)
+                    contact_removed.send(sender=c.__class__, group=g, contact=c, email=email)
+
+
+@task
+def contactgroup_change_check(old_groups_ids=None, contact_id=None, email=None, until=None):
+    """
+    Check the group changes of the contacts saved before until (a
+    timestamp) by PendingGroupCheck.schedule, in chunks of
+    CONTACT_GROUP_CHECK_CHUNK_SIZE contacts. A single contact can also be
+    checked by giving its id and old groups ids.
+    """
+    from django.core.cache import cache
+    from django.db import transaction
+    from djangoplicity.contacts.models import PendingGroupCheck, GROUP_CHECK_CACHE_KEY
     logger = contactgroup_change_check.get_logger()
-    try:
-        c = Contact.objects.get(id=contact_id)
-    except Contact.DoesNotExist:
-        c = None
 
-    old_groups = set(ContactGroup.objects.filter(id__in=old_groups_ids))
+    if contact_id is not None:
+        _contactgroup_changes([(contact_id, old_groups_ids or [], email)], logger)
+        return
 
-    if c:
-        new_groups = set(c.groups.all())
-        added = []
-        removed = []
+    # Contacts saved from now on will schedule a new check
+    cache.delete( GROUP_CHECK_CACHE_KEY )
 
-        for g in new_groups - old_groups:
-            logger.info('Added "%s" to group "%s"', c, g)
-            added.append(g.name)
-            contact_added.send(sender=c.__class__, group=g, contact=c)
+    until = datetime.fromtimestamp( until ) if until else datetime.now()
+    chunk_size = getattr( settings, 'CONTACT_GROUP_CHECK_CHUNK_SIZE', 1000 )
 
-        for g in old_groups - new_groups:
-            logger.info('Removed "%s" from group "%s"', c, g)
-            removed.append(g.name)
-            contact_removed.send(sender=c.__class__, group=g, contact=c, email=email)
+    while True:
+        # Claim a chunk of entries, a contact saved again in the meantime
+        # will get a new entry.
+        with transaction.atomic():
+            entries = list( PendingGroupCheck.objects.select_for_update().filter( last_saved__lte=until ).order_by( 'pk' )[:chunk_size] )
+            PendingGroupCheck.objects.filter( pk__in=[e.pk for e in entries] ).delete()
 
-        messages = []
-        if added:
-            messages.append('Added to groups: %s' % (', '.join(added)))
-        if removed:
-            messages.append('Removed from groups: %s' % (', '.join(removed)))
+        if not entries:
+            break
 
-        if messages:
-            add_admin_history(c, ', '.join(messages))
+        _contactgroup_changes( [( e.contact_id, e.get_groups(), e.email ) for e in entries], logger )
 
-    else:
-        # Contact has disappeared, remove it from its group
-        for g in old_groups:
-            logger.info('Remove disappeared contact "%s" from group "%s"', email, g)
-            contact_removed.send(sender=c.__class__, group=g, contact=c, email=email)
+    # Contacts saved after this check was scheduled
+    if PendingGroupCheck.objects.exists():
+        PendingGroupCheck.schedule_check()
 
 
 class PeriodicAction( PeriodicTask ):
@@ -533,11 +710,16 @@ class RemoveEmailAction( ContactAction ):
         ( 'clear', 'Clear the email field for all contacts with this email', 'bool' ),
         ( 'append', 'If clear is False, append the text in this field to contacts with this email (unless the field is empty)', 'str' ),
     ]
+    # Accepts the emails of several contacts in one task (see batching)
+    supports_batch = True
 
     @classmethod
     def get_arguments( cls, conf, *args, **kwargs ):
         """
         """
+        if 'emails' in kwargs:
+            return ( [], { 'emails': [e for e in kwargs['emails'] if e] } )
+
         try:
             email = kwargs['email']
         except KeyError:
@@ -545,21 +727,26 @@ class RemoveEmailAction( ContactAction ):
 
         return ( [], { 'email': email } )
 
-    def run( self, conf, email=None ):
+    def run( self, conf, email=None, emails=None ):
         """
         Remove from a group from a contact.
         """
         from djangoplicity.contacts.models import Contact
 
-        if email:
+        emails = [e for e in ( emails or [email] ) if e]
+
+        for i in range( 0, len( emails ), 500 ):
+            chunk = emails[i:i + 500]
+            contacts = Contact.objects.filter( reduce( operator.or_, [Q( email__iexact=e ) for e in chunk] ) )
+
             num = 0
             if conf['clear']:
-                num = Contact.objects.filter( email__iexact=email ).update( email='' )
+                num = contacts.update( email='' )
             elif conf['append']:
-                num = Contact.objects.filter( email__iexact=email ).update( email=email.lower() + conf['append'] )
+                num = contacts.update( email=Concat( Lower( 'email' ), Value( conf['append'] ), output_field=CharField() ) )
 
             if num > 0:
-                self.get_logger().info( "Removed invalid email address %s from %s contact(s)." % ( email, num ) )
+                self.get_logger().info( "Removed invalid email address %s from %s contact(s)." % ( ', '.join( chunk ), num ) )
 
 
 UnsetContactGroupAction.register()
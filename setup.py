@@ -43,9 +43,11 @@ setup(
         'django-crispy-forms==1.8.1',
         'django-dirtyfields==1.4.1',
         'hashids',
+        'PyPDF2',
         'trml2pdf==0.5.0',
         'xlrd',
         'xlwt',
+        'XlsxWriter',
     ],
 
     # metadata for upload to PyPI
@@ -219,8 +219,6 @@ def factory_deduplication(data):
     default = {
         'status': DEDUPLICATION_STATUS[0][0],
         'last_deduplication': None,
-        'duplicate_contacts': '',
-        'deduplicated_contacts': '',
         'max_display': 25,
         'min_score_display': 0.7
     }
@@ -1,5 +1,9 @@
 # coding=utf-8
+import csv
+
+from django.core import mail
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.admin.models import LogEntry
 from django.contrib.auth import get_user_model
 from django.test import Client
 from django.test.client import RequestFactory
@@ -8,13 +12,14 @@ from django.urls.base import reverse
 from djangoplicity.contrib.admin.sites import AdminSite
 
 from djangoplicity.contacts.admin import ContactAdmin
+from djangoplicity.contacts.exporter import ExcelExporter
 from djangoplicity.contacts.forms import ContactListAdminForm
-from djangoplicity.contacts.models import ImportTemplate, Import, Contact, ContactGroup
+from djangoplicity.contacts.models import ImportTemplate, Import, Contact, ContactGroup, export_fs
+from djangoplicity.contacts.tasks import export_contacts
 from tests.base import TestDeduplicationBase
 from tests.factories import factory_request_data, factory_invalid_data, factory_deduplication, \
     factory_deduplication_form, factory_label
 
-import json
 
 try:
     from mock import patch, MagicMock
@@ -136,8 +141,87 @@ class TestContactAdmin(TestDeduplicationBase):
         self.assertEqual(label_request['content-type'], 'application/pdf')
         self.assertEqual(excel_export['content-type'], 'application/vnd.ms-excel')
         self.assertIn('export_xls', actions)
+        self.assertIn('export_csv', actions)
         self.assertEqual(change_list_form_class, ContactListAdminForm)
 
+    @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async')
+    def test_contact_admin_set_group(self, contact_group_check_mock):
+        response = self.client.get(reverse('admin:contacts_label', kwargs={'pk': Contact.objects.first().id}))
+        request = response.wsgi_request
+        admin_instance = ContactAdmin(Contact, AdminSite())
+        group = ContactGroup.objects.get(name='Public NL')
+        members = list(group.contact_set.order_by('pk')[:3])
+        queryset = Contact.objects.filter(pk__in=[c.pk for c in members]).order_by('pk')
+        self.assertEqual(len(members), 3)
+
+        # The contacts are removed at once and the batch action gets all of them
+        action = MagicMock(pk=1, plugin='djangoplicity.contacts.tasks.RemoveEmailAction')
+        with patch('djangoplicity.contacts.models.ContactGroupAction.get_actions', return_value=[action]):
+            admin_instance.action_set_group(request=request, queryset=queryset, group=group, remove=True)
+
+        self.assertFalse(group.contact_set.filter(pk__in=queryset.values('pk')).exists())
+        action.dispatch.assert_called_once_with(group=group, contacts=members, emails=[c.email for c in members])
+        self.assertEqual(LogEntry.objects.filter(change_message='Removed from groups: Public NL',
+            object_id__in=[str(c.pk) for c in members], user=self.admin_user).count(), 3)
+
+        # Only the contacts which are not members yet are added
+        group.contact_set.add(members[0])
+        action.reset_mock()
+        with patch('djangoplicity.contacts.models.ContactGroupAction.get_actions', return_value=[action]):
+            admin_instance.action_set_group(request=request, queryset=queryset, group=group, remove=False)
+
+        self.assertEqual(group.contact_set.filter(pk__in=queryset.values('pk')).count(), 3)
+        action.dispatch.assert_called_once_with(group=group, contacts=members[1:])
+        self.assertEqual(LogEntry.objects.filter(change_message='Added to groups: Public NL').count(), 2)
+
+    def test_contact_export(self):
+        contact = Contact.objects.filter(groups__isnull=False).first()
+        pks = list(Contact.objects.order_by('-id').values_list('pk', flat=True))
+
+        # Large exports are run in the background
+        filename = export_contacts(pks, 'csv', 'admin@newsletters.org')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(reverse('admin:contacts_contact_export', args=[filename]), mail.outbox[0].body)
+
+        response = self.client.get(reverse('admin:contacts_contact_export', args=[filename]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['content-type'], 'text/csv')
+
+        rows = list(csv.DictReader(b''.join(response.streaming_content).splitlines()))
+        self.assertEqual(len(rows), len(pks))
+        self.assertEqual([int(r['id']) for r in rows], pks)
+        row = [r for r in rows if int(r['id']) == contact.pk][0]
+        self.assertEqual(row['email'], contact.email)
+        self.assertEqual(row['country'], contact.country.name if contact.country else '')
+        self.assertEqual(row['groups'], ', '.join(g.name for g in contact.groups.all()))
+        export_fs.delete(filename)
+
+        response = self.client.get(reverse('admin:contacts_contact_export', args=[filename]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_contact_export_xls_row_limit(self):
+        pks = list(Contact.objects.order_by('pk').values_list('pk', flat=True))
+
+        # XLS exports above the row limit of the format are written to XLSX
+        with patch.object(ExcelExporter, 'max_rows', len(pks) - 1):
+            filename = export_contacts(pks, 'xls', 'admin@newsletters.org')
+        self.assertTrue(filename.endswith('.xlsx'))
+        with export_fs.open(filename, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'PK'))
+        export_fs.delete(filename)
+
+        # and the admin action queues them as XLSX
+        response = self.client.get(reverse('admin:contacts_contact_changelist'))
+        request = response.wsgi_request
+        admin_instance = ContactAdmin(Contact, AdminSite())
+        with patch.object(ExcelExporter, 'max_rows', len(pks) - 1), \
+                patch('djangoplicity.contacts.admin.export_contacts.delay') as delay_mock, \
+                patch.object(admin_instance, 'message_user') as message_mock, \
+                self.settings(CONTACT_EXPORT_ASYNC_LIMIT=1):
+            self.assertIsNone(admin_instance.action_export_xls(None, request, Contact.objects.order_by('pk')))
+        delay_mock.assert_called_once_with(pks, 'xlsx', self.admin_user.email)
+        self.assertIn('XLS files are limited to', message_mock.call_args_list[0][0][1])
+
 
 class TestDeduplicationAdminViews(TestDeduplicationBase):
     instance = None
@@ -161,10 +245,14 @@ class TestDeduplicationAdminViews(TestDeduplicationBase):
     def test_deduplication_deduplicate_view(self):
         # Review and clean the POST data to be used by deduplicate_view
         self.instance.run()
-        duplicate_contacts = json.loads(self.instance.duplicate_contacts)
-        data = factory_deduplication_form(duplicate_contacts.items()[0:3], 'update')
-        data.update(factory_deduplication_form(duplicate_contacts.items()[3:6], 'ignore'))
-        data.update(factory_deduplication_form(duplicate_contacts.items()[6:], 'delete'))
+        duplicate_contacts = {}
+        for contact_a, contact_b, score in self.instance.pairs.order_by('contact_a').values_list(
+                'contact_a', 'contact_b', 'score'):
+            duplicate_contacts.setdefault(str(contact_a), {})[str(contact_b)] = score
+        duplicate_contacts = sorted(duplicate_contacts.items())
+        data = factory_deduplication_form(duplicate_contacts[0:3], 'update')
+        data.update(factory_deduplication_form(duplicate_contacts[3:6], 'ignore'))
+        data.update(factory_deduplication_form(duplicate_contacts[6:], 'delete'))
 
         response = self.client.post(
             reverse('admin:contacts_deduplication_review',
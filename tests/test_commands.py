@@ -1,7 +1,12 @@
 # coding=utf-8
+import csv
+import os
+import tempfile
+
 from django.core.management import call_command
 from django.test import TestCase
-from djangoplicity.contacts.models import Region
+from djangoplicity.contacts.exporter import StreamingCSVExporter
+from djangoplicity.contacts.models import Contact, ContactGroup, Region
 
 
 class CommandsTestCase(TestCase):
@@ -16,3 +21,58 @@ class CommandsTestCase(TestCase):
 
         regions_count = Region.objects.count()
         self.assertEqual(regions_count, 3107)
+
+
+class UpdateGroupOrderTestCase(TestCase):
+
+    def test_update_group_order(self):
+        g1 = ContactGroup.objects.create(name='g1', order=1)
+        g2 = ContactGroup.objects.create(name='g2', order=2)
+        c1 = Contact.objects.create()
+        c2 = Contact.objects.create()
+        c3 = Contact.objects.create()
+        c1.groups.add(g1, g2)
+        c2.groups.add(g2)
+
+        Contact.objects.update(group_order=5)
+        call_command('update_group_order')
+
+        self.assertEqual(Contact.objects.get(pk=c1.pk).group_order, 1)
+        self.assertEqual(Contact.objects.get(pk=c2.pk).group_order, 2)
+        self.assertIsNone(Contact.objects.get(pk=c3.pk).group_order)
+
+
+class ExportContactsTestCase(TestCase):
+
+    def setUp(self):
+        self.g1 = ContactGroup.objects.create(name='g1')
+        self.g2 = ContactGroup.objects.create(name='g2')
+        self.c1 = Contact.objects.create(first_name=u'J\xf6rg', email='jorg@example.com')
+        self.c2 = Contact.objects.create(first_name='Ann', email='ann@example.com')
+        self.c1.groups.add(self.g2, self.g1)
+        self.c2.groups.add(self.g2)
+
+    def test_export_contacts(self):
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            call_command('export_contacts', filename, group=['g1'])
+            with open(filename, 'rb') as f:
+                rows = list(csv.DictReader(f))
+        finally:
+            os.remove(filename)
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['id'], str(self.c1.pk))
+        self.assertEqual(rows[0]['first_name'].decode('utf-8'), u'J\xf6rg')
+        self.assertEqual(rows[0]['groups'], 'g1, g2')
+
+    def test_streaming_csv_exporter(self):
+        exporter = StreamingCSVExporter(header=Contact.get_export_header(), buffer_rows=1)
+        chunks = list(exporter.stream(Contact.export_data([self.c2.pk, self.c1.pk])))
+
+        # Rows are produced as soon as they are written
+        self.assertEqual(len(chunks), 2)
+        rows = list(csv.DictReader(''.join(chunks).splitlines()))
+        self.assertEqual([r['email'] for r in rows], ['ann@example.com', 'jorg@example.com'])
+        self.assertEqual(rows[0]['groups'], 'g2')
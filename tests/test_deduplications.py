@@ -1,6 +1,17 @@
+import difflib
+import itertools
+
 from django.test import TestCase
 
-from djangoplicity.contacts.deduplication import is_street, is_organisation, split_addresslines, split_name
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
+from djangoplicity.contacts import similarity
+from djangoplicity.contacts.blocking import BlockingIndex, ExactKeyIndex, exact_keys, soundex
+from djangoplicity.contacts.deduplication import is_street, is_organisation, split_addresslines, split_name, \
+    find_duplicates, find_all_duplicates, similar, SearchEntry
 
 
 class DeDuplicationsTestCase(TestCase):
@@ -45,3 +56,185 @@ class DeDuplicationsTestCase(TestCase):
             'street_1': '63344 Brooke Place Suite 507 nSouth Dale, DC 64431',
             'street_2': '709 Holland Street West Joseph Chester, IL 80579'
         })
+
+    def test_search_entry(self):
+        a = {'first_name': ' Jon ', 'last_name': 'DOE', 'email': 'Jon@Doe.org', 'street_1': 'Main  Road 1',
+             'city': 'Garching', 'country': 1}
+        b = {'first_name': 'John', 'last_name': 'Doe', 'email': 'jon@doe.org', 'street_1': 'Main Road 1',
+             'street_2': 'Building 2', 'city': 'garching', 'country': 1}
+
+        entry = SearchEntry(b, pk=2)
+        self.assertEqual(entry.pk, 2)
+        self.assertEqual(entry.last_name, 'doe')
+        self.assertEqual(entry.emails, ('jon@doe.org',))
+        # Only street_1 is compared as a has no street_2
+        self.assertEqual(entry.addresses[SearchEntry(a).street_mask], 'main road 1')
+
+        self.assertEqual(similar(a, b), similar(SearchEntry(a), entry))
+        self.assertEqual(similar(b, a), similar(entry, SearchEntry(a)))
+
+    def test_similar_limit(self):
+        a = SearchEntry({'first_name': 'Jon', 'last_name': 'Doe', 'email': 'jon@doe.org', 'city': 'Garching',
+                         'country': 1})
+        b = SearchEntry({'first_name': 'John', 'last_name': 'Doe', 'email': 'jon@doe.org', 'city': 'Garching',
+                         'country': 1})
+        c = SearchEntry({'first_name': 'Anna', 'last_name': 'Smith', 'city': 'Garching', 'country': 1})
+
+        # Pairs which can reach the limit are compared completely
+        self.assertEqual(similar(a, b, limit=0.74), similar(a, b))
+        # The comparison stops once the limit cannot be reached
+        with patch('djangoplicity.contacts.deduplication.similar_text') as similar_text_mock:
+            self.assertTrue(similar(a, c, limit=0.74) <= 0.74)
+        self.assertFalse(similar_text_mock.called)
+
+    def test_find_duplicates_top_k(self):
+        search_space = dict([
+            (pk, SearchEntry(data, pk=pk)) for pk, data in BlockingIndexTestCase.search_space.items()
+        ])
+        dups = find_duplicates(search_space[1], search_space, ratio_limit=0.5)
+        self.assertEqual([(ratio, s.pk) for ratio, s in dups], [(1.8, 1), (0.94, 2), (0.8, 3)])
+
+        self.assertEqual(find_duplicates(search_space[1], search_space, ratio_limit=0.5, top_k=2), dups[:2])
+        self.assertEqual(find_duplicates(search_space[1], search_space, ratio_limit=0.5, min_score=0.9), dups[:2])
+        self.assertEqual(find_duplicates(search_space[1], search_space, ratio_limit=0.5, top_k=0), [])
+
+    def test_find_all_duplicates(self):
+        search_space = dict([
+            (pk, SearchEntry(data, pk=pk)) for pk, data in BlockingIndexTestCase.search_space.items()
+        ])
+        pks = [3, 1, 2, 4, 5]
+
+        result = find_all_duplicates(pks, search_space)
+        # Each pair is only reported once, for the first contact in pks
+        self.assertEqual(result, [(3, [(0.8, 1)]), (1, [(0.94, 2)])])
+        self.assertEqual(find_all_duplicates(pks, search_space, workers=2), result)
+
+
+class BlockingIndexTestCase(TestCase):
+
+    search_space = {
+        1: {'first_name': 'Jon', 'last_name': 'Doe', 'email': 'jon@doe.org', 'country': 1, 'city': 'Garching'},
+        2: {'first_name': 'John', 'last_name': 'Doe', 'email': '', 'country': 1, 'city': 'Garching'},
+        3: {'first_name': 'Anna', 'last_name': 'Smith', 'email': 'JON@doe.org ', 'country': 2, 'city': 'Paris'},
+        4: {'first_name': 'Eva', 'last_name': 'Miller', 'email': 'eva@miller.org', 'country': 2, 'city': 'Paris'},
+        5: {'first_name': '', 'last_name': '', 'organisation': 'European Southern Observatory', 'country': 1,
+            'city': 'Garching'},
+    }
+
+    def test_soundex(self):
+        self.assertEqual(soundex('robert'), 'r163')
+        self.assertEqual(soundex('rupert'), 'r163')
+        self.assertEqual(soundex('ashcraft'), 'a261')
+        self.assertEqual(soundex('tymczak'), 't522')
+        self.assertEqual(soundex('m\xfcller'), soundex('muller'))
+
+    def test_candidates(self):
+        index = BlockingIndex(self.search_space)
+
+        # Same last name and same email (case insensitive)
+        self.assertEqual(index.candidates(self.search_space[1]), set([1, 2, 3]))
+        # Similar sounding last name
+        self.assertEqual(index.candidates({'last_name': 'Myller'}), set([4]))
+        # Organisations are blocked on their address
+        self.assertEqual(index.candidates({'organisation': 'European Southern Obs.', 'country': 1}), set([5]))
+        self.assertEqual(index.candidates({}), set())
+
+    def test_candidates_similar_email(self):
+        index = BlockingIndex(self.search_space)
+
+        # Emails with a typo in the local part or in the domain
+        self.assertEqual(index.candidates({'email': 'john@doe.org'}), set([1, 3]))
+        self.assertEqual(index.candidates({'email': 'eva@millr.org'}), set([4]))
+        self.assertEqual(index.candidates({'email': 'eva@miller.og'}), set([4]))
+        # Contacts without a last name are blocked on their first name
+        self.assertEqual(index.candidates({'first_name': 'Jonn'}), set())
+        index.add(6, {'first_name': 'Jon', 'last_name': ''})
+        self.assertEqual(index.candidates({'first_name': 'Jonn'}), set([6]))
+
+    def test_exact_keys(self):
+        self.assertEqual(exact_keys(self.search_space[1]), {'e:jon@doe.org': 0.8, 'n:doe:jon:1': 0.9})
+        self.assertEqual(exact_keys(self.search_space[5]), {})
+
+        index = ExactKeyIndex(self.search_space)
+        self.assertEqual(index.matches(self.search_space[1]), {1: 0.8 + 0.9, 3: 0.8})
+        self.assertEqual(index.matches({'first_name': 'Eva', 'last_name': 'Miller', 'country': 2}), {4: 0.9})
+        self.assertEqual(index.matches({'first_name': 'Eva', 'last_name': 'Miller'}), {})
+
+    def test_find_duplicates_with_exact_index(self):
+        index = BlockingIndex(self.search_space)
+        exact = ExactKeyIndex(self.search_space)
+        data = {'first_name': 'Jon', 'last_name': 'Doe', 'email': 'jon@doe.org', 'country': 1}
+
+        # The exact matches are not compared with similar()
+        with patch('djangoplicity.contacts.deduplication.similar', wraps=similar) as similar_mock:
+            dups = find_duplicates(data, self.search_space, index=index, exact=exact)
+        self.assertEqual([c[0][1] for c in similar_mock.call_args_list], [self.search_space[2]])
+        self.assertEqual(dups, [(1.7, self.search_space[1]), (0.84, self.search_space[2]), (0.8, self.search_space[3])])
+
+        # The exact matches fill the heap first
+        dups = find_duplicates(data, self.search_space, index=index, exact=exact, top_k=1)
+        self.assertEqual(dups, [(1.7, self.search_space[1])])
+
+        # Contacts sharing no exact key are compared as without the index
+        data = {'first_name': 'Eva', 'last_name': 'Myller', 'email': 'eva@millr.org'}
+        self.assertEqual(
+            find_duplicates(data, self.search_space, index=index, exact=exact),
+            find_duplicates(data, self.search_space, index=index)
+        )
+
+    def test_find_duplicates_with_index(self):
+        index = BlockingIndex(self.search_space)
+        data = dict(self.search_space[1])
+
+        self.assertEqual(
+            find_duplicates(data, self.search_space, index=index),
+            find_duplicates(data, self.search_space)
+        )
+
+
+def difflib_ratio(a, b, limit=0.0):
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+class SimilarityTestCase(TestCase):
+
+    strings = ['', 'jon', 'john', 'joan', 'jon doe', 'john doe', 's.doe', 'sam doe', 'jon@doe.org', 'john@doe.org',
+               'jon@doe.com', 'garching', 'garching b. munchen', 'karlsruhe', 'european southern observatory',
+               'european southern obs.', 'karl-schwarzschild-str. 2', 'karl-schwarzschild-strasse 2', 'abcabc', 'cba']
+
+    limits = [0.8, 0.85, 0.9, 0.95]
+
+    def assertParity(self):
+        for a, b in itertools.product(self.strings, repeat=2):
+            expected = difflib_ratio(a, b)
+            for limit in self.limits:
+                r = similarity.ratio(a, b, limit)
+                self.assertEqual(r > limit, expected > limit, (a, b, limit))
+                self.assertEqual(r >= limit, expected >= limit, (a, b, limit))
+                if r >= limit:
+                    self.assertEqual(r, expected)
+
+    def test_ratio(self):
+        self.assertEqual(similarity.ratio('jon doe', 'john doe'), difflib_ratio('jon doe', 'john doe'))
+        self.assertEqual(similarity.ratio('', ''), 1.0)
+        # Rejected by the length bound
+        self.assertEqual(similarity.ratio('jon', 'european southern observatory', 0.8), 0.0)
+        self.assertParity()
+
+    def test_ratio_without_lcs(self):
+        with patch.object(similarity, 'lcs_ratio', None):
+            self.assertParity()
+
+    def test_similar_parity(self):
+        entries = [SearchEntry(data, pk=pk) for pk, data in BlockingIndexTestCase.search_space.items()]
+        entries += [
+            SearchEntry({'first_name': 'S.', 'last_name': 'Doe', 'email': 'sdoe@doe.org', 'street_1': 'Main Road 1'}),
+            SearchEntry({'first_name': 'Sam', 'last_name': 'Doe', 'street_1': 'Main Road 1', 'street_2': 'B2'}),
+            SearchEntry({'organisation': 'European Southern Obs.', 'department': 'ePOD', 'city': 'Garching',
+                         'country': 1, 'street_1': 'Karl-Schwarzschild-Str. 2'}),
+        ]
+
+        scores = [similar(a, b) for a, b in itertools.product(entries, repeat=2)]
+        with patch('djangoplicity.contacts.deduplication.ratio', difflib_ratio):
+            expected = [similar(a, b) for a, b in itertools.product(entries, repeat=2)]
+        self.assertEqual(scores, expected)
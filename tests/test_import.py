@@ -1,16 +1,22 @@
 # coding=utf-8
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.db import models, transaction
+from django.db import connection, models, transaction
+from django.db.models import Q
 from djangoplicity.contacts.admin import ImportAdmin
 from djangoplicity.contacts.api.serializers import ImportSerializer
-from djangoplicity.contacts.models import Contact, ContactGroup, ImportTemplate, ImportMapping, \
-    ImportSelector, ImportGroupMapping, DataImportError, Import, Deduplication
+from djangoplicity.contacts.models import Contact, ContactGroup, Country, ImportTemplate, ImportMapping, \
+    ImportSelector, ImportGroupMapping, DataImportError, Import, Deduplication, Region
 from tests.base import BasicTestCase, TestDeduplicationBase
 from tests.factories import factory_import_selector, factory_request_data, factory_deduplication
+from djangoplicity.contacts import deduplication
+from djangoplicity.contacts.countries import CountryResolver, RegionResolver, country_resolver, region_resolver
 from djangoplicity.contacts.importer import CSVImporter, ExcelImporter
 from djangoplicity.contacts.tasks import prepare_import
+from datetime import datetime, timedelta
 import json
+import os
 from django.core import mail
+from django.core.cache import cache
 
 try:
     from mock import patch, MagicMock
@@ -51,6 +57,24 @@ class TestImportTemplate(BasicTestCase):
         self.assertEqual(row_3_email, 'joneskristen@hotmail.com')
         self.assertEqual(row_4_email, 'greenryan@hernandez.com')
 
+    def test_csv_importer_streaming(self):
+        """
+        Test CSV rows are read on demand and can be iterated several times
+        """
+        importer = CSVImporter(filename='./tests/data_sources/contacts.csv')
+        rows = list(importer)
+
+        self.assertTrue(rows)
+        self.assertEqual([r['Email'] for r in importer], importer['Email'])
+        self.assertEqual(rows[4].get('Email'), 'greenryan@hernandez.com')
+        self.assertIsNone(rows[4].get('Unknown column'))
+        self.assertRaises(KeyError, lambda: rows[4]['Unknown column'])
+        self.assertEqual(sorted(dict(rows[0]).keys()), sorted(importer.keys()))
+        self.assertRaises(IndexError, importer.row, 100)
+        self.assertEqual(dict(importer.row(-1)), dict(rows[-1]))
+        self.assertEqual(dict(importer.row(-100)), dict(rows[0]))
+        self.assertRaises(IndexError, importer.row, -101)
+
     def test_template_get_data_from_xls_file(self):
         """
         Test open xls import file
@@ -176,7 +200,50 @@ class TestImportTemplate(BasicTestCase):
 
             self.assertEqual(before_contacts, 0)
             self.assertEqual(after_contacts, 100)
-            self.assertEqual(contact_group_check_mock.call_count, 100)
+            self.assertEqual(contact_group_check_mock.call_count, 0)
+
+    @patch('djangoplicity.contacts.models.contacts_added.send')
+    def test_direct_import_data_bulk(self, contacts_added_mock):
+        """
+        Contacts are created in bulk and a single signal is sent per group
+        """
+        with self.settings(SITE_ENVIRONMENT='prod', CONTACT_IMPORT_BATCH_SIZE=30):
+            template = ImportTemplate.objects.get(name='TEST Contacts all')
+            template.direct_import_data('./tests/data_sources/contacts.xls')
+
+            groups = ContactGroup.objects.filter(contact__isnull=False).distinct()
+            self.assertEqual(Contact.objects.count(), 100)
+            self.assertEqual(contacts_added_mock.call_count, groups.count())
+            for call in contacts_added_mock.call_args_list:
+                group = call[1]['group']
+                self.assertEqual(set(call[1]['contacts']), set(group.contact_set.all()))
+
+            contact = Contact.objects.get(email='tracy77@hotmail.com')
+            self.assertEqual(contact.first_name, 'Angela')
+            self.assertEqual(contact.country_id, 7)
+            self.assertEqual(contact.region_id, 550)
+
+    @patch('djangoplicity.contacts.models.contacts_added.send')
+    def test_direct_import_data_without_bulk_ids(self, contacts_added_mock):
+        """
+        Contacts are inserted one by one on backends which can't return the
+        ids of bulk inserted rows (e.g. MySQL, SQLite)
+        """
+        with self.settings(SITE_ENVIRONMENT='prod'), \
+                patch.object(connection.features, 'can_return_ids_from_bulk_insert', False), \
+                patch.object(Contact.objects, 'bulk_create') as bulk_create_mock:
+            template = ImportTemplate.objects.get(name='TEST Contacts all')
+            template.direct_import_data('./tests/data_sources/contacts.xls')
+
+            self.assertFalse(bulk_create_mock.called)
+            self.assertEqual(Contact.objects.count(), 100)
+            self.assertFalse(Contact.objects.filter(Q(created__isnull=True) | Q(last_modified__isnull=True)).exists())
+            self.assertEqual(contacts_added_mock.call_count,
+                ContactGroup.objects.filter(contact__isnull=False).distinct().count())
+
+            contact = Contact.objects.get(email='tracy77@hotmail.com')
+            self.assertEqual(contact.first_name, 'Angela')
+            self.assertEqual(contact.region_id, 550)
 
     @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async', raw=True)
     def test_import_duplication_contacts_from_xml(self, contact_group_check_mock):
@@ -244,6 +311,85 @@ class TestImportMapping(BasicTestCase):
         self.assertIsNone(result6)
         self.assertIsNone(unknown)
 
+    def test_country_resolver(self):
+        resolver = CountryResolver(maxsize=2)
+        germany = Country.objects.get(iso_code='DE')
+
+        self.assertEqual(resolver.resolve('Deutchland'), germany.pk)
+        self.assertEqual(resolver.resolve(' GERMANY '), germany.pk)
+        self.assertIsNone(resolver.resolve('gArmany'))
+        self.assertEqual(resolver.exact('de'), germany.pk)
+        self.assertIsNone(resolver.exact('ermany'))
+
+        # Resolved values and misses are cached, up to maxsize values
+        with self.assertNumQueries(0):
+            self.assertIsNone(resolver.resolve('garmany'))
+        self.assertEqual(list(resolver._cache.keys()), ['germany', 'garmany'])
+
+        # Countries changed in another process are seen once it clears its resolver
+        self.addCleanup(country_resolver.clear)
+        Country.objects.bulk_create([Country(name='Garmany', iso_code='GY')])
+        self.assertIsNone(resolver.resolve('garmany'))
+        CountryResolver().clear()
+        self.assertIsNotNone(resolver.resolve('garmany'))
+        self.assertEqual(resolver.exact('gy'), Country.objects.get(iso_code='GY').pk)
+
+        # A snapshot keeps the countries without checking them in the cache
+        countries = resolver.snapshot()
+        Country.objects.filter(iso_code='GY').delete()
+        with patch('djangoplicity.contacts.caching.cache') as cache_mock:
+            self.assertIsNotNone(countries.resolve('garmany'))
+            self.assertEqual(countries.resolve('Deutchland'), germany.pk)
+            self.assertEqual(countries.get(germany.pk), germany)
+        self.assertFalse(cache_mock.method_calls)
+        self.assertIsNone(resolver.resolve('garmany'))
+
+    def test_parse_rows_resolvers(self):
+        template = ImportTemplate.objects.get(name='TEST Contacts all')
+        resolver_keys = ['djangoplicity.contacts.countries.version', 'djangoplicity.contacts.regions.version']
+
+        # The resolvers are validated once per file, not for each row
+        with patch('djangoplicity.contacts.caching.cache', wraps=cache) as cache_mock:
+            mapping, rows = template.preview_data('./tests/data_sources/contacts.xls')
+        self.assertEqual(len(rows), 100)
+        self.assertLessEqual(len([c for c in cache_mock.get.call_args_list if c[0][0] in resolver_keys]), 4)
+
+    def test_region_resolver(self):
+        resolver = RegionResolver()
+        germany = Country.objects.get(iso_code='DE')
+
+        # Code first, then first region in ordering by name or local name prefix
+        self.assertEqual(resolver.resolve('10', germany.pk), 544)
+        self.assertEqual(resolver.resolve('sax', germany.pk), 546)
+        self.assertEqual(resolver.resolve(u'Baden-W\xfc', germany.pk), 558)
+        self.assertEqual(resolver.resolve('Berlin', None), 556)
+        self.assertIsNone(resolver.resolve('Atlantis', germany.pk))
+        self.assertIsNone(resolver.resolve('', germany.pk))
+
+        # Once loaded, regions are resolved without queries
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve('hamburg', germany.pk), 553)
+            self.assertEqual(resolver.resolve('15', germany.pk), 543)
+
+        # Changing a region reloads the module-level resolver
+        self.addCleanup(region_resolver.clear)
+        mapping = ImportTemplate.objects.get(name='TEST Contacts all').importmapping_set.get(field='country')
+        self.assertIsNone(mapping.get_region_value('Neustadt', germany.pk))
+        Region.objects.create(name='Neustadt', local_name='Neustadt', code='99', country=germany)
+        self.assertIsNotNone(mapping.get_region_value('Neustadt', germany.pk))
+
+        # and the resolvers of the other processes
+        self.assertIsNotNone(resolver.resolve('Neustadt', germany.pk))
+
+        # A snapshot keeps the regions without checking them in the cache
+        regions = resolver.snapshot()
+        Region.objects.filter(name='Neustadt').delete()
+        with patch('djangoplicity.contacts.caching.cache') as cache_mock:
+            self.assertIsNotNone(regions.resolve('Neustadt', germany.pk))
+            self.assertEqual(regions.resolve('hamburg', germany.pk), 553)
+        self.assertFalse(cache_mock.method_calls)
+        self.assertIsNone(resolver.resolve('Neustadt', germany.pk))
+
 
 class TestImportSelectorModel(BasicTestCase):
 
@@ -433,6 +579,32 @@ class TestImportMethodsModel(BasicTestCase):
             self.assertEqual(len(mapping), 17)
             self.assertEqual(len(new), 100)
 
+    def test_extract_data_cache(self):
+        path = self.import_instance.data_file.path
+        cache_filename = '%s.%s.cache' % (path, self.template.revision())
+
+        # The temporary file of a concurrent writer is left alone
+        other_tmp_filename = '%s.other.tmp' % cache_filename
+        with open(other_tmp_filename, 'wb') as f:
+            f.write(b'partial')
+
+        rows = list(self.template.extract_data(path))
+        self.assertTrue(os.path.exists(cache_filename))
+        self.assertTrue(os.path.exists(other_tmp_filename))
+        self.assertEqual(list(self.template.extract_data(path)), rows)
+        self.assertEqual(len(rows), 100)
+
+        # Changing the template creates a new cache
+        ImportSelector.objects.create(template=self.template, header='Email', value='michael11@cox-ayala.com')
+        self.template.clear_selector_cache()
+        self.assertNotEqual('%s.%s.cache' % (path, self.template.revision()), cache_filename)
+        self.assertEqual(len([row for row in self.template.extract_data(path) if row]), 1)
+        self.assertFalse(os.path.exists(cache_filename))
+
+        self.import_instance.delete()
+        self.assertFalse(os.path.exists('%s.%s.cache' % (path, self.template.revision())))
+        self.assertFalse(os.path.exists(other_tmp_filename))
+
     @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async', raw=True)
     def test_import_data(self, contactgroup_change_check_mock):
         with self.settings(SITE_ENVIRONMENT='prod'):
@@ -467,10 +639,125 @@ class TestDeduplicationModel(TestDeduplicationBase):
         # Look for 10 duplicates contacts in the given groups
         response = instance.run()
         duplicates, total_duplicates = instance.review_data()
-        duplicate_contacts = json.loads(instance.duplicate_contacts)
+        duplicate_contacts = set(instance.pairs.values_list('contact_a', flat=True))
 
         self.assertTrue(response)
         self.assertEqual(len(duplicate_contacts), 10)
         self.assertEqual(len(duplicates), 10)
         self.assertEqual(total_duplicates, 10)
         self.assertIsInstance(instance, Deduplication)
+
+    def test_deduplication_max_duplicates(self):
+        instance = factory_deduplication({'max_duplicates': 1, 'min_score_display': 0.9})
+        instance.save()
+        instance.run()
+
+        contact_ids = instance.pairs.values_list('contact_a', flat=True)
+        self.assertEqual(len(contact_ids), len(set(contact_ids)))
+        self.assertFalse(instance.pairs.filter(score__lt=0.9).exists())
+
+    def test_deduplication_resume(self):
+        instance = factory_deduplication({})
+        instance.save()
+
+        # Interrupt the run after the first chunk of contacts
+        find_all_duplicates = deduplication.find_all_duplicates
+        chunks = []
+
+        def interrupted(*args, **kwargs):
+            chunks.append(kwargs['scan'])
+            if len(chunks) > 1:
+                raise RuntimeError('Worker lost')
+            return find_all_duplicates(*args, **kwargs)
+
+        with self.settings(CONTACT_DEDUPLICATION_CHECKPOINT=50), \
+                patch('djangoplicity.contacts.deduplication.find_all_duplicates', side_effect=interrupted):
+            self.assertRaises(RuntimeError, instance.run)
+
+        instance.refresh_from_db()
+        self.assertEqual(instance.checkpoint, chunks[0][-1])
+        self.assertEqual(instance.processed_contacts, 50)
+        self.assertEqual(instance.total_contacts, Contact.objects.count())
+        self.assertIsNone(instance.last_completed_run)
+
+        # The run is resumed after the checkpoint
+        with self.settings(CONTACT_DEDUPLICATION_CHECKPOINT=50), \
+                patch('djangoplicity.contacts.deduplication.find_all_duplicates',
+                      side_effect=find_all_duplicates) as find_mock:
+            instance.run()
+
+        self.assertTrue(all(pk > chunks[0][-1] for pk in find_mock.call_args_list[0][1]['scan']))
+        self.assertIsNone(instance.checkpoint)
+        self.assertEqual(instance.processed_contacts, instance.total_contacts)
+        self.assertIsNotNone(instance.last_completed_run)
+        self.assertEqual(len(set(instance.pairs.values_list('contact_a', flat=True))), 10)
+
+    def test_deduplication_single_run(self):
+        instance = factory_deduplication({'status': 'processing'})
+        instance.save()
+
+        # Another task is running the deduplication
+        Deduplication.objects.filter(pk=instance.pk).update(run_token='other', heartbeat=datetime.now())
+        self.assertFalse(instance.run())
+        self.assertFalse(instance.pairs.exists())
+        self.assertFalse(instance.is_stalled())
+
+        # The other task was lost, the deduplication is taken over
+        Deduplication.objects.filter(pk=instance.pk).update(heartbeat=datetime.now() - timedelta(days=1))
+        instance.refresh_from_db()
+        self.assertTrue(instance.is_stalled())
+        self.assertTrue(instance.run())
+        instance.refresh_from_db()
+        self.assertEqual(instance.run_token, '')
+        self.assertIsNone(instance.heartbeat)
+
+        # A task which was taken over stops at its next checkpoint
+        def taken_over(*args, **kwargs):
+            Deduplication.objects.filter(pk=instance.pk).update(run_token='other')
+            return []
+
+        with patch('djangoplicity.contacts.deduplication.find_all_duplicates', side_effect=taken_over):
+            self.assertFalse(instance.run())
+        instance.refresh_from_db()
+        self.assertEqual(instance.run_token, 'other')
+        self.assertEqual(instance.processed_contacts, 0)
+
+    def test_deduplication_estimated_completion(self):
+        now = datetime.now()
+        instance = factory_deduplication({'status': 'processing'})
+        instance.run_started = now - timedelta(days=1)
+        instance.checkpoint = 1
+        instance.total_contacts = 300
+        instance.save()
+        self.assertIsNone(instance.estimated_completion())
+
+        # Resumed an hour ago after 100 contacts, 100 more processed since
+        instance.run_resumed = now - timedelta(hours=1)
+        instance.resumed_contacts = 100
+        instance.processed_contacts = 200
+        estimate = instance.estimated_completion()
+        self.assertTrue(now + timedelta(minutes=59) < estimate < now + timedelta(minutes=61))
+
+    def test_deduplication_decisions(self):
+        instance = factory_deduplication({})
+        instance.save()
+        instance.run()
+
+        duplicates, total_duplicates = instance.review_data()
+        contact_id = duplicates[0]['contact_id']
+        duplicate_id = duplicates[0]['duplicates'][0]['contact_id']
+
+        # Ignored contacts are not reviewed again
+        instance.deduplicate_data({}, [], ['%s_%s' % (contact_id, contact_id)])
+        duplicates, total_duplicates = instance.review_data()
+        self.assertEqual(total_duplicates, 9)
+        self.assertNotIn(contact_id, [d['contact_id'] for d in duplicates])
+
+        # Decisions are kept when running again
+        instance.incremental = True
+        instance.run()
+        self.assertEqual(instance.review_data()[1], 9)
+
+        # Deleted contacts are removed from the review
+        instance.deduplicate_data({}, ['%s_%s' % (duplicate_id, duplicate_id)], [])
+        self.assertFalse(instance.pairs.filter(contact_b=duplicate_id).exists())
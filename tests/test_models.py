@@ -1,15 +1,20 @@
 # coding=utf-8
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
 from django.test import TestCase, Client
 from django.contrib.auth import get_user_model
 from djangoplicity.contacts.models import Label, LabelRender, Contact, Field, GroupCategory, CountryGroup, PostalZone, \
-    Country, Region, ContactGroup, ContactGroupAction
+    Country, Region, ContactGroup, ContactGroupAction, ContactField, ContactLookups, PendingGroupCheck
+from djangoplicity.contacts import batching
+from djangoplicity.contacts.batching import batch_dispatch
+from djangoplicity.contacts.countries import country_resolver
 from .factories import factory_label, factory_contact, \
     contacts_count, factory_field, factory_contact_group
 
 try:
-    from mock import patch, MagicMock
+    from mock import patch, MagicMock, ANY
 except ImportError:
-    from unittest.mock import patch, MagicMock
+    from unittest.mock import patch, MagicMock, ANY
 
 
 class LabelTestCase(TestCase):
@@ -82,6 +87,28 @@ class LabelTestCase(TestCase):
         self.assertIn('/contact_label_5000.pdf', file_path)
         self.assertIn("ReportLab Generated PDF document", render.content)
 
+    def test_label_template_cache(self):
+        """
+        Test that compiled label templates are reused until the label is saved.
+        """
+        label = factory_label({
+            "name": "Standard - 99.1x38.1",
+            "paper": "us-letter-5162",
+            "enabled": True,
+            "template": "{{ obj.email }}",
+            "style": "",
+        })
+        label.save()
+
+        template = label.get_label_render().document_template
+        self.assertIs(label.get_label_render().document_template, template)
+        # Renders without a label are not cached
+        self.assertIsNot(LabelRender(label.paper, label_template=label.template).document_template, template)
+
+        label.template = "{{ obj.first_name }}"
+        label.save()
+        self.assertIsNot(label.get_label_render().document_template, template)
+
 
 class FieldTestCase(TestCase):
     """
@@ -125,7 +152,7 @@ class FieldTestCase(TestCase):
         """
 
         # Reset Field cache
-        Field._allowed_fields = None
+        Field.clear_cache()
 
         # Add 5 extra fields
         for i in range(0, 5):
@@ -142,6 +169,44 @@ class FieldTestCase(TestCase):
         self.assertEqual(len(field_options), 5)
         self.assertIn("field-1", allow_fields)
 
+    def test_field_cache_invalidation(self):
+        """
+        Test that the fields cache is reloaded once a field is saved or deleted
+        """
+        Field.clear_cache()
+        before = Field.allowed_fields()
+
+        # The (possibly empty) list is reused
+        with self.assertNumQueries(0):
+            self.assertEqual(Field.allowed_fields(), before)
+
+        field = factory_field({
+            "slug": "field-x",
+            "name": "test field x"
+        })
+        field.save()
+        self.assertIn("field-x", Field.allowed_fields())
+
+        # Version changed by another process
+        cache.delete(Field._cache.version_key)
+        Field.objects.filter(pk=field.pk).update(slug="field-y")
+        self.assertIn("field-y", Field.allowed_fields())
+
+        field.delete()
+        self.assertEqual(sorted(Field.allowed_fields()), sorted(before))
+
+        # Without a shared cache the fields are loaded each time
+        with patch('djangoplicity.contacts.caching.cache', DummyCache('dummy', {})):
+            field = factory_field({
+                "slug": "field-z",
+                "name": "test field z"
+            })
+            field.save()
+            self.assertIn("field-z", Field.allowed_fields())
+            Field.objects.filter(pk=field.pk).update(slug="field-w")
+            self.assertIn("field-w", Field.allowed_fields())
+        Field.clear_cache()
+
 
 class LoadBasicDataTestCase(TestCase):
     """
@@ -191,6 +256,8 @@ class ContactTestCase(TestCase):
     after_contact_count = 0
 
     def setUp(self):
+        # Forget checks scheduled (with a mocked task) by previous tests
+        cache.clear()
         self.client = Client()
         self.admin_user = get_user_model().objects.create_superuser(
             username='admin',
@@ -236,8 +303,8 @@ class ContactTestCase(TestCase):
             "email": "larrydoe@mail.com"
         })
 
-        contact_group_check_mock.assert_called_with(
-            ([], 4000, 'larrydoe@mail.com'), countdown=20)
+        contact_group_check_mock.assert_called_with(kwargs={'until': ANY}, countdown=20)
+        self.assertEqual(PendingGroupCheck.objects.get(contact_id=4000).email, 'larrydoe@mail.com')
 
         contacts = Contact.objects.filter(email="larrydoe@mail.com")
 
@@ -254,7 +321,7 @@ class ContactTestCase(TestCase):
         Test Contact class methods
         """
         # Reset Field cache
-        Field._allowed_fields = None
+        Field.clear_cache()
 
         # Add extra fields
         for i in range(0, 5):
@@ -394,6 +461,72 @@ class ContactTestCase(TestCase):
         self.assertEqual(contact1.country.name, 'USA')
         self.assertEqual(contact1.region.name, 'New York')
 
+    @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async', raw=True)
+    def test_update_object_lookups(self, contact_group_check_mock):
+        factory_field({
+            "slug": "company-email",
+            "name": "Company Email"
+        }).save()
+        lookups = ContactLookups()
+        contact = Contact.create_object(groups=[200, 201], lookups=lookups, **{
+            "first_name": "Jhon",
+            "last_name": "Doe",
+            "email": "jhondoe@mail.com",
+            "company-email": "jhondoe@colacola.com",
+            'country': 'DE',
+            'region': 'Berlin',
+        })
+        self.assertEqual(contact.country.name, 'Germany')
+        self.assertEqual(contact.region.name, 'Berlin')
+        self.assertEqual(sorted(contact.groups.values_list('pk', flat=True)), [200, 201])
+        self.assertEqual(contact.get_extra_field('company-email'), 'jhondoe@colacola.com')
+
+        # Country, region and groups are resolved once per context
+        with self.assertNumQueries(0):
+            contact.update_object(lookups=lookups, country='DE', region='Berlin')
+            self.assertEqual(lookups.groups([200, 201]), lookups.groups(['200', '201']))
+
+        # Only the requested groups are loaded
+        lookups = ContactLookups()
+        with self.assertNumQueries(1):
+            self.assertEqual([g.pk for g in lookups.groups(['200'])], [200])
+        group = ContactGroup.objects.get(pk=201)
+        with self.assertNumQueries(1):
+            self.assertIn(group, lookups.groups([group.name]))
+        with self.assertNumQueries(0):
+            self.assertEqual(lookups.groups([]), [])
+
+        # Extra fields are not looked up without extra field values
+        with self.assertNumQueries(0):
+            self.assertFalse(contact.update_extra_fields(lookups=lookups, first_name='Jon'))
+
+        # Countries unknown to the resolver are looked up in the database
+        self.addCleanup(country_resolver.clear)
+        Country.objects.bulk_create([Country(name='Garmany', iso_code='GY')])
+        self.assertEqual(lookups.country('GY').name, 'Garmany')
+        self.assertEqual(lookups.country('garmany').iso_code, 'GY')
+        self.assertRaises(Country.DoesNotExist, lookups.country, 'Atlantis')
+
+        # Unchanged extra fields are only read, changed ones updated
+        with self.assertNumQueries(1):
+            contact.update_extra_fields(lookups=lookups, **{"company-email": "jhondoe@colacola.com"})
+        with self.assertNumQueries(2):
+            contact.update_extra_fields(lookups=lookups, **{"company-email": "jhondoe@pepsi.com"})
+        self.assertEqual(ContactField.objects.filter(contact=contact).count(), 1)
+        self.assertEqual(contact.get_extra_field('company-email'), 'jhondoe@pepsi.com')
+
+        # Several changed values are updated at once
+        factory_field({
+            "slug": "company-phone",
+            "name": "Company Phone"
+        }).save()
+        lookups = ContactLookups()
+        contact.update_extra_fields(lookups=lookups, **{"company-phone": "123"})
+        with self.assertNumQueries(2):
+            contact.update_extra_fields(lookups=lookups, **{"company-email": "jhondoe@fanta.com", "company-phone": "456"})
+        self.assertEqual(contact.get_extra_field('company-email'), 'jhondoe@fanta.com')
+        self.assertEqual(contact.get_extra_field('company-phone'), '456')
+
     @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async', raw=True)
     def test_unicode_contact_representation(self, contact_group_check_mock):
         """
@@ -629,6 +762,8 @@ class TestContactGroupAction(TestCase):
     fixtures = ['actions', 'initial']
 
     def setUp(self):
+        # Forget checks scheduled (with a mocked task) by previous tests
+        cache.clear()
         self.client = Client()
         self.admin_user = get_user_model().objects.create_superuser(
             username='admin',
@@ -659,8 +794,10 @@ class TestContactGroupAction(TestCase):
             self.assertTrue(task_contactgroup_change_check_mock.called)
             self.assertTrue(signal_contact_added_mock.called)
 
-            task_contactgroup_change_check_mock.assert_called_with(
-                ([], contact.id, 'jhondoe@mail.com'), countdown=20)
+            task_contactgroup_change_check_mock.assert_called_with(kwargs={'until': ANY}, countdown=20)
+            pending = PendingGroupCheck.objects.get(contact_id=contact.id)
+            self.assertEqual(pending.get_groups(), [])
+            self.assertEqual(pending.email, 'jhondoe@mail.com')
 
             signal_contact_added_mock.assert_called_with(
                 contact=contact, group=contact_group, sender=Contact
@@ -679,6 +816,22 @@ class TestContactGroupAction(TestCase):
         self.assertEqual(len(actions_for_group), 4)
         self.assertEqual(len(actions_for_event), 1)
 
+    def test_contact_group_action_cache(self):
+        """
+        Test that actions are looked up in the local copy while the version is unchanged
+        """
+        group = ContactGroup.objects.get(name='Public NL')
+        ContactGroupAction.get_actions(group)
+
+        with self.assertNumQueries(0), patch.object(cache, 'get', wraps=cache.get) as cache_get_mock:
+            actions = ContactGroupAction.get_actions(group, on_event='contact_added')
+        cache_get_mock.assert_called_once_with(ContactGroupAction._cache.version_key)
+        self.assertEqual(len(actions), 1)
+
+        # Changes are seen by the next lookup
+        ContactGroupAction.objects.filter(group=group, on_event='contact_added').delete()
+        self.assertEqual(ContactGroupAction.get_actions(group, on_event='contact_added'), [])
+
     @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async')
     def test_contact_added_callback(self, task_contact_group_change_check_mock):
         """
@@ -799,3 +952,27 @@ class TestContactGroupAction(TestCase):
                 },
                 instance=contact
             )
+
+    def test_batch_dispatch(self):
+        """
+        Test actions are dispatched once per group and action in a batch
+        """
+        group = ContactGroup.objects.get(name='Public NL')
+        contacts = [Contact(pk=i, email='contact%d@mail.com' % i) for i in range(3)]
+        action = MagicMock(pk=1, plugin='djangoplicity.mailinglists.tasks.mailchimp_actions.MailChimpSubscribeAction')
+
+        with patch('djangoplicity.contacts.batching.supports_batch', return_value=True):
+            with batch_dispatch():
+                for contact in contacts:
+                    batching.dispatch(action, 'contact_added', group, contact)
+                self.assertFalse(action.dispatch.called)
+            action.dispatch.assert_called_once_with(group=group, contacts=contacts)
+
+        # Plugins without batch support are dispatched for each contact
+        action.reset_mock()
+        with patch('djangoplicity.contacts.batching.supports_batch', return_value=False):
+            with batch_dispatch():
+                for contact in contacts:
+                    batching.dispatch(action, 'contact_removed', group, contact, email=contact.email)
+            self.assertEqual(action.dispatch.call_count, 3)
+            action.dispatch.assert_called_with(group=group, contact=contacts[2], email='contact2@mail.com')
@@ -1,12 +1,19 @@
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test.testcases import TransactionTestCase
-from djangoplicity.contacts.models import Import, ImportTemplate, Contact, ContactGroup
+from celery.exceptions import Retry
+from djangoplicity.contacts.models import Import, ImportTemplate, Contact, ContactGroup, PendingGroupCheck, \
+    Deduplication
 from djangoplicity.contacts.tasks import direct_import_data, import_data, run_deduplication, contactgroup_change_check, \
-    EveryDayAction
+    EveryDayAction, RemoveEmailAction, make_labels
+from djangoplicity.contacts import labels
+from djangoplicity.contacts.models import export_fs
 from tests.base import TestDeduplicationBase, BasicTestCase, BaseContactTestCase
-from tests.factories import factory_request_data, factory_deduplication, factory_contact, factory_contact_group
+from tests.factories import factory_request_data, factory_deduplication, factory_contact, factory_contact_group, \
+    factory_label
 from django.core import mail
-import json
+from datetime import datetime, timedelta
+import time
 
 try:
     from mock import patch, MagicMock
@@ -29,6 +36,7 @@ class ImportTaskTestCase(TransactionTestCase):
     filepath = "./tests/data_sources/contacts.xls"
 
     def setUp(self):
+        cache.clear()
         with open(self.filepath) as contacts_file:
             self.template = ImportTemplate.objects.get(name='TEST Contacts all')
             self.data = {
@@ -46,9 +54,9 @@ class ImportTaskTestCase(TransactionTestCase):
             # Run contacts import in the background and run MailChimp Subscribe Action
             direct_import_data(self.instance.pk)
 
-            self.assertTrue(contact_group_check_mock.called)
+            # The actions are dispatched without checking each contact's groups
+            self.assertFalse(contact_group_check_mock.called)
             self.assertTrue(mailchimp_subscribe_action_mock.called)
-            self.assertEqual(contact_group_check_mock.call_count, 100)
 
     @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async', raw=True)
     def test_import_data_task(self, contact_group_check_mock):
@@ -72,7 +80,7 @@ class DeduplicationTaskTestCase(TestDeduplicationBase):
             instance.refresh_from_db()
 
             duplicates, total_duplicates = instance.review_data()
-            duplicate_contacts = json.loads(instance.duplicate_contacts)
+            duplicate_contacts = set(instance.pairs.values_list('contact_a', flat=True))
 
             self.assertEqual(len(duplicate_contacts), 10)
             self.assertEqual(len(duplicates), 10)
@@ -81,6 +89,46 @@ class DeduplicationTaskTestCase(TestDeduplicationBase):
             self.assertEqual(mail.outbox[0].subject,
                              'Deduplication %s ready for review' % instance.pk)
 
+    def test_run_deduplication_task_redelivered(self):
+        instance = factory_deduplication({'status': 'processing'})
+        instance.save()
+
+        # The worker running the task was lost after a checkpoint, the task
+        # is redelivered while the heartbeat of the lost task is still fresh
+        Deduplication.objects.filter(pk=instance.pk).update(run_token='lost', heartbeat=datetime.now(),
+            run_started=datetime.now(), checkpoint=0)
+        with self.settings(CONTACT_DEDUPLICATION_TIMEOUT=600), \
+                patch('djangoplicity.contacts.tasks.run_deduplication.retry', return_value=Retry()) as retry_mock:
+            with self.assertRaises(Retry):
+                run_deduplication(instance.id, 'admin@djangoplicity.com')
+        countdown = retry_mock.call_args[1]['countdown']
+        self.assertTrue(590 < countdown <= 601)
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, 'processing')
+        self.assertEqual(len(mail.outbox), 0)
+
+        # The retried task runs once the heartbeat has expired
+        Deduplication.objects.filter(pk=instance.pk).update(heartbeat=datetime.now() - timedelta(days=1))
+        run_deduplication.push_request(retries=1)
+        try:
+            run_deduplication(instance.id, 'admin@djangoplicity.com')
+        finally:
+            run_deduplication.pop_request()
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, 'review')
+        self.assertEqual(instance.run_token, '')
+        self.assertEqual(len(set(instance.pairs.values_list('contact_a', flat=True))), 10)
+        self.assertEqual(len(mail.outbox), 1)
+
+        # A retried task stops if the deduplication was completed meanwhile
+        with patch.object(Deduplication, 'run') as run_mock:
+            run_deduplication.push_request(retries=2)
+            try:
+                run_deduplication(instance.id, 'admin@djangoplicity.com')
+            finally:
+                run_deduplication.pop_request()
+        self.assertFalse(run_mock.called)
+
 
 class ContactTaskTestCase(TransactionTestCase):
     fixtures = ['actions', 'initial']
@@ -124,6 +172,55 @@ class ContactTaskTestCase(TransactionTestCase):
         )
         self.assertEqual(contact_added_mock.call_count, 4)
 
+    @patch('djangoplicity.contacts.signals.contact_removed.send')
+    @patch('djangoplicity.contacts.signals.contact_added.send')
+    @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async')
+    def test_contact_group_change_check_pending(self, task_mock, contact_added_mock, contact_removed_mock):
+        """Test that repeated saves are checked once by one task."""
+        cache.clear()
+        for i in range(200, 203):
+            factory_contact_group({'id': i, 'name': 'Test Group %s' % i, 'order': 1}).save()
+
+        contact = Contact.create_object(groups=[200, 201], **{
+            "first_name": "Jon",
+            "last_name": "Doe",
+            "email": "jhondoe@mail.com"
+        })
+        other = Contact.create_object(groups=[200], **{
+            "first_name": "Jane",
+            "last_name": "Doe",
+            "email": "janedoe@mail.com"
+        })
+        self.assertEqual(contact_added_mock.call_count, 3)
+
+        # Saved again, the entry keeps the groups before the first save
+        contact.email = 'jondoe@mail.com'
+        contact.save()
+        contact.groups.remove(200)
+        contact.groups.add(202)
+        contact.save()
+
+        self.assertEqual(task_mock.call_count, 1)
+        self.assertEqual(PendingGroupCheck.objects.count(), 2)
+        pending = PendingGroupCheck.objects.get(contact_id=contact.pk)
+        self.assertEqual(pending.get_groups(), [])
+        self.assertEqual(pending.email, 'jondoe@mail.com')
+
+        other.delete()
+        contact_removed_mock.reset_mock()
+        contact_added_mock.reset_mock()
+
+        # Run the scheduled check
+        contactgroup_change_check(until=time.time())
+
+        self.assertFalse(PendingGroupCheck.objects.exists())
+        self.assertEqual(
+            sorted(kw['group'].pk for dummy, kw in contact_added_mock.call_args_list),
+            [201, 202]
+        )
+        # The deleted contact was not in any group when first saved
+        self.assertFalse(contact_removed_mock.called)
+
 
 class UpdateContactActionTestCase(BaseContactTestCase):
     # test update contact celery task
@@ -148,3 +245,87 @@ class UpdateContactActionTestCase(BaseContactTestCase):
             self.assertEqual(mailchimp_update_action_mock.call_count, 1)
             self.assertEqual(mailchimp_subscribe_action_mock.call_count, 1)
 
+
+class RemoveEmailActionTestCase(BaseContactTestCase):
+    fixtures = ['actions', 'initial']
+
+    def test_run_batch(self):
+        contacts = [self.create_contact({'email': 'invalid%d@mail.com' % i}) for i in range(3)]
+        other = self.create_contact({'email': 'valid@mail.com'})
+        conf = {'clear': False, 'append': '-INVALID'}
+
+        self.assertTrue(RemoveEmailAction.supports_batch)
+        args, kwargs = RemoveEmailAction.get_arguments(conf, group=None, contacts=contacts,
+            emails=[c.email.upper() for c in contacts] + [''])
+        self.assertEqual(kwargs, {'emails': ['INVALID0@MAIL.COM', 'INVALID1@MAIL.COM', 'INVALID2@MAIL.COM']})
+
+        RemoveEmailAction().run(conf, *args, **kwargs)
+        self.assertEqual(sorted(Contact.objects.filter(pk__in=[c.pk for c in contacts]).values_list('email', flat=True)),
+            ['invalid0@mail.com-INVALID', 'invalid1@mail.com-INVALID', 'invalid2@mail.com-INVALID'])
+        self.assertEqual(Contact.objects.get(pk=other.pk).email, 'valid@mail.com')
+
+        # Single contacts are still supported
+        args, kwargs = RemoveEmailAction.get_arguments({'clear': True, 'append': ''}, email='valid@mail.com')
+        RemoveEmailAction().run({'clear': True, 'append': ''}, *args, **kwargs)
+        self.assertEqual(Contact.objects.get(pk=other.pk).email, '')
+
+
+
+class LabelTaskTestCase(TransactionTestCase):
+    fixtures = ['actions', 'initial']
+
+    @patch('djangoplicity.contacts.tasks.contactgroup_change_check.apply_async')
+    def test_make_labels(self, contact_group_check_mock):
+        label = factory_label({
+            "name": "Standard - 99.1x38.1",
+            "paper": "us-letter-5162",
+            "enabled": True,
+            "repeat": 5
+        })
+        label.save()
+        pks = []
+        for i in range(4):
+            contact = factory_contact({
+                "first_name": "Jhon %s" % i,
+                "last_name": "Doe",
+                "email": "jhondoe%s@mail.com" % i
+            })
+            contact.save()
+            pks.append(contact.pk)
+
+        with self.settings(CONTACT_LABEL_CHUNK_PAGES=1):
+            filename = make_labels(label.pk, pks, 'admin@newsletters.org', 'abcdef0123456789')
+
+        # 20 labels on pages of 14 labels
+        progress = cache.get(labels.LABEL_PROGRESS_CACHE_KEY % 'abcdef0123456789')
+        self.assertEqual(progress, {'done': 2, 'total': 2, 'filename': filename})
+        self.assertTrue(export_fs.exists(filename))
+        with export_fs.open(filename, 'rb') as f:
+            self.assertTrue(f.read().startswith('%PDF'))
+        self.assertEqual(len(mail.outbox), 1)
+        export_fs.delete(filename)
+
+        # The chunks can be rendered in a pool of processes
+        with self.settings(CONTACT_LABEL_CHUNK_PAGES=1, CONTACT_LABEL_PROCESSES=2):
+            filename = make_labels(label.pk, pks, 'admin@newsletters.org', 'abcdef0123456789')
+        self.assertEqual(cache.get(labels.LABEL_PROGRESS_CACHE_KEY % 'abcdef0123456789'),
+            {'done': 2, 'total': 2, 'filename': filename})
+        with export_fs.open(filename, 'rb') as f:
+            self.assertTrue(f.read().startswith('%PDF'))
+        export_fs.delete(filename)
+
+    def test_bounded_imap(self):
+        consumed = []
+
+        def jobs():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        # The jobs are only read ahead up to the given number
+        pool = MagicMock()
+        pool.apply_async.side_effect = lambda func, args: MagicMock(get=lambda: func(*args))
+        results = labels._bounded_imap(pool, lambda x: x * 2, jobs(), 3)
+        self.assertEqual(next(results), 0)
+        self.assertEqual(consumed, [0, 1, 2])
+        self.assertEqual(list(results), [2, 4, 6, 8, 10, 12, 14, 16, 18])